@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Micro-benchmark for the UART sentence framer.
+
+Feeds a serial capture (raw bytes as read from the GPSDO) through the legacy
+character-at-a-time framer and the bytearray framer, in chunks of various sizes,
+and reports throughput, CPU time per sentence, and the allocations per sentence:
+the blocks tracemalloc sees allocated over the run, with every sentence framed kept
+alive so that nothing it cost is freed before it is counted, divided by the number
+of sentences. If no capture is given, a synthetic stream resembling a few hours of
+GPSDO output is used.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trueposition.framer import TruePositionFramer
+
+def synthetic_stream(seconds=3600):
+    """
+    Build a byte stream that looks like what a TruePosition GPSDO sends: a CLOCK,
+    STATUS and EXTSTATUS every second, a handful of SAT sentences, the odd GETPOS
+    response and a sprinkling of bootloader carriage returns and line noise.
+    """
+    out = bytearray()
+    for sec in range(seconds):
+        out += '$CLOCK {} 18 3\r\n'.format(1200000000 + sec).encode('ascii')
+        out += '$STATUS 0 0 0 0 {} 0\r\n'.format(8 + sec % 4).encode('ascii')
+        out += '$EXTSTATUS 0 {} 1.23 {:.1f}\r\n'.format(9 + sec % 3, 40.0 + (sec % 50) / 10).encode('ascii')
+        for chan in range(sec % 8):
+            out += '$SAT {} {} {} {} {}\r\n'.format(chan, 1 + (chan * 3 + sec) % 32,
+                    (sec + chan * 11) % 90, (sec * 7 + chan * 40) % 360, 30 + chan).encode('ascii')
+        if sec % 30 == 0:
+            out += b'$GETPOS 45123456 -75654321 84.2 -34.1 0\r\n'
+        if sec % 600 == 0:
+            out += b'\r\r$GETVER BOOT\r\n\xff\xfe\x00garbage\n'
+    return bytes(out)
+
+class LegacyFramer(object):
+    """
+    The framer that TruePositionUART.data_received used to implement, kept here
+    verbatim (modulo the sink) for comparison.
+    """
+    def __init__(self, sink):
+        self._cur = ''
+        self._messages = []
+        self._sink = sink
+
+    def feed(self, data):
+        for c in data.decode('utf-8', 'replace'):
+            if c == '\n':
+                self._messages.append(self._cur)
+                self._cur = ''
+            elif c == '\r':
+                continue
+            else:
+                self._cur += c
+
+        if self._messages:
+            for message in self._messages:
+                if message.strip():
+                    asyncio.ensure_future(self._sink.put(message.strip()))
+            self._messages = []
+
+async def _run(kind, stream, chunk_size, keep=None):
+    queue = asyncio.Queue()
+    if kind == 'legacy':
+        framer = LegacyFramer(queue)
+    else:
+        framer = TruePositionFramer(lambda sentence, rx_time: queue.put_nowait(sentence))
+
+    nr_sentences = 0
+    start = time.perf_counter()
+    for offs in range(0, len(stream), chunk_size):
+        framer.feed(stream[offs:offs + chunk_size])
+        # Give any tasks the framer spawned a chance to run, as the event loop would
+        # between reads from the UART.
+        await asyncio.sleep(0)
+        while not queue.empty():
+            sentence = queue.get_nowait()
+            if keep is not None:
+                keep.append(sentence)
+            nr_sentences += 1
+    elapsed = time.perf_counter() - start
+    return nr_sentences, elapsed
+
+def bench(kind, stream, chunk_size, trace):
+    """
+    Frame the stream. Returns the number of sentences, the seconds taken and, if trace
+    is set, the blocks allocated per sentence.
+    """
+    if not trace:
+        nr_sentences, elapsed = asyncio.run(_run(kind, stream, chunk_size))
+        return nr_sentences, elapsed, None
+
+    keep = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    nr_sentences, elapsed = asyncio.run(_run(kind, stream, chunk_size, keep))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Leave out what tracemalloc allocated for the first snapshot
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    nr_blocks = sum(stat.count_diff for stat in after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), 'filename'))
+    return nr_sentences, elapsed, nr_blocks / nr_sentences
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TruePosition UART framer')
+    parser.add_argument('captures', nargs='*', help='raw serial captures to replay')
+    parser.add_argument('-c', '--chunk-sizes', default='1,16,64,256,4096',
+            help='comma separated list of chunk sizes to feed the framer')
+    parser.add_argument('-s', '--seconds', type=int, default=3600,
+            help='length of the synthetic stream, if no capture is given')
+    args = parser.parse_args()
+
+    if args.captures:
+        stream = b''.join(open(path, 'rb').read() for path in args.captures)
+    else:
+        stream = synthetic_stream(args.seconds)
+
+    print('{} bytes of input'.format(len(stream)))
+    print('{:>8} {:>6} {:>10} {:>12} {:>12} {:>14}'.format('framer', 'chunk', 'sentences',
+        'MB/s', 'usec/sent', 'allocs/sent'))
+
+    for chunk_size in [int(x) for x in args.chunk_sizes.split(',')]:
+        for kind in ['legacy', 'bytes']:
+            nr_sentences, elapsed, _ = bench(kind, stream, chunk_size, False)
+            _, _, allocs = bench(kind, stream, chunk_size, True)
+            print('{:>8} {:>6} {:>10} {:>12.2f} {:>12.2f} {:>14.2f}'.format(kind, chunk_size,
+                nr_sentences, len(stream) / elapsed / 1e6, elapsed / nr_sentences * 1e6,
+                allocs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Benchmark for the NMEA sentence encoder.
+
+Encodes a day's worth of gps messages (one per second, with the occasional
+position update) as RMC, ZDA and GGA, and their satellite tables as GSA and GSV
+groups, reports sentences/sec for the legacy string formatter and for NMEAEncoder,
+and checks every sentence produced against an independent reference validator.
+"""
+
+import argparse
+import calendar
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trueposition.nmea import NMEAEncoder
+
+_SENTENCE_RE = re.compile(r'^\$([A-Z]{5}),([ -~]*)\*([0-9A-F]{2})\n$')
+
+def validate(sentence, msg):
+    """
+    Reference validator: checks framing, checksum and the decoded content of each
+    field against the gps message the sentence was built from. Returns a list of
+    problems, empty if the sentence is good.
+    """
+    text = sentence.decode('ascii')
+    match = _SENTENCE_RE.match(text)
+    if not match:
+        return ['malformed framing: {!r}'.format(text)]
+
+    name, body, checksum = match.groups()
+    expected = 0
+    for c in '{},{}'.format(name, body):
+        expected ^= ord(c)
+    errors = []
+    if int(checksum, 16) != expected:
+        errors.append('checksum {} != {:02X}'.format(checksum, expected))
+
+    fields = body.split(',')
+    when = time.gmtime(msg['time'])
+
+    def check_time(field):
+        if field != time.strftime('%H%M%S', when):
+            errors.append('time {} does not match'.format(field))
+
+    def check_pos(lat, ns, lon, ew):
+        for value, hemi, deg_digits, ref, pos_hemi in [(lat, ns, 2, msg['latitude'], 'N'),
+                (lon, ew, 3, msg['longitude'], 'E')]:
+            if not re.match(r'^\d{%d}\d{2}\.\d{4}$' % deg_digits, value):
+                errors.append('bad coordinate {}'.format(value))
+                continue
+            decoded = int(value[:deg_digits]) + float(value[deg_digits:]) / 60.0
+            if hemi != pos_hemi:
+                decoded = -decoded
+            if abs(decoded - ref) > 1e-6:
+                errors.append('coordinate {}{} decodes to {}, expected {}'.format(value, hemi,
+                    decoded, ref))
+
+    if name == 'GPRMC':
+        if len(fields) != 11:
+            return errors + ['RMC has {} fields'.format(len(fields))]
+        check_time(fields[0])
+        if fields[1] != ('A' if msg['goodFix'] else 'V'):
+            errors.append('RMC status {}'.format(fields[1]))
+        check_pos(*fields[2:6])
+        if fields[8] != time.strftime('%d%m%y', when):
+            errors.append('RMC date {}'.format(fields[8]))
+    elif name == 'GPZDA':
+        if len(fields) != 6:
+            return errors + ['ZDA has {} fields'.format(len(fields))]
+        check_time(fields[0])
+        if [int(x) for x in fields[1:4]] != [when.tm_mday, when.tm_mon, when.tm_year]:
+            errors.append('ZDA date {}'.format(fields[1:4]))
+    elif name == 'GPGSA':
+        used = ['{:02d}'.format(sat['satId']) for sat in msg['trackedSats'] if sat['snr']][:12]
+        if len(fields) != 17:
+            return errors + ['GSA has {} fields'.format(len(fields))]
+        if [prn for prn in fields[2:14] if prn] != used:
+            errors.append('GSA PRNs {}'.format(fields[2:14]))
+    elif name == 'GPGSV':
+        total, idx, in_view = [int(x) for x in fields[:3]]
+        sats = msg['trackedSats'][(idx - 1) * 4:idx * 4]
+        if in_view != len(msg['trackedSats']) or total != max(1, -(-in_view // 4)):
+            errors.append('GSV {} of {}, {} in view'.format(idx, total, in_view))
+        if len(fields) != 3 + 4 * len(sats):
+            return errors + ['GSV has {} fields'.format(len(fields))]
+        for n, sat in enumerate(sats):
+            prn, el, az, snr = fields[3 + n * 4:7 + n * 4]
+            if (int(prn), int(el), int(az), int(snr or 0)) != (sat['satId'], sat['el'], sat['az'],
+                    sat['snr']):
+                errors.append('GSV satellite {}'.format(fields[3 + n * 4:7 + n * 4]))
+    elif name == 'GPGGA':
+        if len(fields) != 14:
+            return errors + ['GGA has {} fields'.format(len(fields))]
+        check_time(fields[0])
+        check_pos(*fields[1:5])
+        if int(fields[5]) != (1 if msg['goodFix'] else 0) or int(fields[6]) != msg['nrSats']:
+            errors.append('GGA fix {} sats {}'.format(fields[5], fields[6]))
+        if abs(float(fields[8]) - msg['elevMetres']) > 0.05:
+            errors.append('GGA altitude {}'.format(fields[8]))
+    else:
+        errors.append('unexpected sentence {}'.format(name))
+    return errors
+
+def gps_messages(seconds, nr_channels=12):
+    start = calendar.timegm((2018, 12, 31, 12, 0, 0))
+    # A few sites, including ones with fewer than 10 minutes of arc and some in the
+    # southern and eastern hemispheres, to exercise zero padding.
+    sites = [(45.4215296, -75.6971931), (45.0500001, -75.0833333), (-33.8688197, 151.2092955),
+             (51.4778, -0.0014), (-0.1807, 6.7312), (64.1265, -21.8174)]
+    msgs = []
+    for sec in range(seconds):
+        if sec % 30 == 0:
+            # A GETPOS response wiggling the position a little
+            lat, lon = sites[(sec // 600) % len(sites)]
+            lat += (sec % 600) * 1e-7
+            lon -= (sec % 600) * 1e-7
+        # SNRs jitter from one second to the next, so the satellites always change
+        sats = [{'satId': 1 + (chan * 3 + sec // 3600) % 32, 'el': (sec // 60 + chan * 11) % 90,
+                 'az': (sec // 30 + chan * 40) % 360, 'snr': 0 if chan == 5 else 30 + (sec + chan) % 15,
+                 'slotId': chan, 'lastSeen': start + sec} for chan in range(nr_channels)]
+        msgs.append({'type': 'gps', 'time': start + sec, 'latitude': lat, 'longitude': lon,
+            'elevMetres': 84.2, 'geoidOffs': -34.1, 'goodFix': sec % 100 != 0,
+            'nrSats': 8 + sec % 4, 'nrTrackedSats': 8 + sec % 4, 'trackedSats': sats})
+    return msgs
+
+class LegacyEncoder(object):
+    """
+    What TruePositionNMEAWriter used to do for each CLOCK message, for comparison.
+    """
+    def rmc(self, msg):
+        def _frac_to_dm(frac_n):
+            frac = abs(frac_n)
+            deg = int(frac)
+            mins = (frac - deg) * 60.0
+            return (deg, mins)
+
+        lon = msg.get('longitude', 0)
+        lat = msg.get('latitude', 0)
+        lat_deg, lat_mins = _frac_to_dm(lat)
+        lon_deg, lon_mins = _frac_to_dm(lon)
+        now = time.gmtime(msg.get('time'))
+        fields = {'time': time.strftime('%H%M%S', now),
+                'date': time.strftime('%d%m%y', now),
+                'lat_deg': lat_deg,
+                'lat_mins': lat_mins,
+                'lon_deg': lon_deg,
+                'lon_mins': lon_mins,
+                'lat_dir': 'N' if lat > 0 else 'S',
+                'lon_dir': 'E' if lon > 0 else 'W',
+                'fix_quality': 'A' if msg.get('goodFix', False) else 'V',
+                }
+        return self._finish('GPRMC,{time},{fix_quality},{lat_deg:02d}{lat_mins:6.4f},{lat_dir},{lon_deg:03d}{lon_mins:6.4f},{lon_dir},0.0,0.0,{date},0.0,E'.format(**fields))
+
+    def zda(self, msg):
+        gmt = time.gmtime(msg.get('time'))
+        return self._finish('GPZDA,{:02d}{:02d}{:02d},{:02d},{:02d},{:04d},0,0'.format(gmt.tm_hour,
+                gmt.tm_min, gmt.tm_sec, gmt.tm_mday, gmt.tm_mon, gmt.tm_year))
+
+    def _finish(self, msg_body):
+        checksum = 0
+        for c in msg_body:
+            checksum ^= ord(c)
+        return '${}*{:2X}\n'.format(msg_body, checksum).encode('ascii')
+
+def run(encoder, kinds, msgs):
+    out = []
+    start = time.perf_counter()
+    for msg in msgs:
+        for kind in kinds:
+            out.append(getattr(encoder, kind)(msg))
+    return out, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the NMEA sentence encoder')
+    parser.add_argument('-s', '--seconds', type=int, default=86400,
+            help='number of one second gps messages to encode')
+    parser.add_argument('-c', '--channels', type=int, default=12,
+            help='receiver channels in each satellite table')
+    args = parser.parse_args()
+
+    msgs = gps_messages(args.seconds, args.channels)
+    print('{:>8} {:>12} {:>14} {:>10}'.format('encoder', 'sentences', 'sentences/s', 'invalid'))
+
+    for name, encoder, kinds in [('legacy', LegacyEncoder(), ['rmc', 'zda']),
+            ('cached', NMEAEncoder(), ['rmc', 'zda']),
+            ('cached+', NMEAEncoder(), ['rmc', 'zda', 'gga']),
+            ('sats', NMEAEncoder(), ['gsa', 'gsv'])]:
+        out, elapsed = run(encoder, kinds, msgs)
+        invalid = 0
+        nr_sentences = 0
+        for idx, block in enumerate(out):
+            # A GSV group is several sentences in one block
+            for sentence in block.splitlines(keepends=True):
+                nr_sentences += 1
+                errors = validate(sentence, msgs[idx // len(kinds)])
+                if errors:
+                    invalid += 1
+                    if invalid <= 3:
+                        print('  {}: {!r}: {}'.format(name, sentence, '; '.join(errors)))
+        print('{:>8} {:>12} {:>14.0f} {:>10}'.format(name, nr_sentences, nr_sentences / elapsed,
+            invalid))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Compares the queued pipeline (sentences queued for the state manager's task, fixes
+queued for each output's task) with the direct one (gpsagent.py --pipeline direct),
+where a sentence is parsed, handled and written out in the call stack of the read
+that framed it.
+
+A synthetic capture is replayed through the framer, the state manager and an NMEA
+writer (every sentence, to /dev/null) in process. Reports the CPU time spent per
+sentence, replaying as fast as possible, and the latency of each stage from the bytes
+arriving to the NMEA being written, replaying at --speed so the pipeline is not
+backlogged.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_replay import NullUART, record_synthetic
+from trueposition.capture import replay_capture
+from trueposition.framer import TruePositionFramer
+from trueposition.nmea_writer import NMEA_SENTENCES, TruePositionNMEAWriter
+from trueposition.state import TruePositionState
+
+PIPELINES = ['queued', 'direct']
+
+async def replay(capture, pipeline, speed):
+    """
+    Replay the capture through one pipeline. Returns the CPU seconds used, the number of
+    sentences handled, and the latency stats.
+    """
+    loop = asyncio.get_event_loop()
+    direct = pipeline == 'direct'
+    nmea = TruePositionNMEAWriter(os.devnull, loop=loop, direct=direct,
+            intervals={name: 1 for name in NMEA_SENTENCES})
+    outputs = [nmea]
+    state = TruePositionState(NullUART(), outputs, latency_log_interval_sec=0, direct=direct)
+    for output in outputs:
+        output.start(loop=loop)
+    state.start(loop=loop)
+    # The synthetic stream never answers $GETVER, so answer it up front, rather than
+    # have every sentence ask again
+    state.receive_message('$GETVER TP 1.0 a b c SN1234')
+    framer = TruePositionFramer(state.receive_message)
+
+    start = time.process_time()
+    await replay_capture(capture, framer.feed, speed=speed, loop=loop)
+    # Let the queued pipeline catch up
+    while state._msg_queue.qsize() or len(nmea._sub):
+        await asyncio.sleep(0)
+    cpu_secs = time.process_time() - start
+
+    state.stop()
+    for output in outputs:
+        output.stop()
+    # The handler and writer tasks wait on their queues, and would outlive the run
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    nr_sentences = sum(stats['count'] for stats in state.get_sentence_stats().values())
+    return cpu_secs, nr_sentences, state.get_latency_stats()
+
+async def run(args):
+    capture = args.capture
+    if not capture:
+        capture = os.path.join(tempfile.mkdtemp(), 'synthetic.tpcap')
+        record_synthetic(capture, args.seconds)
+
+    print('{:>8} {:>10} {:>14}'.format('pipeline', 'sentences', 'CPU us/sentence'))
+    for pipeline in PIPELINES:
+        cpu_secs, nr_sentences, _ = await replay(capture, pipeline, 0)
+        print('{:>8} {:10} {:14.2f}'.format(pipeline, nr_sentences, cpu_secs / nr_sentences * 1e6))
+
+    print('\nReplaying at {}x'.format(args.speed))
+    print('{:>8} {:>14} {:>8} {:>10} {:>10} {:>10}'.format('pipeline', 'stage', 'count', 'mean us',
+        'p99 us', 'max us'))
+    for pipeline in PIPELINES:
+        _, _, latency = await replay(capture, pipeline, args.speed)
+        for stage in ['framing', 'dispatch', 'fanout.nmea', 'write.nmea', 'total.nmea']:
+            stats = latency.get(stage)
+            if not stats:
+                continue
+            print('{:>8} {:>14} {:8} {:10.1f} {:10.1f} {:10.1f}'.format(pipeline, stage,
+                stats['count'], stats['meanSecs'] * 1e6, stats['p99Secs'] * 1e6,
+                stats['maxSecs'] * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='?', help='serial capture to replay')
+    parser.add_argument('--seconds', type=int, default=600,
+            help='seconds of synthetic stream to build if no capture is given')
+    parser.add_argument('--speed', type=float, default=20,
+            help='multiple of real time to replay at, for the latency run')
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
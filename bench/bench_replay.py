@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Replays a serial capture (recorded with gpsagent.py --capture) through the framer,
+the state manager and the NMEA and ephemeris outputs, in process, and reports the
+sustained sentence rate and the latency of each stage. Faults can be injected into
+the stream on the way. With --min-rate, exits non-zero if the pipeline does not
+keep up, so throughput regressions can be caught without a GPSDO.
+
+If no capture is given, a synthetic one is built from the stream in
+bench_framer.py. --record saves it, for use with gpsagent.py --replay.
+
+With --pty, the capture is instead replayed into a pseudo-terminal, so a separate
+agent can be pointed at it (gpsagent.py -u <pty> -b 9600).
+
+The event loop monitor watches the replay. With --stall and a --speed, the loop is
+blocked now and then, and every CLOCK is checked against when it should have arrived:
+the monitor must hold back each one that was stamped later than --loop-lag-ms.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_framer import synthetic_stream
+from trueposition.capture import (FaultInjector, TruePositionCaptureWriter, open_replay_pty,
+        replay_capture)
+from trueposition.framer import TruePositionFramer
+from trueposition.loop_monitor import TruePositionLoopMonitor
+from trueposition.nmea_writer import TruePositionNMEAWriter
+from trueposition.sat_writer import TruePositionSatWriter
+from trueposition.state import TruePositionState
+
+class NullUART(object):
+    def __init__(self):
+        self.commands = []
+
+    async def enqueue_command(self, cmd):
+        self.commands.append(cmd)
+
+def record_synthetic(path, seconds, chunk_size=64):
+    """
+    Write a capture of the synthetic stream, one second of sentences at a time, split
+    into chunks the size a UART read would typically return.
+    """
+    stream = synthetic_stream(seconds)
+    writer = TruePositionCaptureWriter(path)
+    start = time.time()
+    # Every second of the stream starts with its CLOCK
+    for sec, block in enumerate(stream.split(b'$CLOCK')[1:]):
+        block = b'$CLOCK' + block
+        for offset in range(0, len(block), chunk_size):
+            writer.write(block[offset:offset + chunk_size], start + sec + offset / 1e4)
+    writer.close()
+
+class TimeSampleChecker(object):
+    """
+    Stands in for a time output: asks the loop monitor about each time sample, the way
+    the SHM and chrony writers do, and keeps the answer for checking afterwards.
+    """
+    def __init__(self):
+        self.samples = []
+
+    def subscribe(self, bus):
+        self._loop_monitor = bus.loop_monitor
+        bus.subscribe('check', types=['gps'], callback=self._check)
+
+    def _check(self, msg):
+        self.samples.append((msg['time'], msg['rxTime'],
+            self._loop_monitor.sample_is_late('check', msg['rxTime'])))
+
+    def start(self, loop=asyncio.get_event_loop()):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self, speed, threshold_sec):
+        """
+        Compare the monitor's verdicts with how late each sample really was, judged by
+        the earliest any sample arrived relative to its GPS time. Returns the number of
+        late samples the monitor let through.
+        """
+        offsets = [rx_time - gps_time / speed for gps_time, rx_time, _ in self.samples]
+        base = min(offsets)
+        late = [offset - base > threshold_sec for offset in offsets]
+        flagged = [flag for _, _, flag in self.samples]
+        missed = sum(1 for was, flag in zip(late, flagged) if was and not flag)
+        print('Time samples: {} stamped late, {} held back, {} late ones let through, '
+            '{} held back needlessly'.format(sum(late), sum(flagged), missed,
+            sum(1 for was, flag in zip(late, flagged) if flag and not was)))
+        return missed
+
+async def replay_in_process(capture, speed, faults, min_rate, loop_monitor):
+    loop = asyncio.get_event_loop()
+    tmpdir = tempfile.mkdtemp()
+    checker = TimeSampleChecker()
+    outputs = [TruePositionNMEAWriter(os.devnull, loop=loop),
+               TruePositionSatWriter(os.path.join(tmpdir, 'sats.jsonl'), loop=loop), checker]
+    uart = NullUART()
+    state = TruePositionState(uart, outputs, latency_log_interval_sec=0, loop_monitor=loop_monitor)
+    for output in outputs:
+        output.start(loop=loop)
+    state.start(loop=loop)
+    loop_monitor.start(loop=loop)
+    framer = TruePositionFramer(state.enqueue_message_nowait)
+
+    start = time.perf_counter()
+    nr_bytes = await replay_capture(capture, framer.feed, speed=speed, faults=faults, loop=loop)
+    while state._msg_queue.qsize():
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    loop_monitor.stop()
+    state.stop()
+    for output in outputs:
+        output.stop()
+
+    sentences = state.get_sentence_stats()
+    nr_sentences = sum(stats['count'] for stats in sentences.values())
+    rate = nr_sentences / elapsed
+    print('Replayed {} bytes, {} sentences in {:.3f}s: {:.0f} sentences/s, {:.2f} MB/s'.format(
+        nr_bytes, nr_sentences, elapsed, rate, nr_bytes / elapsed / 1e6))
+    print('Framer: {} overruns'.format(framer.nr_overruns))
+    if faults:
+        print('Faults injected: {}'.format(', '.join('{}={}'.format(k, v)
+            for k, v in sorted(faults.nr_faults.items()))))
+    print('Commands sent to the GPSDO: {}'.format(len(uart.commands)))
+    print('{:>12} {:>8} {:>8} {:>8}'.format('sentence', 'count', 'errors', 'us/parse'))
+    for tag, stats in sorted(sentences.items()):
+        print('{:>12} {:8} {:8} {:8.2f}'.format(tag, stats['count'],
+            stats['fieldCountErrors'] + stats['typeErrors'] + stats['handlerErrors'], stats['meanParseSecs'] * 1e6))
+    print('{:>16} {:>8} {:>10} {:>10} {:>10}'.format('stage', 'count', 'p50 us', 'p99 us', 'max us'))
+    for stage, stats in state.get_latency_stats().items():
+        print('{:>16} {:8} {:10.1f} {:10.1f} {:10.1f}'.format(stage, stats['count'],
+            stats['p50Secs'] * 1e6, stats['p99Secs'] * 1e6, stats['maxSecs'] * 1e6))
+    for name, stats in sorted(state.get_output_stats().items()):
+        print('Output {}: delivered {}, dropped {}, coalesced {}'.format(name, stats['delivered'],
+            stats['dropped'], stats['coalesced']))
+
+    loop_stats = loop_monitor.get_stats()
+    print('Loop ({}): lag p99<={:.3f}ms max={:.3f}ms, {} stalls'.format(loop_stats['implementation'],
+        loop_stats['lag']['p99Secs'] * 1e3, loop_stats['lag']['maxSecs'] * 1e3, loop_stats['nrStalls']))
+
+    ok = True
+    if speed and checker.samples and checker.report(speed, loop_monitor.threshold_sec):
+        print('FAIL: the loop monitor let late time samples through')
+        ok = False
+    if min_rate and rate < min_rate:
+        print('FAIL: {:.0f} sentences/s is below the minimum of {:.0f}'.format(rate, min_rate))
+        ok = False
+    return ok
+
+async def replay_to_pty(capture, speed, faults):
+    master, slave, path = open_replay_pty()
+    print('Replaying {} into {}'.format(capture, path))
+    try:
+        nr_bytes = await replay_capture(capture, lambda data: os.write(master, data), speed=speed,
+                faults=faults)
+        print('Replayed {} bytes'.format(nr_bytes))
+    finally:
+        os.close(master)
+        os.close(slave)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='?', help='serial capture to replay')
+    parser.add_argument('--seconds', type=int, default=3600,
+            help='seconds of synthetic stream to build if no capture is given')
+    parser.add_argument('--record', help='save the synthetic capture to this file and exit')
+    parser.add_argument('--speed', type=float, default=0,
+            help='multiple of real time to replay at (0 for as fast as possible)')
+    parser.add_argument('--pty', action='store_true', help='replay into a pseudo-terminal')
+    parser.add_argument('--min-rate', type=float, default=0,
+            help='fail if fewer sentences than this are handled per second')
+    parser.add_argument('--garbage', type=float, default=0, help='chance per chunk of garbage bytes')
+    parser.add_argument('--truncate', type=float, default=0, help='chance per chunk of a truncated line')
+    parser.add_argument('--boot', type=float, default=0, help='chance per chunk of a bootloader banner')
+    parser.add_argument('--sat-burst', type=float, default=0, help='chance per chunk of a $SAT burst')
+    parser.add_argument('--sat-burst-len', type=int, default=64, help='sentences in a $SAT burst')
+    parser.add_argument('--stall', type=float, default=0, help='chance per chunk of a stalled loop')
+    parser.add_argument('--stall-ms', type=float, default=200, help='milliseconds each stall lasts')
+    parser.add_argument('--seed', type=int, default=0, help='seed for fault injection')
+    parser.add_argument('--loop', default='asyncio', choices=['asyncio', 'uvloop'],
+            help='event loop implementation to replay on')
+    parser.add_argument('--loop-tick-ms', type=float, default=20,
+            help='milliseconds between checks of the event loop lag')
+    parser.add_argument('--loop-lag-ms', type=float, default=50,
+            help='lag past which the loop monitor holds back time samples')
+    args = parser.parse_args()
+
+    if args.record:
+        record_synthetic(args.record, args.seconds)
+        return
+
+    capture = args.capture
+    if not capture:
+        capture = os.path.join(tempfile.mkdtemp(), 'synthetic.tpcap')
+        record_synthetic(capture, args.seconds)
+
+    faults = FaultInjector(garbage=args.garbage, truncate=args.truncate, boot=args.boot,
+            sat_burst=args.sat_burst, sat_burst_len=args.sat_burst_len, stall=args.stall,
+            stall_sec=args.stall_ms / 1000.0, seed=args.seed)
+    if not faults.enabled:
+        faults = None
+
+    if args.loop == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    if args.pty:
+        loop.run_until_complete(replay_to_pty(capture, args.speed or 1.0, faults))
+        return
+
+    loop_monitor = TruePositionLoopMonitor(tick_sec=args.loop_tick_ms / 1000.0,
+            threshold_sec=args.loop_lag_ms / 1000.0, log_interval_sec=0)
+    if not loop.run_until_complete(replay_in_process(capture, args.speed, faults, args.min_rate,
+            loop_monitor)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
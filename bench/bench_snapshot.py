@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Compares the two ways a local process can read the GPSDO state: GET / from the HTTP
+API (over a kept-alive connection, parsing the JSON), and the shared memory snapshot
+through SnapshotReader.
+
+Runs a state manager with the HTTP API and a snapshot writer in this process, fed a
+CLOCK, STATUS, EXTSTATUS and a few SATs every few milliseconds so the snapshot keeps
+changing under the reader, and times reads of each from a child process.
+
+With --stress, a child process instead publishes snapshots as fast as it can, each
+one built from a single counter, while this process reads them and checks that no
+read mixes fields from two publications.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trueposition.http import TruePositionHTTPApi
+from trueposition.snapshot import SnapshotReader, TruePositionSnapshotWriter
+from trueposition.state import TruePositionState
+
+class NullUART(object):
+    async def enqueue_command(self, cmd):
+        pass
+
+def time_reads(port, path, reads, results):
+    timings = {}
+
+    conn = http.client.HTTPConnection('localhost', port)
+    start = time.perf_counter()
+    for _ in range(reads):
+        conn.request('GET', '/')
+        state = json.loads(conn.getresponse().read())
+    timings['HTTP GET / + JSON'] = (time.perf_counter() - start) / reads
+    conn.close()
+
+    reader = SnapshotReader(path)
+    start = time.perf_counter()
+    for _ in range(reads):
+        snapshot = reader.read()
+    timings['snapshot read()'] = (time.perf_counter() - start) / reads
+
+    start = time.perf_counter()
+    for _ in range(reads):
+        seq, raw = reader.read_raw()
+    timings['snapshot read_raw()'] = (time.perf_counter() - start) / reads
+
+    start = time.perf_counter()
+    for _ in range(reads):
+        seq = reader.sequence
+    timings['snapshot sequence'] = (time.perf_counter() - start) / reads
+
+    # Both should describe the same fix
+    assert abs(state['location']['lat'] - snapshot['location']['lat']) < 1e-9
+    results.put((timings, reader.nr_retries))
+
+def stress_state(idx):
+    """
+    A state in which every field that varies is derived from idx, so a snapshot that
+    mixes two publications shows up as fields that disagree.
+    """
+    return {'state': 0, 'tenMhzBad': False, 'onePPSBad': False, 'antennaBad': False,
+            'isSurvey': False, 'isBooted': True, 'leapSeconds': 18, 'unixEpoch': 1.5e9 + idx,
+            'gpsEpoch': idx, 'holdoverSec': idx % 1000, 'timeQuality': 3, 'nrTrackedSats': idx % 30,
+            'location': {'lat': float(idx), 'lon': float(idx), 'elevMetres': 1.0, 'elevCorrWGS84': 2.0},
+            'extParams': {'temperatureC': 40.0, 'tdop': 1.0, 'nrSignals': 9},
+            'trackedSats': [{'satId': (idx + chan) % 255, 'slotId': chan, 'el': 10, 'snr': 30,
+                             'az': idx % 360} for chan in range(idx % 30)],
+            'staleFields': []}
+
+def stress_writer(path, nr_publications):
+    writer = TruePositionSnapshotWriter(path)
+    for idx in range(nr_publications):
+        writer.publish(stress_state(idx), idx)
+    writer.stop()
+
+def stress(path, nr_publications):
+    """
+    Read snapshots while a child process publishes them. Returns the number of torn
+    reads.
+    """
+    writer = TruePositionSnapshotWriter(path)
+    writer.publish(stress_state(0), 0)
+    writer.stop()
+    child = multiprocessing.Process(target=stress_writer, args=(path, nr_publications))
+    child.start()
+
+    reader = SnapshotReader(path)
+    nr_reads = 0
+    nr_torn = 0
+    while child.is_alive():
+        snapshot = reader.read()
+        nr_reads += 1
+        idx = snapshot['version']
+        if snapshot['gpsEpoch'] != idx or snapshot['location']['lat'] != idx or \
+                snapshot['location']['lon'] != idx or snapshot['holdoverSec'] != idx % 1000 or \
+                len(snapshot['trackedSats']) != idx % 30 or \
+                any(sat['az'] != idx % 360 for sat in snapshot['trackedSats']):
+            nr_torn += 1
+    child.join()
+    reader.close()
+
+    print('{} reads against {} publications: {} torn, {} seqlock retries'.format(nr_reads,
+        nr_publications, nr_torn, reader.nr_retries))
+    return nr_torn
+
+async def feed(state, interval_sec):
+    sec = 0
+    while True:
+        state.enqueue_message_nowait('$CLOCK {} 18 3'.format(1200000000 + sec))
+        state.enqueue_message_nowait('$STATUS 0 0 0 {} {} 0'.format(sec % 7, 8 + sec % 4))
+        state.enqueue_message_nowait('$EXTSTATUS 0 {} 1.23 {:.1f}'.format(9 + sec % 3, 40 + sec % 50 / 10))
+        for chan in range(8):
+            state.enqueue_message_nowait('$SAT {} {} {} {} {}'.format(chan, 1 + (chan * 3 + sec) % 32,
+                (sec + chan * 11) % 90, (sec * 7 + chan * 40) % 360, 30 + chan))
+        sec += 1
+        await asyncio.sleep(interval_sec)
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    path = os.path.join(tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None),
+            'gpsagent.snapshot')
+    snapshot = TruePositionSnapshotWriter(path)
+    state = TruePositionState(NullUART(), [], latency_log_interval_sec=0, snapshot=snapshot)
+    state.enqueue_message_nowait('$GETPOS 45123456 -75654321 84.2 -34.1 0')
+    state.enqueue_message_nowait('$GETVER TP 1.0 a b c SN1234')
+    api = TruePositionHTTPApi(state, port=args.port, loop=loop)
+    state.start(loop=loop)
+    api.start(loop=loop)
+    feeder = asyncio.ensure_future(feed(state, args.update_ms / 1000.0))
+    await asyncio.sleep(0.5)
+
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=time_reads, args=(args.port, path, args.reads, results))
+    child.start()
+    while child.is_alive():
+        await asyncio.sleep(0.05)
+    feeder.cancel()
+    state.stop()
+
+    timings, nr_retries = results.get()
+    print('{} reads each, snapshot updated {} times while reading'.format(args.reads,
+        snapshot.nr_published))
+    print('{:>24} {:>12}'.format('path', 'us/read'))
+    for name, secs in timings.items():
+        print('{:>24} {:12.2f}'.format(name, secs * 1e6))
+    print('Seqlock retries: {}'.format(nr_retries))
+    os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reads', type=int, default=5000, help='reads to time for each path')
+    parser.add_argument('--port', type=int, default=24611, help='port for the HTTP API')
+    parser.add_argument('--update-ms', type=float, default=2.0,
+            help='milliseconds between updates to the state')
+    parser.add_argument('--stress', type=int, default=0, metavar='N',
+            help='publish N snapshots from a child process and check every read for tearing')
+    args = parser.parse_args()
+
+    if args.stress:
+        path = os.path.join(tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None),
+                'gpsagent.snapshot')
+        nr_torn = stress(path, args.stress)
+        os.unlink(path)
+        if nr_torn:
+            sys.exit(1)
+        return
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Stand-in for chrony's SOCK refclock.
+
+By default, binds a Unix datagram socket in a temporary directory, runs the state
+manager and the chrony SOCK output against it, feeds CLOCK sentences through the
+UART framer and checks every sample that arrives: the magic, the offset against the
+CLOCK time, the leap indication, that nothing arrives while the GPSDO is unlocked,
+and how long each sample took from the bytes being framed to arriving at the
+socket.
+
+With --listen, just binds the given path and prints the samples a running agent
+(started with -C <path>) sends, the way chrony would see them.
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trueposition.framer import TruePositionFramer
+from trueposition.sock_writer import SOCK_LEAP_NORMAL, decode_sock_sample, TruePositionSockWriter
+from trueposition.state import TruePositionState
+
+GPS_EPOCH_DELTA = 315964800
+LEAP_SECONDS = 18
+
+class NullUART(object):
+    async def enqueue_command(self, cmd):
+        pass
+
+def bind(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    return sock
+
+def listen(path):
+    sock = bind(path)
+    try:
+        while True:
+            data = sock.recv(1024)
+            now = time.time()
+            receive_time, offset, pulse, leap = decode_sock_sample(data)
+            print('{:.6f}: receive={:.6f} offset={:+.6f} pulse={} leap={} (arrived {:.3f}ms later)'.format(
+                now, receive_time, offset, pulse, leap, (now - receive_time) * 1e3))
+    finally:
+        os.unlink(path)
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+async def run(nr_samples, fudge_sec, max_latency_sec):
+    loop = asyncio.get_event_loop()
+    path = os.path.join(tempfile.mkdtemp(), 'chrony.sock')
+    sock = bind(path)
+    sock.setblocking(False)
+
+    writer = TruePositionSockWriter(path, loop=loop, fudge_sec=fudge_sec)
+    state = TruePositionState(NullUART(), [writer], latency_log_interval_sec=0)
+    state.start(loop=loop)
+    framer = TruePositionFramer(state.enqueue_message_nowait)
+
+    latencies = []
+    nr_unlocked = 0
+    for idx in range(nr_samples):
+        gps_sec = 1200000000 + idx
+        # Every tenth second, the GPSDO reports it has lost lock
+        locked = idx % 10 != 9
+        framer.feed('$STATUS 0 0 0 0 8 {}\r\n'.format(0 if locked else 1).encode('ascii'))
+        sent = time.time()
+        framer.feed('$CLOCK {} {} 3\r\n'.format(gps_sec, LEAP_SECONDS).encode('ascii'))
+
+        try:
+            data = await asyncio.wait_for(loop.sock_recv(sock, 1024), 0.1)
+        except asyncio.TimeoutError:
+            assert not locked, 'No sample for a locked CLOCK at {}'.format(gps_sec)
+            nr_unlocked += 1
+            continue
+        arrived = time.time()
+        assert locked, 'Sample sent while unlocked at {}'.format(gps_sec)
+
+        receive_time, offset, pulse, leap = decode_sock_sample(data)
+        assert leap == SOCK_LEAP_NORMAL and pulse == 0
+        expected_receive = sent - fudge_sec
+        assert abs(receive_time - expected_receive) < max_latency_sec, \
+            'Receive time off by {:.6f}s'.format(receive_time - expected_receive)
+        utc = GPS_EPOCH_DELTA - LEAP_SECONDS + gps_sec
+        assert abs(receive_time + offset - utc) < 1e-5, 'Offset does not lead to the CLOCK time'
+        latencies.append(arrived - sent)
+
+    state.stop()
+    writer.stop()
+    sock.close()
+    os.unlink(path)
+
+    print('{} samples, {} suppressed while unlocked'.format(len(latencies), nr_unlocked))
+    print('Framed to arrival: p50 {:.1f}us p99 {:.1f}us max {:.1f}us'.format(
+        percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6, max(latencies) * 1e6))
+    # A single sample held up by the scheduler says nothing about the output, so judge the tail
+    assert percentile(latencies, 0.99) < max_latency_sec, 'Samples arrived too late'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listen', help='bind this path and print samples from a running agent')
+    parser.add_argument('--samples', type=int, default=1000, help='number of CLOCK sentences to feed')
+    parser.add_argument('--fudge-ms', type=float, default=0, help='receive timestamp fudge to check')
+    parser.add_argument('--max-latency-ms', type=float, default=5,
+            help='fail if the 99th percentile sample takes longer than this to arrive')
+    args = parser.parse_args()
+
+    if args.listen:
+        listen(args.listen)
+        return
+
+    asyncio.get_event_loop().run_until_complete(run(args.samples, args.fudge_ms / 1000.0,
+        args.max_latency_ms / 1000.0))
+
+if __name__ == '__main__':
+    main()
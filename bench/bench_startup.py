@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Startup benchmark.
+
+Reports how long importing the trueposition package and each of its subsystems
+takes in a fresh interpreter, then starts gpsagent.py against a replayed capture
+and reports how long it takes from launch to the first sample appearing in the
+ntpd shared memory segment, and to the agent signalling that it is ready, with and
+without the HTTP server.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_replay import record_synthetic
+
+AGENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gpsagent.py')
+
+IMPORTS = ['trueposition', 'trueposition.state', 'trueposition.uart', 'trueposition.http',
+           'trueposition.shm_writer', 'trueposition.nmea_writer', 'trueposition.sat_writer',
+           'trueposition.tcp_server']
+
+_IMPORT_TIMER = ('import time; start = time.perf_counter(); import {}; '
+                 'print(time.perf_counter() - start)')
+
+def import_time(module, runs):
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', _IMPORT_TIMER.format(module)],
+                cwd=os.path.dirname(AGENT))
+        times.append(float(out))
+    return statistics.median(times)
+
+def time_to_first_sample(capture, unit, extra_args, timeout_sec=30):
+    """
+    Launch the agent, and time the first SHM sample and the ready file from launch.
+    """
+    import ntpdshm
+    shm = ntpdshm.NtpdShm(unit=unit)
+    start_count = shm.count
+    ready_file = os.path.join(tempfile.mkdtemp(), 'ready')
+
+    start = time.perf_counter()
+    agent = subprocess.Popen([sys.executable, AGENT, '--replay', capture, '-S', str(unit),
+        '--shm-direct', '--ready-file', ready_file, '--latency-log-sec', '0'] + extra_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_sample = ready = None
+    try:
+        while time.perf_counter() - start < timeout_sec and (first_sample is None or ready is None):
+            now = time.perf_counter() - start
+            if first_sample is None and shm.count != start_count:
+                first_sample = now
+            if ready is None and os.path.exists(ready_file):
+                ready = now
+            if agent.poll() is not None:
+                break
+            time.sleep(0.0005)
+    finally:
+        agent.terminate()
+        agent.wait()
+    return first_sample, ready
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='runs to take the median of')
+    parser.add_argument('--unit', type=int, default=5, help='ntpd SHM unit to use')
+    args = parser.parse_args()
+
+    print('{:>28} {:>10}'.format('import', 'ms'))
+    for module in IMPORTS:
+        print('{:>28} {:10.1f}'.format(module, import_time(module, args.runs) * 1e3))
+
+    capture = os.path.join(tempfile.mkdtemp(), 'startup.tpcap')
+    record_synthetic(capture, 60)
+
+    print('{:>28} {:>14} {:>10}'.format('agent', 'first SHM ms', 'ready ms'))
+    for label, extra_args in [('no HTTP', ['-P', '0']), ('HTTP', ['-P', '24681'])]:
+        results = [time_to_first_sample(capture, args.unit, extra_args) for _ in range(args.runs)]
+        samples = [sample for sample, _ in results if sample is not None]
+        readies = [ready for _, ready in results if ready is not None]
+        if not samples or not readies:
+            print('{:>28} {:>14} {:>10}'.format(label, 'timed out', ''))
+            continue
+        print('{:>28} {:14.1f} {:10.1f}'.format(label, statistics.median(samples) * 1e3,
+            statistics.median(readies) * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Load test for the TCP NMEA / gpsd server.
+
+Starts the server on a bus in this process, connects a few hundred clients from a
+child process, publishes a burst of fixes and reports how long the server took to
+fan them out and the CPU time it spent doing so. A handful of the clients never
+read, to check that slow readers are dropped (or disconnected) without holding up
+the rest.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from trueposition.bus import DISCONNECT, DROP_NEWEST, TruePositionBus
+from trueposition.tcp_server import TruePositionTCPServer
+
+def gps_message(sec):
+    return {'type': 'gps', 'time': 1515964800 + sec, 'latitude': 45.123456, 'longitude': -75.654321,
+            'elevMetres': 84.2, 'geoidOffs': -34.1, 'goodFix': True, 'nrSats': 9,
+            'leapSeconds': 18, 'pubTime': time.monotonic(), 'rxTime': time.monotonic()}
+
+def run_clients(port, protocol, nr_clients, nr_stalled, ready, results):
+    async def client(idx):
+        reader, writer = await asyncio.open_connection('localhost', port)
+        if protocol == 'gpsd':
+            writer.write(b'?WATCH={"enable":true,"json":true};\n')
+        if idx < nr_stalled:
+            # Never read, with as small a socket buffer as the kernel allows, so the
+            # server's buffer for this client soon fills up
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1)
+            await asyncio.sleep(3600)
+        nr_lines = 0
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.startswith(b'$GPRMC') or line.startswith(b'{"class": "TPV"'):
+                nr_lines += 1
+        return nr_lines
+
+    async def main():
+        tasks = [asyncio.ensure_future(client(idx)) for idx in range(nr_clients)]
+        await asyncio.sleep(1.0)
+        ready.set()
+        done, _ = await asyncio.wait(tasks[nr_stalled:])
+        results.put([task.result() for task in done])
+        for task in tasks[:nr_stalled]:
+            task.cancel()
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    bus = TruePositionBus()
+    server = TruePositionTCPServer(args.port, loop=loop, protocol=args.protocol,
+            max_clients=args.clients, max_client_buffer=args.buffer,
+            slow_policy=DISCONNECT if args.disconnect else DROP_NEWEST, queue_len=args.fixes)
+    server.subscribe(bus)
+    server.start(loop=loop)
+    await asyncio.sleep(0.2)
+
+    ready = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_clients, args=(args.port, args.protocol, args.clients,
+        args.stalled, ready, results))
+    child.start()
+    while not ready.is_set():
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for sec in range(args.fixes):
+        bus.publish(gps_message(sec))
+        await asyncio.sleep(0)
+    while len(server._sub):
+        await asyncio.sleep(0)
+    # Let the transports drain to the clients
+    while any(client.transport.get_write_buffer_size() and not client.paused
+              for client in server._clients):
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    server.stop()
+    received = await loop.run_in_executor(None, results.get)
+    child.join()
+
+    fanout = bus.latency.get_stats().get('total.' + server._sub.name, {})
+    print('{} clients ({} stalled), {} fixes of {}: {:.3f}s wall, {:.3f}s CPU, {:.1f}us CPU per fix per client'.format(
+        args.clients, args.stalled, args.fixes, args.protocol, elapsed, cpu,
+        cpu / args.fixes / args.clients * 1e6))
+    print('Reading clients received {} to {} fixes each'.format(min(received), max(received)))
+    print('Stalled clients: {} sends dropped, {} disconnected'.format(server.nr_dropped,
+        server.nr_disconnected))
+    if fanout:
+        print('Publish to written to all clients: p50 {:.1f}us p99 {:.1f}us'.format(
+            fanout['p50Secs'] * 1e6, fanout['p99Secs'] * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=28947)
+    parser.add_argument('--protocol', default='nmea', choices=['nmea', 'gpsd'])
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--stalled', type=int, default=4, help='clients that never read')
+    parser.add_argument('--fixes', type=int, default=2000)
+    parser.add_argument('--buffer', type=int, default=16384, help='per-client buffer limit in bytes')
+    parser.add_argument('--disconnect', action='store_true', help='disconnect slow clients')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+if __name__ == '__main__':
+    main()
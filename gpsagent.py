@@ -5,25 +5,307 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
 import argparse
+import collections
+import json
 import logging
 import asyncio
+import os
+import signal
 
 import trueposition
+from trueposition.bus import DISCONNECT, DROP_NEWEST
+from trueposition.nmea_writer import NMEA_SENTENCES
+from trueposition.sat_writer import SAT_COMPRESSION, SAT_FORMATS
+
+# Options that create an output, or a file only one device can use. Those given on the
+# command line belong to the first device; any others need to list their own in the
+# devices file.
+OUTPUT_OPTIONS = ['nmea', 'satfile', 'shm_unit', 'chrony_sock', 'capture', 'nmea_tcp', 'gpsd_tcp',
+                  'checkpoint', 'telemetry', 'snapshot']
+
+def nmea_intervals(text):
+    """
+    Parse a list of NMEA sentences to write, each optionally with the seconds between
+    them, e.g. RMC,GGA,GSV=5.
+    """
+    intervals = {}
+    for item in text.split(','):
+        name, _, interval = item.strip().upper().partition('=')
+        if name not in NMEA_SENTENCES:
+            raise argparse.ArgumentTypeError('unknown NMEA sentence {} (choose from {})'.format(name,
+                ', '.join(NMEA_SENTENCES)))
+        try:
+            intervals[name] = float(interval) if interval else 1
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad interval for {}: {}'.format(name, interval))
+    return intervals
+
+def _list_option(value):
+    return [value] if isinstance(value, str) else list(value)
+
+def _nmea_sentences_option(value):
+    if isinstance(value, dict):
+        value = ','.join('{}={}'.format(name, interval) for name, interval in value.items())
+    if not isinstance(value, str):
+        raise TypeError('expected a list of sentences, e.g. "RMC,GSV=5"')
+    return nmea_intervals(value)
+
+# Converters for device file options that the command line parses into something other
+# than what JSON gives, so each device's options look as they would from argparse
+DEVICE_CONVERTERS = {'nmea': _list_option,
+                     'nmea_sentences': _nmea_sentences_option,}
+
+def _inherited_option(value):
+    # -u and -b may be repeated, so come as lists; a device can only inherit one value
+    if not isinstance(value, list):
+        return value
+    if len(value) != 1:
+        return None
+    return value[0].rpartition('=')[2] if isinstance(value[0], str) else value[0]
+
+def device_options(args):
+    """
+    Work out the devices to manage, from -u/-b or the devices file. Returns a list of
+    namespaces, one per device, holding the command line options with any set for the
+    device in the devices file applied over them.
+    """
+    defaults = vars(args)
+    entries = []
+
+    if args.devices:
+        with open(args.devices) as f:
+            entries = json.load(f).get('devices', [])
+        if not entries:
+            raise ValueError('{} does not list any devices'.format(args.devices))
+    elif args.replay:
+        entries = [{'name': 'replay'}]
+    else:
+        uarts = args.uart or []
+        bauds = args.baud or []
+        if not uarts or not bauds:
+            raise ValueError('a UART and baud rate (-u and -b) are required, unless replaying a capture')
+        if len(bauds) == 1:
+            bauds = bauds * len(uarts)
+        if len(bauds) != len(uarts):
+            raise ValueError('give either one baud rate, or one per UART')
+        for uart, baud in zip(uarts, bauds):
+            name, _, path = uart.rpartition('=')
+            entries.append({'name': name or os.path.basename(path), 'uart': path, 'baud': baud})
+
+    devices = []
+    names = set()
+    for idx, entry in enumerate(entries):
+        unknown = set(entry) - set(defaults) - {'name'}
+        if unknown:
+            raise ValueError('Unknown device options: {}'.format(', '.join(sorted(unknown))))
+        opts = dict(defaults)
+        opts['uart'] = _inherited_option(opts['uart'])
+        opts['baud'] = _inherited_option(opts['baud'])
+        if idx:
+            opts.update({key: None for key in OUTPUT_OPTIONS})
+        for key, value in entry.items():
+            conv = DEVICE_CONVERTERS.get(key)
+            if conv and value is not None:
+                try:
+                    value = conv(value)
+                except (argparse.ArgumentTypeError, TypeError) as e:
+                    raise ValueError('Bad {} for device {}: {}'.format(key,
+                        entry.get('name', idx), e))
+            opts[key] = value
+        opts.setdefault('name', os.path.basename(opts.get('uart') or 'device{}'.format(idx)))
+        if opts['name'] in names:
+            raise ValueError('Device name {} is used more than once'.format(opts['name']))
+        if not opts.get('replay') and not (opts.get('uart') and opts.get('baud')):
+            raise ValueError('Device {} needs a UART and baud rate'.format(opts['name']))
+        names.add(opts['name'])
+        devices.append(argparse.Namespace(**opts))
+    return devices
+
+def create_outputs(opts, loop):
+    """
+    Create an output object for each output destination of a device. In the direct
+    pipeline, every output that never blocks is handed fixes in the handler's call
+    stack; the ephemeris log, which writes files, keeps its queue.
+    """
+    direct = opts.pipeline == 'direct'
+    outputs = []
+    if opts.nmea:
+        logging.info('[{}] Writing NMEA sentences out to {}'.format(opts.name, ', '.join(opts.nmea)))
+        outputs.append(trueposition.TruePositionNMEAWriter(opts.nmea, loop=loop,
+            intervals=opts.nmea_sentences, direct=direct))
+
+    # Check if the user asked to log satellite ephemeris data
+    if opts.satfile:
+        logging.info('[{}] Dumping satellite ephemeris to file {}'.format(opts.name, opts.satfile))
+        outputs.append(trueposition.TruePositionSatWriter(opts.satfile, loop=loop,
+            fmt=opts.sat_format, compression=opts.sat_compress, batch_size=opts.sat_batch,
+            flush_interval_sec=opts.sat_flush_sec, rotate_bytes=int(opts.sat_rotate_mb * 1024 * 1024),
+            rotate_interval_sec=opts.sat_rotate_hours * 3600))
+
+    if opts.shm_unit:
+        logging.info('[{}] Time will be populated in shm unit {}'.format(opts.name, opts.shm_unit))
+        outputs.append(trueposition.TruePositionSHMWriter(loop=loop, unit=opts.shm_unit,
+            direct=opts.shm_direct or direct, fudge_sec=opts.shm_fudge_ms / 1000.0,
+            precision=opts.shm_precision))
+
+    if opts.chrony_sock:
+        logging.info('[{}] Time will be sent to the chrony socket {}'.format(opts.name, opts.chrony_sock))
+        outputs.append(trueposition.TruePositionSockWriter(opts.chrony_sock, loop=loop,
+            fudge_sec=opts.chrony_fudge_ms / 1000.0, max_holdover_sec=opts.chrony_max_holdover_sec))
+
+    for protocol, port in [('nmea', opts.nmea_tcp), ('gpsd', opts.gpsd_tcp)]:
+        if port:
+            logging.info('[{}] Serving {} on TCP port {}'.format(opts.name, protocol, port))
+            outputs.append(trueposition.TruePositionTCPServer(port, loop=loop, host=opts.tcp_host,
+                protocol=protocol, device=opts.name, max_clients=opts.tcp_max_clients,
+                slow_policy=DISCONNECT if opts.tcp_disconnect_slow else DROP_NEWEST, direct=direct))
+
+    return outputs
+
+async def create_device(opts, loop, readiness=None, loop_monitor=None):
+    """
+    Set up the serial protocol, outputs and state manager for one GPSDO.
+    """
+    if opts.replay:
+        logging.info('[{}] Replaying {} at {}x'.format(opts.name, opts.replay, opts.replay_speed))
+        proto = trueposition.TruePositionUART.CreateReplay(loop=loop, capture=opts.replay,
+                speed=opts.replay_speed)
+    else:
+        logging.info('[{}] Opening uart={}, baud rate={}'.format(opts.name, opts.uart, opts.baud))
+        proto = await trueposition.TruePositionUART.Open(loop=loop, uart=opts.uart, baudrate=opts.baud)
+
+    if opts.capture:
+        logging.info('[{}] Recording the serial stream to {}'.format(opts.name, opts.capture))
+        proto.set_capture(trueposition.TruePositionCaptureWriter(opts.capture))
+
+    outputs = create_outputs(opts, loop)
+    if readiness:
+        # Last, so it knows whether the device has any time outputs to wait on
+        outputs.append(readiness)
+
+    # Create the TruePosition state manager, which subscribes each output to the messages
+    # it wants
+    checkpoint = None
+    if opts.checkpoint:
+        logging.info('[{}] Checkpointing state to {}'.format(opts.name, opts.checkpoint))
+        checkpoint = trueposition.TruePositionCheckpoint(opts.checkpoint,
+                interval_sec=opts.checkpoint_sec)
+
+    telemetry = None
+    if opts.telemetry:
+        logging.info('[{}] Recording {} days of telemetry to {}'.format(opts.name, opts.telemetry_days,
+            opts.telemetry))
+        telemetry = trueposition.TruePositionTelemetry(opts.telemetry,
+                capacity=int(opts.telemetry_days * 86400))
+
+    snapshot = None
+    if opts.snapshot:
+        logging.info('[{}] Publishing state snapshots to {}'.format(opts.name, opts.snapshot))
+        snapshot = trueposition.TruePositionSnapshotWriter(opts.snapshot)
+
+    st = trueposition.TruePositionState(proto, outputs, latency_log_interval_sec=opts.latency_log_sec,
+            checkpoint=checkpoint, telemetry=telemetry, snapshot=snapshot, loop_monitor=loop_monitor,
+            direct=opts.pipeline == 'direct')
+    # Queue whatever arrives from here on, rather than losing it while the other devices
+    # and the HTTP server are being set up
+    proto.set_trueposition_state(st)
+    return proto, st, outputs
 
 def main():
     parser = argparse.ArgumentParser(description='TruePosition GPSDO Management and NMEA Agent')
     parser.add_argument('-v', '--verbose', help='verbose output', action='store_true')
-    parser.add_argument('-u', '--uart', help='specify the UART to use', required=True)
-    parser.add_argument('-b', '--baud', type=int, help='specify the baud rate to use', required=True)
+    parser.add_argument('-u', '--uart', help='UART to use, optionally named as name=path (may be repeated '
+            'for several GPSDOs)', required=False, action='append')
+    parser.add_argument('-b', '--baud', type=int, help='baud rate to use (give one, or one per UART)',
+            required=False, action='append')
+    parser.add_argument('-D', '--devices', help='JSON file listing the GPSDOs to manage', required=False)
+    parser.add_argument('--capture', help='record the raw serial stream to this file', required=False)
+    parser.add_argument('--replay', help='replay a serial capture instead of using a UART', required=False)
+    parser.add_argument('--replay-speed', type=float, help='replay at this multiple of real time '
+            '(0 for as fast as possible)', required=False, default=1.0)
     parser.add_argument('-P', '--port', type=int,
-            help='specify the TCP port for the HTTP server to listen on', required=False, default=24601)
+            help='specify the TCP port for the HTTP server to listen on (0 to disable)', required=False,
+            default=24601)
     parser.add_argument('-s', '--satfile', help='specify output file to dump satellite ephemeris to',
             required=False)
+    parser.add_argument('--sat-format', help='format of the ephemeris log', required=False,
+            default='jsonl', choices=SAT_FORMATS)
+    parser.add_argument('--sat-compress', help='compress the ephemeris log as it is written',
+            required=False, default='none', choices=sorted(SAT_COMPRESSION))
+    parser.add_argument('--sat-flush-sec', type=float, help='seconds between ephemeris log writes',
+            required=False, default=30.0)
+    parser.add_argument('--sat-batch', type=int, help='write the ephemeris log once this many records are pending',
+            required=False, default=256)
+    parser.add_argument('--sat-rotate-mb', type=float, help='rotate the ephemeris log after this many MB',
+            required=False, default=0)
+    parser.add_argument('--sat-rotate-hours', type=float, help='rotate the ephemeris log after this many hours',
+            required=False, default=0)
     parser.add_argument('-S', '--shm-unit', help='update specified shared memory unit for ntpd', required=False,
             default=0, type=int)
-    parser.add_argument('-n', '--nmea', help='Output file to write NMEA sentences to', required=False)
+    parser.add_argument('--shm-direct', help='update shared memory straight from the CLOCK handler, '
+            'stamped with the UART receive time', required=False, action='store_true')
+    parser.add_argument('--shm-fudge-ms', type=float, help='subtract this from the shared memory '
+            'receive timestamp (direct mode only)', required=False, default=0)
+    parser.add_argument('--shm-precision', type=int, help='log2 seconds precision to advertise '
+            'while locked', required=False, default=-10)
+    parser.add_argument('-C', '--chrony-sock', help='send samples to the chrony SOCK refclock at this path',
+            required=False)
+    parser.add_argument('--chrony-fudge-ms', type=float, help='subtract this from the chrony sample '
+            'receive timestamp', required=False, default=0)
+    parser.add_argument('--chrony-max-holdover-sec', type=int, help='stop sending chrony samples once '
+            'the GPSDO has been in holdover this long', required=False, default=0)
+    parser.add_argument('-n', '--nmea', help='Output file or FIFO to write NMEA sentences to (may be repeated)',
+            required=False, action='append')
+    parser.add_argument('--nmea-sentences', type=nmea_intervals, default='RMC',
+            help='NMEA sentences to write to -n outputs, each optionally with the seconds between '
+            'them (e.g. RMC,GGA,GSA=5,GSV=5,ZDA=60; default RMC)', required=False)
+    parser.add_argument('--nmea-tcp', type=int, help='serve NMEA sentences over TCP on this port',
+            required=False)
+    parser.add_argument('--gpsd-tcp', type=int, help='speak the gpsd JSON protocol over TCP on this port',
+            required=False)
+    parser.add_argument('--tcp-host', help='address for the TCP servers to listen on', required=False,
+            default='localhost')
+    parser.add_argument('--tcp-max-clients', type=int, help='most clients each TCP server will take',
+            required=False, default=256)
+    parser.add_argument('--tcp-disconnect-slow', help='disconnect TCP clients that fall behind, '
+            'rather than skipping sentences for them', required=False, action='store_true')
+    parser.add_argument('--ready-file', help='create this file once the first sample with a good fix '
+            'has been written to ntpd or chrony (systemd is also notified, if it is listening)',
+            required=False)
+    parser.add_argument('--checkpoint', help='keep the position, leap seconds, firmware and '
+            'satellites in this file, to warm start from after a restart', required=False)
+    parser.add_argument('--checkpoint-sec', type=float, help='seconds between checkpoints',
+            required=False, default=60.0)
+    parser.add_argument('--telemetry', help='record a sample of the GPSDO health every second to '
+            'this file, for GET /telemetry', required=False)
+    parser.add_argument('--telemetry-days', type=float, help='days of telemetry to keep (the file is '
+            'sized for this up front, at 24 bytes a second)', required=False, default=90)
+    parser.add_argument('--snapshot', help='publish a binary snapshot of the state to this file '
+            '(e.g. under /dev/shm) for local readers', required=False)
+    parser.add_argument('--latency-log-sec', type=float,
+            help='log a latency summary every this many seconds (0 to disable)', required=False, default=300)
+    parser.add_argument('--pipeline', help='queue each sentence for the state manager and each fix '
+            'for the outputs, or handle them in the call stack of the UART read (direct)',
+            required=False, default='queued', choices=['queued', 'direct'])
+    parser.add_argument('--loop', help='event loop implementation to run on', required=False,
+            default='asyncio', choices=['asyncio', 'uvloop'])
+    parser.add_argument('--loop-tick-ms', type=float, help='milliseconds between checks of the '
+            'event loop lag', required=False, default=20)
+    parser.add_argument('--loop-lag-ms', type=float, help='hold back time samples that arrive while '
+            'the event loop lags by more than this (0 to not monitor the loop)', required=False,
+            default=50)
     args = parser.parse_args()
+    try:
+        devices = device_options(args)
+    except ValueError as e:
+        parser.error(str(e))
 
+    if args.loop == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            parser.error('--loop uvloop needs uvloop to be installed')
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     loop = asyncio.get_event_loop()
 
     # Set verbosity, globally.
@@ -35,43 +317,57 @@ def main():
     logging.basicConfig(format='%(asctime)s - %(name)s:%(levelname)s:%(message)s',
             datefmt='%m/%d/%Y %H:%M:%S', level=log_level)
 
-    logging.info('Starting GPS Agent (uart={}, baud rate={})'.format(args.uart, args.baud))
-
-    # Set up the asyncio serial protocol
-    proto = trueposition.TruePositionUART.Create(loop=loop, uart=args.uart, baudrate=args.baud)
+    logging.info('Starting GPS Agent ({}) on the {} event loop'.format(
+        ', '.join(opts.name for opts in devices), args.loop))
 
-    # For each output destination, create an output object
-    outputs = []
-    if args.nmea:
-        logging.info('Writing NMEA sentences out to {}'.format(args.nmea))
-        outputs = outputs.append(trueposition.TruePositionNMEAWriter(args.nmea))
-
-    # Create the TruePosition state manager
-    st = trueposition.TruePositionState(proto, outputs)
+    # One loop serves every device, so they share its monitor
+    loop_monitor = None
+    if args.loop_lag_ms:
+        loop_monitor = trueposition.TruePositionLoopMonitor(tick_sec=args.loop_tick_ms / 1000.0,
+                threshold_sec=args.loop_lag_ms / 1000.0, log_interval_sec=args.latency_log_sec)
 
-    # Start the HTTP server
-    logging.info('Starting HTTP Command and Control server on port {}'.format(args.port))
-    tphttp = trueposition.TruePositionHTTPApi(st, port=args.port, loop=loop)
-    tphttp.start(loop=loop)
+    readiness = None
+    if args.ready_file or os.environ.get('NOTIFY_SOCKET'):
+        readiness = trueposition.TruePositionReadiness(args.ready_file)
 
-    # Check if the user asked to log satellite ephemeris data
-    if args.satfile:
-        logging.info('Dumping satellite ephemeris to file {}'.format(args.satfile))
-        outputs.append(trueposition.TruePositionSatWriter(args.satfile, loop=loop))
+    # Set up a serial protocol, a state manager and a set of outputs for each GPSDO, opening
+    # all of the UARTs at once
+    protos = loop.run_until_complete(asyncio.gather(*[create_device(opts, loop, readiness,
+        loop_monitor) for opts in devices]))
+    states = collections.OrderedDict((opts.name, st) for opts, (_, st, _) in zip(devices, protos))
 
-    if args.shm_unit:
-        logging.info('Time will be populated in shm unit {}'.format(args.shm_unit))
-        outputs.append(trueposition.TruePositionSHMWriter(loop=loop, unit=args.shm_unit))
+    # Start the HTTP server, shared by all of the devices
+    if args.port:
+        logging.info('Starting HTTP Command and Control server on port {}'.format(args.port))
+        tphttp = trueposition.TruePositionHTTPApi(states, port=args.port, loop=loop,
+                loop_monitor=loop_monitor)
+        tphttp.start(loop=loop)
 
     # Start this mess
-    for output in outputs:
-        output.start(loop=loop)
-    proto.start(st, loop=loop)
-    st.start(loop=loop)
+    if loop_monitor:
+        loop_monitor.start(loop=loop)
+    for proto, st, outputs in protos:
+        for output in outputs:
+            output.start(loop=loop)
+        proto.start(st, loop=loop)
+        st.start(loop=loop)
+
+    # Stop the loop on SIGTERM (e.g. from systemd) or ^C, so that the outputs get to
+    # write out what they have buffered below
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
 
     logging.debug('Starting the event loop')
     loop.run_forever()
     logging.debug('We are out of here')
+    for proto, st, outputs in protos:
+        # Includes readiness, which every device shares
+        for output in outputs:
+            output.stop()
+        proto.stop()
+        st.stop()
+    if loop_monitor:
+        loop_monitor.stop()
     loop.close()
 
 if __name__ == '__main__':
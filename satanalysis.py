@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Analyse ephemeris logs written by gpsagent.py -s (JSONL or binary, plain, gzip or zstd,
+rotated or not). Builds a sky mask of SNR by azimuth and elevation, the visibility
+windows of each PRN, and the number of satellites tracked over time.
+
+Logs are read in chunks and split into shards that are analysed in parallel by a pool
+of worker processes, so memory use stays bounded however large the logs are.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+try:
+    from trueposition.ephemeris import EphemerisStats, analyze_shard, plan_shards
+except ImportError as e:
+    # numpy is optional for the agent, but the analysis is built on it
+    if e.name != 'numpy':
+        raise
+    sys.exit('satanalysis.py needs numpy to analyse ephemeris logs (pip install numpy)')
+
+def _iso_time(when):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(when))
+
+def analyze(paths, jobs, shard_bytes, options):
+    """
+    Analyse the logs with a pool of jobs worker processes, merging each shard's stats as
+    it completes.
+    """
+    shards = plan_shards(paths, shard_bytes)
+    logging.info('Analysing {} files as {} shards with {} workers'.format(len(paths), len(shards), jobs))
+    stats = EphemerisStats(**options)
+    if jobs == 1:
+        for shard in shards:
+            stats.merge(analyze_shard(shard, **options))
+        return stats
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(analyze_shard, shard, **options) for shard in shards]
+        for future in concurrent.futures.as_completed(futures):
+            stats.merge(future.result())
+    return stats
+
+def print_summary(stats, nr_windows):
+    if not stats.nr_records:
+        print('No records')
+        return
+
+    print('{} records ({} damaged) from {} to {}'.format(stats.nr_records, stats.nr_bad,
+        _iso_time(stats.first), _iso_time(stats.last)))
+
+    times, counts = stats.tracked_counts()
+    print('\nSatellites tracked per {}s: min {}, mean {:.1f}, max {}'.format(stats.count_bin_sec,
+        counts.min(), counts.mean(), counts.max()))
+
+    print('\n{:>4} {:>8} {:>10}  {}'.format('PRN', 'windows', 'hours', 'last windows'))
+    for prn, windows in stats.windows().items():
+        hours = sum(end - begin for begin, end in windows) / 3600
+        recent = ', '.join('{}+{:.0f}m'.format(_iso_time(begin), (end - begin) / 60)
+                           for begin, end in windows[-nr_windows:])
+        print('{:4} {:8} {:10.1f}  {}'.format(prn, len(windows), hours, recent))
+
+    # Rows from the zenith down, columns clockwise from north; '..' where nothing was seen
+    print('\nMean SNR by elevation (rows, degrees) and azimuth (columns, degrees)')
+    mean = stats.snr_mean()
+    print('    ' + ''.join('{:>3}'.format(col * stats.az_bin_deg) if col % 3 == 0 else '   '
+                           for col in range(mean.shape[1])))
+    for row in reversed(range(mean.shape[0])):
+        print('{:>3} '.format(row * stats.el_bin_deg) + ''.join(
+            ' ..' if math.isnan(snr) else '{:3.0f}'.format(snr) for snr in mean[row]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='ephemeris logs to analyse')
+    parser.add_argument('-v', '--verbose', help='verbose output', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+            help='worker processes to use')
+    parser.add_argument('--shard-mb', type=float, default=64,
+            help='split uncompressed logs into shards of this many MB')
+    parser.add_argument('--az-bin', type=int, default=10, help='azimuth bin, in degrees')
+    parser.add_argument('--el-bin', type=int, default=5, help='elevation bin, in degrees')
+    parser.add_argument('--count-bin-sec', type=int, default=60,
+            help='seconds of time to count tracked satellites over')
+    parser.add_argument('--gap-sec', type=float, default=300,
+            help='a PRN unheard for longer than this ends its visibility window')
+    parser.add_argument('--windows', type=int, default=3,
+            help='visibility windows to list for each PRN')
+    parser.add_argument('--json', help='write all of the aggregates to this file as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s:%(levelname)s:%(message)s',
+            datefmt='%m/%d/%Y %H:%M:%S', level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    options = {'az_bin_deg': args.az_bin, 'el_bin_deg': args.el_bin,
+               'count_bin_sec': args.count_bin_sec, 'gap_sec': args.gap_sec}
+    start = time.perf_counter()
+    stats = analyze(args.logs, max(1, args.jobs), int(args.shard_mb * 1024 * 1024), options)
+    elapsed = time.perf_counter() - start
+    logging.info('Analysed {} records in {:.2f}s'.format(stats.nr_records, elapsed))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats.to_dict(), f)
+    print_summary(stats, args.windows)
+
+if __name__ == '__main__':
+    main()
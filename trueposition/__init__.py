@@ -2,10 +2,37 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
-from .state import TruePositionState
-from .uart import TruePositionUART
-from .http import TruePositionHTTPApi
-from .sat_writer import TruePositionSatWriter
-from .nmea_writer import TruePositionNMEAWriter
-from .shm_writer import TruePositionSHMWriter
+import importlib
 
+# The public classes, and the module each lives in. A module is only imported the
+# first time one of its classes is used, so subsystems that are not enabled (and
+# their dependencies: aiohttp, ntpdshm, pyserial) cost nothing at startup.
+_EXPORTS = {
+    'TruePositionState': 'state',
+    'TruePositionUART': 'uart',
+    'TruePositionCaptureWriter': 'capture',
+    'TruePositionCheckpoint': 'checkpoint',
+    'TruePositionHTTPApi': 'http',
+    'TruePositionLoopMonitor': 'loop_monitor',
+    'TruePositionSatWriter': 'sat_writer',
+    'TruePositionNMEAWriter': 'nmea_writer',
+    'TruePositionSHMWriter': 'shm_writer',
+    'TruePositionSockWriter': 'sock_writer',
+    'TruePositionSnapshotWriter': 'snapshot',
+    'TruePositionTCPServer': 'tcp_server',
+    'TruePositionTelemetry': 'telemetry',
+    'TruePositionReadiness': 'readiness',
+}
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,233 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import collections
+import logging
+
+from .latency import LatencyRecorder
+
+# Overflow policies for a subscription whose buffer is full
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+OVERFLOW_POLICIES = [DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT]
+
+class SubscriptionOverflowError(Exception):
+    """
+    Raised to a subscriber with the disconnect policy once it has fallen too far behind.
+    """
+    pass
+
+def _type_key(msg):
+    return msg.get('type')
+
+class TruePositionSubscription(object):
+    """
+    A subscriber's view of the bus: a bounded ring of pending messages, and the
+    counters describing how well the subscriber is keeping up.
+
+    With the coalesce policy, a message replaces any pending message with the same
+    key (by default, the message type), so a slow subscriber only ever sees the
+    latest of each. With the disconnect policy, overflowing the buffer ends the
+    subscription: the next get() raises SubscriptionOverflowError.
+
+    A subscription with a callback has no buffer at all: the callback is called with
+    each message from within publish(), before publish() returns. This is for the few
+    outputs whose work is cheap and must not wait behind the event loop.
+    """
+    def __init__(self, name, types, maxlen, policy, key=None, transient=False, callback=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(policy))
+        if maxlen < 1:
+            raise ValueError('Subscription buffer must hold at least one message')
+
+        self.name = name
+        self.types = types
+        # Transient subscribers (e.g. HTTP stream clients) come and go, and are left out
+        # of per-subscriber metrics
+        self.transient = transient
+        self._callback = callback
+        self._maxlen = maxlen
+        self._policy = policy
+        self._key = key or _type_key
+        self._ring = collections.deque()
+        self._pending = {}
+        self._waiter = None
+        self.nr_published = 0
+        self.nr_delivered = 0
+        self.nr_dropped = 0
+        self.nr_coalesced = 0
+        self.max_depth = 0
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._ring)
+
+    def _offer(self, msg):
+        self.nr_published += 1
+        if self._callback is not None:
+            try:
+                self._callback(msg)
+                self.nr_delivered += 1
+            except Exception:
+                logging.exception('Direct subscriber {} failed to handle {}'.format(self.name, msg))
+                self.nr_dropped += 1
+            return
+
+        ring = self._ring
+
+        if self._policy == COALESCE:
+            key = self._key(msg)
+            if key in self._pending:
+                self._pending[key] = msg
+                self.nr_coalesced += 1
+                return
+            if len(ring) >= self._maxlen:
+                del self._pending[ring.popleft()]
+                self.nr_dropped += 1
+            self._pending[key] = msg
+            ring.append(key)
+        else:
+            if len(ring) >= self._maxlen:
+                self.nr_dropped += 1
+                if self._policy == DISCONNECT:
+                    self.overflowed = True
+                    self._wake()
+                    return
+                if self._policy == DROP_NEWEST:
+                    return
+                ring.popleft()
+            ring.append(msg)
+
+        if len(ring) > self.max_depth:
+            self.max_depth = len(ring)
+
+        self._wake()
+
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def get_nowait(self):
+        """
+        Return the oldest pending message. Raises IndexError if there is none.
+        """
+        if self.overflowed:
+            raise SubscriptionOverflowError(self.name)
+        item = self._ring.popleft()
+        if self._policy == COALESCE:
+            item = self._pending.pop(item)
+        self.nr_delivered += 1
+        return item
+
+    async def get(self):
+        """
+        Wait for, and return, the oldest pending message.
+        """
+        while not self._ring and not self.overflowed:
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+    def encode_stats(self):
+        return {'types': sorted(self.types) if self.types else None,
+                'policy': 'direct' if self._callback is not None else self._policy,
+                'maxlen': self._maxlen,
+                'depth': len(self._ring),
+                'maxDepth': self.max_depth,
+                'published': self.nr_published,
+                'delivered': self.nr_delivered,
+                'dropped': self.nr_dropped,
+                'coalesced': self.nr_coalesced,}
+
+class TruePositionBus(object):
+    """
+    Fan-out of state manager messages to the outputs. Publishing never blocks: each
+    subscriber has its own bounded buffer and overflow policy, so a stalled output
+    only ever loses its own messages. Subscribers name the message types they want,
+    and are not handed anything else.
+
+    The bus also carries the latency recorder shared by everything along the path from
+    the UART to the outputs, and the event loop monitor, if there is one. Outputs that
+    hand time on (ntpd's SHM segment, chrony's socket) add their name to time_outputs,
+    and call sample_written() once a sample has actually gone out, for anything
+    watching with add_written_hook(). Outputs that need the satellites being tracked on
+    each gps message set wants_tracked_sats; otherwise they are left off.
+    """
+    def __init__(self, latency=None, loop_monitor=None):
+        self.latency = latency or LatencyRecorder()
+        self.loop_monitor = loop_monitor
+        self.time_outputs = set()
+        self.wants_tracked_sats = False
+        self._written_hooks = ()
+        self._subs = []
+        self._by_type = {}
+        self._wildcard = []
+
+    def subscribe(self, name, types=None, maxlen=64, policy=DROP_OLDEST, key=None, transient=False,
+            callback=None):
+        """
+        Create a subscription. If types is None, the subscriber receives every message.
+        If callback is given, it is called synchronously with each message instead of the
+        message being buffered.
+        """
+        sub = TruePositionSubscription(name, frozenset(types) if types else None, maxlen,
+                policy, key=key, transient=transient, callback=callback)
+        self._subs.append(sub)
+        self._reindex()
+        logging.debug('Bus subscriber {} (types={}, maxlen={}, policy={})'.format(name,
+            types, maxlen, policy))
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub in self._subs:
+            self._subs.remove(sub)
+            self._reindex()
+
+    def _reindex(self):
+        by_type = {}
+        wildcard = []
+        for sub in self._subs:
+            if sub.types is None:
+                wildcard.append(sub)
+                continue
+            for msg_type in sub.types:
+                by_type.setdefault(msg_type, []).append(sub)
+        for msg_type in by_type:
+            by_type[msg_type].extend(wildcard)
+        self._by_type = by_type
+        self._wildcard = wildcard
+
+    def add_written_hook(self, hook):
+        """
+        Have hook(output, msg) called each time a time output writes out a sample.
+        """
+        self._written_hooks += (hook,)
+
+    def remove_written_hook(self, hook):
+        self._written_hooks = tuple(h for h in self._written_hooks if h is not hook)
+
+    def sample_written(self, output, msg):
+        for hook in self._written_hooks:
+            hook(output, msg)
+
+    def has_subscribers(self, msg_type):
+        return msg_type in self._by_type or bool(self._wildcard)
+
+    def publish(self, msg):
+        for sub in self._by_type.get(msg.get('type'), self._wildcard):
+            sub._offer(msg)
+
+    def subscriptions(self):
+        return list(self._subs)
+
+    def get_stats(self):
+        return {sub.name: sub.encode_stats() for sub in self._subs}
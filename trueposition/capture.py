@@ -0,0 +1,202 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import logging
+import os
+import random
+import struct
+import time
+import tty
+
+# A capture is this magic, followed by one record per chunk read from the UART: the
+# wall clock time the chunk arrived, its length, then the bytes themselves
+CAPTURE_MAGIC = b'TPCAP\x00\x01\x00'
+CAPTURE_RECORD = struct.Struct('<dI')
+
+class CaptureFormatError(Exception):
+    pass
+
+class TruePositionCaptureWriter(object):
+    """
+    Records the raw serial stream, exactly as it was read from the UART, with the
+    time each chunk arrived. Writes are buffered, and the file is flushed at most
+    every flush_interval_sec, so recording costs no more than a memory copy per chunk
+    most of the time.
+    """
+    def __init__(self, path, flush_interval_sec=5.0):
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._flush_interval_sec = flush_interval_sec
+        self._next_flush = time.monotonic() + flush_interval_sec
+        self.nr_chunks = 0
+        self.nr_bytes = 0
+
+    def write(self, data, when=None):
+        if when is None:
+            when = time.time()
+        self._file.write(CAPTURE_RECORD.pack(when, len(data)))
+        self._file.write(data)
+        self.nr_chunks += 1
+        self.nr_bytes += len(data)
+
+        now = time.monotonic()
+        if now >= self._next_flush:
+            self._file.flush()
+            self._next_flush = now + self._flush_interval_sec
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def read_capture(path):
+    """
+    Iterate over the (time, bytes) chunks in a capture.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise CaptureFormatError('{} is not a serial capture'.format(path))
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if not header:
+                return
+            if len(header) < CAPTURE_RECORD.size:
+                logging.warning('Capture {} ends with a truncated record'.format(path))
+                return
+            when, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logging.warning('Capture {} ends with a truncated record'.format(path))
+                return
+            yield when, data
+
+class FaultInjector(object):
+    """
+    Mangles replayed chunks the way a flaky serial line or a rebooting GPSDO would.
+    Each rate is the probability, per chunk, of that fault:
+
+     * garbage: a run of random bytes is inserted
+     * truncate: a line is cut short, losing the rest of it and its line ending
+     * boot: the GPSDO drops back into its bootloader and announces it
+     * sat_burst: a burst of sat_burst_len $SAT sentences is inserted
+     * stall: the event loop is blocked for stall_sec before the chunk is fed, as a
+       blocking write or a slow callback would
+
+    Faults are drawn from a seeded generator, so a run can be repeated exactly.
+    """
+    BOOT_BANNER = b'\r\r$GETVER BOOT\r\n'
+
+    def __init__(self, garbage=0.0, truncate=0.0, boot=0.0, sat_burst=0.0, sat_burst_len=64,
+            stall=0.0, stall_sec=0.2, seed=0):
+        self._garbage = garbage
+        self._truncate = truncate
+        self._boot = boot
+        self._sat_burst = sat_burst
+        self._sat_burst_len = sat_burst_len
+        self._stall = stall
+        self._stall_sec = stall_sec
+        self._random = random.Random(seed)
+        self.nr_faults = {'garbage': 0, 'truncate': 0, 'boot': 0, 'sat_burst': 0, 'stall': 0}
+
+    @property
+    def enabled(self):
+        return bool(self._garbage or self._truncate or self._boot or self._sat_burst or self._stall)
+
+    def _sat_sentences(self):
+        rand = self._random
+        return b''.join('$SAT {} {} {} {} {}\r\n'.format(rand.randrange(16), rand.randrange(1, 33),
+            rand.randrange(0, 90), rand.randrange(0, 360), rand.randrange(20, 50)).encode('ascii')
+            for _ in range(self._sat_burst_len))
+
+    def apply(self, data):
+        rand = self._random
+        if self._truncate and rand.random() < self._truncate:
+            end = data.find(b'\n')
+            if end > 0:
+                data = data[:rand.randrange(end)] + data[end + 1:]
+                self.nr_faults['truncate'] += 1
+        if self._garbage and rand.random() < self._garbage:
+            pos = rand.randrange(len(data) + 1)
+            data = data[:pos] + os.urandom(rand.randrange(1, 32)) + data[pos:]
+            self.nr_faults['garbage'] += 1
+        if self._boot and rand.random() < self._boot:
+            data = self.BOOT_BANNER + data
+            self.nr_faults['boot'] += 1
+        if self._sat_burst and rand.random() < self._sat_burst:
+            data = data + self._sat_sentences()
+            self.nr_faults['sat_burst'] += 1
+        if self._stall and rand.random() < self._stall:
+            time.sleep(self._stall_sec)
+            self.nr_faults['stall'] += 1
+        return data
+
+async def replay_capture(path, feed, speed=1.0, faults=None, loop=asyncio.get_event_loop()):
+    """
+    Feed the chunks of a capture to feed(), keeping the gaps between them divided by
+    speed. A speed of 0 replays as fast as the loop will go, yielding to it between
+    chunks. Returns the number of bytes fed.
+    """
+    nr_bytes = 0
+    start = None
+    replay_start = loop.time()
+    for when, data in read_capture(path):
+        if start is None:
+            start = when
+        if speed:
+            delay = replay_start + (when - start) / speed - loop.time()
+            await asyncio.sleep(max(0, delay))
+        else:
+            await asyncio.sleep(0)
+        if faults:
+            data = faults.apply(data)
+        feed(data)
+        nr_bytes += len(data)
+    return nr_bytes
+
+class ReplayTransport(asyncio.Transport):
+    """
+    In-process stand-in for the serial transport: replays a capture into a protocol
+    and swallows whatever the protocol writes back. Once the capture is exhausted, the
+    connection is reported lost, just as if the GPSDO had been unplugged.
+    """
+    def __init__(self, protocol, path, speed=1.0, faults=None, loop=asyncio.get_event_loop()):
+        super().__init__()
+        self._protocol = protocol
+        self._closing = False
+        self.nr_written = 0
+        protocol.connection_made(self)
+        self._task = asyncio.ensure_future(self._replay(path, speed, faults, loop), loop=loop)
+
+    async def _replay(self, path, speed, faults, loop):
+        nr_bytes = await replay_capture(path, self._protocol.data_received, speed=speed,
+                faults=faults, loop=loop)
+        logging.info('Replayed {} bytes from {}'.format(nr_bytes, path))
+        self.close()
+
+    def write(self, data):
+        self.nr_written += len(data)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._protocol.connection_lost(None)
+
+def open_replay_pty():
+    """
+    Open a pseudo-terminal for replaying into a separate agent process. Returns the
+    master and slave file descriptors, and the path of the slave, which the agent is
+    pointed at as its UART. Keep the slave descriptor open while replaying, so the
+    line is not hung up whenever the agent closes it.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    return master, slave, path
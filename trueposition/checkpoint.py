@@ -0,0 +1,94 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+# Bumped whenever the layout of the checkpoint changes; checkpoints written with any
+# other version are ignored
+CHECKPOINT_VERSION = 1
+
+class TruePositionCheckpoint(object):
+    """
+    Keeps what the state manager has learned from the GPSDO that holds from one run of
+    the agent to the next (position, leap seconds, firmware and the satellites being
+    tracked) in a small JSON file, so that it can be put back at startup rather than
+    waiting for the GPSDO to repeat it.
+
+    The file is rewritten every interval_sec, on a thread of its own so the fsync never
+    holds up the event loop, and when the agent stops. Each write goes to a temporary
+    file that is then renamed over the checkpoint, so a crash part way through leaves
+    the previous checkpoint intact.
+    """
+    def __init__(self, path, interval_sec=60):
+        self._path = path
+        self._interval_sec = interval_sec
+        self._state = None
+        self._running = False
+        self._loop = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.nr_saved = 0
+
+    def load(self):
+        """
+        Read the checkpoint back. Returns None if there is none, or it can't be used.
+        """
+        try:
+            with open(self._path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            logging.info('No checkpoint at {}, starting cold'.format(self._path))
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable checkpoint {}: {}'.format(self._path, e))
+            return None
+
+        if not isinstance(checkpoint, dict) or checkpoint.get('version') != CHECKPOINT_VERSION:
+            logging.warning('Ignoring checkpoint {}: not version {}'.format(self._path,
+                CHECKPOINT_VERSION))
+            return None
+        logging.info('Loaded checkpoint {}, saved {:.0f}s ago'.format(self._path,
+            time.time() - checkpoint.get('savedAt', 0)))
+        return checkpoint
+
+    def save(self, checkpoint):
+        checkpoint = dict(checkpoint, version=CHECKPOINT_VERSION, savedAt=time.time())
+        tmp_path = '{}.{}'.format(self._path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._path)
+        except OSError as e:
+            logging.warning('Could not write checkpoint {}: {}'.format(self._path, e))
+            return
+        self.nr_saved += 1
+
+    async def _writer(self):
+        while self._running:
+            await asyncio.sleep(self._interval_sec)
+            if self._running:
+                # Taken on the loop, so the state doesn't change under the thread
+                await self._loop.run_in_executor(self._executor, self.save,
+                        self._state.get_checkpoint())
+
+    def start(self, state, loop=asyncio.get_event_loop()):
+        self._state = state
+        self._loop = loop
+        self._running = True
+        asyncio.ensure_future(self._writer(), loop=loop)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        # Shutting down, so it is fine to block: let a save in progress finish first, as
+        # it writes the same temporary file
+        self._executor.shutdown(wait=True)
+        self.save(self._state.get_checkpoint())
@@ -0,0 +1,138 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import itertools
+import logging
+
+# Command priorities, lowest first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class CommandSpec(object):
+    """
+    How a command is scheduled: its priority, the tag of the sentence the GPSDO answers
+    it with (None if it does not answer), and how long to wait for that answer.
+    """
+    __slots__ = ['priority', 'response', 'timeout_sec']
+
+    def __init__(self, priority=PRIORITY_NORMAL, response=None, timeout_sec=1.0):
+        self.priority = priority
+        self.response = response
+        self.timeout_sec = timeout_sec
+
+# Commands we know how the GPSDO answers. Anything else is sent at normal priority,
+# followed by a second's pause, which is what every command used to get.
+COMMAND_SPECS = {
+    # The bootloader says nothing when told to proceed; give the firmware time to start
+    '$PROCEED': CommandSpec(PRIORITY_HIGH, None, 2.0),
+    '$GETVER': CommandSpec(PRIORITY_NORMAL, '$GETVER', 2.0),
+    '$GETPOS': CommandSpec(PRIORITY_LOW, '$GETPOS', 2.0),
+}
+DEFAULT_COMMAND_SPEC = CommandSpec()
+
+class TruePositionCommandScheduler(object):
+    """
+    Orders commands for the GPSDO. A command that is already pending (or waiting for
+    its response) is not queued again, just raised to the higher of the two priorities.
+    The next command goes out as soon as the response to the last one has been seen,
+    or once its timeout has passed, in which case it is retried up to max_retries
+    times.
+    """
+    def __init__(self, max_retries=2, specs=COMMAND_SPECS):
+        self._specs = specs
+        self._max_retries = max_retries
+        self._pending = {}
+        self._seq = itertools.count()
+        self._waiter = None
+        self._in_flight = None
+        self._response = None
+        self.nr_sent = 0
+        self.nr_coalesced = 0
+        self.nr_timeouts = 0
+        self.nr_failed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _spec(self, cmd):
+        return self._specs.get(cmd.split(' ', 1)[0], DEFAULT_COMMAND_SPEC)
+
+    def enqueue(self, cmd, priority=None):
+        if priority is None:
+            priority = self._spec(cmd).priority
+        if cmd == self._in_flight:
+            self.nr_coalesced += 1
+            return
+        if cmd in self._pending:
+            self.nr_coalesced += 1
+            if priority < self._pending[cmd][0]:
+                self._pending[cmd] = (priority, self._pending[cmd][1], self._pending[cmd][2])
+            return
+        self._pending[cmd] = (priority, next(self._seq), 0)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def next(self):
+        """
+        Wait for, and return, the highest priority command (oldest first among equals).
+        """
+        while not self._pending:
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        cmd = min(self._pending, key=self._pending.get)
+        return cmd
+
+    async def send(self, cmd, write):
+        """
+        Send cmd with write(), and wait for its response (or timeout). On a timeout, the
+        command is put back to be retried, unless it has run out of retries.
+        """
+        priority, seq, attempts = self._pending.pop(cmd)
+        spec = self._spec(cmd)
+        self._in_flight = cmd
+        self._response = asyncio.get_event_loop().create_future() if spec.response else None
+        write(cmd)
+        self.nr_sent += 1
+
+        try:
+            if self._response is None:
+                await asyncio.sleep(spec.timeout_sec)
+                return
+            await asyncio.wait_for(self._response, spec.timeout_sec)
+        except asyncio.TimeoutError:
+            self.nr_timeouts += 1
+            if attempts < self._max_retries:
+                logging.debug('No response to {}, retrying'.format(cmd))
+                if cmd not in self._pending:
+                    self._pending[cmd] = (priority, seq, attempts + 1)
+            else:
+                logging.info('No response to {} after {} attempts, giving up'.format(cmd, attempts + 1))
+                self.nr_failed += 1
+        finally:
+            self._in_flight = None
+            self._response = None
+
+    def sentence_received(self, sentence):
+        """
+        Called with every sentence from the GPSDO, to spot the response to the command
+        in flight.
+        """
+        response = self._response
+        if response is None or response.done():
+            return
+        if sentence.split(' ', 1)[0] == self._spec(self._in_flight).response:
+            response.set_result(sentence)
+
+    def get_stats(self):
+        return {'pending': sorted(self._pending, key=self._pending.get),
+                'sent': self.nr_sent,
+                'coalesced': self.nr_coalesced,
+                'timeouts': self.nr_timeouts,
+                'failed': self.nr_failed,}
@@ -0,0 +1,323 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Offline analysis of the ephemeris logs written by TruePositionSatWriter. Logs are read
+a chunk at a time, in either format and any compression, and reduced into
+EphemerisStats, whose size depends on the bin sizes and the time span covered, never on
+how many records were read.
+"""
+
+import gzip
+import json
+import math
+import os
+
+import numpy
+
+from .sat_writer import SAT_FILE_MAGIC, SAT_RECORD
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# numpy view of a binary ephemeris record, matching SAT_RECORD
+SAT_DTYPE = numpy.dtype([('lastSeen', '<f8'), ('slotId', 'u1'), ('satId', 'u1'), ('el', 'i1'),
+                         ('az', '<u2'), ('snr', 'u1')])
+assert SAT_DTYPE.itemsize == SAT_RECORD.size
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# PRNs fit in a byte, so (time bin, PRN) pairs pack into one integer
+_PRN_SPAN = 256
+
+def _open_decompressed(path):
+    """
+    Open a log for reading, decompressing it if it is compressed. Returns the file and
+    whether it can be seeked, i.e. split into shards.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, 'rb'), False
+    if magic == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError('{} is zstd compressed, and zstandard is not installed'.format(path))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), False
+    return open(path, 'rb'), True
+
+def plan_shards(paths, shard_bytes=64 * 1024 * 1024):
+    """
+    Split logs into (path, start, end) shards that can be read independently. Plain logs
+    are cut every shard_bytes (readers line the cuts up with the records); compressed
+    logs can only be read from the start, so each is a single shard.
+    """
+    shards = []
+    for path in paths:
+        f, seekable = _open_decompressed(path)
+        f.close()
+        size = os.path.getsize(path)
+        if not seekable or size <= shard_bytes:
+            shards.append((path, 0, None))
+            continue
+        for start in range(0, size, shard_bytes):
+            shards.append((path, start, min(start + shard_bytes, size)))
+    return shards
+
+def _read_binary(f, start, end, chunk_records):
+    # Cuts are made in file offsets, so round them to the records after the magic
+    header = len(SAT_FILE_MAGIC)
+    first = header + max(0, math.ceil((start - header) / SAT_RECORD.size)) * SAT_RECORD.size
+    if start:
+        f.seek(first)
+    pos = first
+    while end is None or pos < end:
+        nr_records = chunk_records
+        if end is not None:
+            nr_records = min(nr_records, math.ceil((end - pos) / SAT_RECORD.size))
+        data = f.read(nr_records * SAT_RECORD.size)
+        # A partly written last record is left out
+        data = data[:len(data) - len(data) % SAT_RECORD.size]
+        if not data:
+            break
+        pos += len(data)
+        records = numpy.frombuffer(data, dtype=SAT_DTYPE)
+        yield (records['lastSeen'], records['satId'], records['el'], records['az'],
+               records['snr'], 0)
+
+def _parse_jsonl(lines):
+    """
+    Parse a batch of JSONL records in one go, falling back to a line at a time if any of
+    them is damaged. Returns the records, and how many lines were skipped.
+    """
+    lines = [line.strip() for line in lines if line.strip()]
+    try:
+        return json.loads(b'[' + b','.join(lines) + b']'), 0
+    except ValueError:
+        pass
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records, len(lines) - len(records)
+
+_JSONL_COLUMNS = ('lastSeen', 'satId', 'el', 'az', 'snr')
+
+def _record_ok(record):
+    try:
+        return all(type(record[key]) in (int, float) for key in _JSONL_COLUMNS)
+    except (KeyError, TypeError):
+        return False
+
+def _jsonl_columns(records):
+    """
+    Build the numpy columns for a batch of parsed records, in one go unless a record is
+    missing a field or has one that is not a number, in which case each record is
+    checked and only the damaged ones are dropped. Returns the columns, and how many
+    records were dropped.
+    """
+    try:
+        columns = [numpy.array([record[key] for record in records]) for key in _JSONL_COLUMNS]
+        if all(column.dtype.kind in 'iuf' for column in columns):
+            return columns, 0
+    except (KeyError, TypeError):
+        pass
+    good = [record for record in records if _record_ok(record)]
+    columns = [numpy.array([record[key] for record in good], dtype=float) for key in _JSONL_COLUMNS]
+    return columns, len(records) - len(good)
+
+def _read_jsonl(f, start, end, chunk_bytes):
+    pos = start
+    if start:
+        # The line running over the cut belongs to the shard before
+        f.seek(start - 1)
+        pos += len(f.readline()) - 1
+    while end is None or pos < end:
+        lines = f.readlines(chunk_bytes)
+        if not lines:
+            break
+        batch = []
+        for line in lines:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            batch.append(line)
+        records, nr_bad = _parse_jsonl(batch)
+        columns, nr_dropped = _jsonl_columns(records)
+        yield tuple(columns) + (nr_bad + nr_dropped,)
+
+def read_ephemeris(path, start=0, end=None, chunk_records=65536):
+    """
+    Iterate over a log (or the shard of it from start to end) in chunks, each a tuple of
+    numpy columns: lastSeen, satId, el, az and snr, followed by the number of damaged
+    records skipped.
+    """
+    f, _ = _open_decompressed(path)
+    with f:
+        if f.read(len(SAT_FILE_MAGIC)) == SAT_FILE_MAGIC:
+            yield from _read_binary(f, start, end, chunk_records)
+            return
+
+    # Compressed streams can't be rewound, so start the JSONL over from the top
+    f, _ = _open_decompressed(path)
+    with f:
+        # JSONL records run to about 100 bytes each
+        yield from _read_jsonl(f, start, end, chunk_records * 100)
+
+class EphemerisStats(object):
+    """
+    Aggregates over ephemeris records:
+     * SNR by azimuth/elevation bin (a sky mask: bins with low SNR, or none at all, point
+       at obstructions around the antenna)
+     * visibility windows for each PRN (runs of records with a signal, no more than
+       gap_sec apart)
+     * how many distinct PRNs were tracked in each count_bin_sec of time
+
+    Stats built from separate chunks or shards are combined with merge().
+    """
+    def __init__(self, az_bin_deg=10, el_bin_deg=5, count_bin_sec=60, gap_sec=300):
+        self.az_bin_deg = az_bin_deg
+        self.el_bin_deg = el_bin_deg
+        self.count_bin_sec = count_bin_sec
+        self.gap_sec = gap_sec
+        shape = (90 // el_bin_deg + 1, math.ceil(360 / az_bin_deg))
+        self.snr_sum = numpy.zeros(shape)
+        self.snr_count = numpy.zeros(shape, dtype=numpy.int64)
+        self.snr_max = numpy.zeros(shape, dtype=numpy.uint8)
+        self.nr_records = 0
+        self.nr_bad = 0
+        self.first = math.inf
+        self.last = -math.inf
+        self._windows = {}
+        self._tracked = [numpy.array([], dtype=numpy.int64)]
+
+    def add(self, last_seen, sat_id, el, az, snr, nr_bad=0):
+        self.nr_bad += nr_bad
+        if not len(last_seen):
+            return
+        self.nr_records += len(last_seen)
+        self.first = min(self.first, float(last_seen.min()))
+        self.last = max(self.last, float(last_seen.max()))
+        sat_id = sat_id.astype(numpy.int64)
+        snr = numpy.clip(snr, 0, 255).astype(numpy.uint8)
+
+        above = el >= 0
+        rows = numpy.minimum(el[above].astype(numpy.int64), 90) // self.el_bin_deg
+        cols = (az[above].astype(numpy.int64) % 360) // self.az_bin_deg
+        cells = rows * self.snr_sum.shape[1] + cols
+        size = self.snr_sum.size
+        self.snr_sum += numpy.bincount(cells, weights=snr[above], minlength=size).reshape(
+                self.snr_sum.shape)
+        self.snr_count += numpy.bincount(cells, minlength=size).reshape(self.snr_count.shape)
+        numpy.maximum.at(self.snr_max.reshape(-1), cells, snr[above])
+
+        heard = snr > 0
+        self._add_windows(last_seen[heard], sat_id[heard])
+
+        keys = numpy.unique((last_seen // self.count_bin_sec).astype(numpy.int64) * _PRN_SPAN +
+                            sat_id)
+        self._add_tracked(keys)
+
+    def _add_windows(self, last_seen, sat_id):
+        if not len(last_seen):
+            return
+        order = numpy.lexsort((last_seen, sat_id))
+        last_seen = last_seen[order]
+        sat_id = sat_id[order]
+        # A window ends where the PRN changes, or the PRN goes unheard for too long
+        breaks = numpy.flatnonzero((numpy.diff(sat_id) != 0) |
+                                   (numpy.diff(last_seen) > self.gap_sec)) + 1
+        starts = numpy.concatenate(([0], breaks))
+        ends = numpy.append(breaks, len(last_seen)) - 1
+        for prn, begin, end in zip(sat_id[starts].tolist(), last_seen[starts].tolist(),
+                last_seen[ends].tolist()):
+            self._windows.setdefault(prn, []).append([begin, end])
+        for prn in set(sat_id[starts].tolist()):
+            self._windows[prn] = self._merge_windows(self._windows[prn])
+
+    def _merge_windows(self, windows):
+        windows.sort()
+        merged = [windows[0]]
+        for begin, end in windows[1:]:
+            if begin - merged[-1][1] <= self.gap_sec:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        return merged
+
+    def _add_tracked(self, keys):
+        self._tracked.append(keys)
+        # Fold the pending pairs together now and then, so duplicates don't pile up
+        if len(self._tracked) > 64:
+            self._tracked = [numpy.unique(numpy.concatenate(self._tracked))]
+
+    def merge(self, other):
+        self.snr_sum += other.snr_sum
+        self.snr_count += other.snr_count
+        numpy.maximum(self.snr_max, other.snr_max, out=self.snr_max)
+        self.nr_records += other.nr_records
+        self.nr_bad += other.nr_bad
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+        for prn, windows in other._windows.items():
+            self._windows[prn] = self._merge_windows(self._windows.get(prn, []) + windows)
+        for keys in other._tracked:
+            self._add_tracked(keys)
+
+    def snr_mean(self):
+        """
+        Mean SNR of each elevation (rows, from the horizon up) and azimuth (columns, from
+        north) bin, NaN where nothing was seen.
+        """
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(self.snr_count > 0, self.snr_sum / self.snr_count, numpy.nan)
+
+    def windows(self):
+        """
+        Visibility windows of each PRN, as lists of [first seen, last seen].
+        """
+        return {prn: [list(window) for window in windows]
+                for prn, windows in sorted(self._windows.items())}
+
+    def tracked_counts(self):
+        """
+        The start time of each count_bin_sec bin anything was seen in, and the number of
+        distinct PRNs seen in it.
+        """
+        keys = numpy.unique(numpy.concatenate(self._tracked))
+        bins, counts = numpy.unique(keys // _PRN_SPAN, return_counts=True)
+        return bins * self.count_bin_sec, counts
+
+    def to_dict(self):
+        mean = self.snr_mean()
+        times, counts = self.tracked_counts()
+        return {'nrRecords': self.nr_records,
+                'nrBadRecords': self.nr_bad,
+                'first': self.first if self.nr_records else None,
+                'last': self.last if self.nr_records else None,
+                'sky': {'azBinDeg': self.az_bin_deg,
+                        'elBinDeg': self.el_bin_deg,
+                        'count': self.snr_count.tolist(),
+                        'meanSnr': [[None if math.isnan(v) else round(v, 2) for v in row]
+                                    for row in mean.tolist()],
+                        'maxSnr': self.snr_max.tolist()},
+                'windows': {str(prn): windows for prn, windows in self.windows().items()},
+                'tracked': {'binSec': self.count_bin_sec,
+                            'time': times.tolist(),
+                            'count': counts.tolist()}}
+
+def analyze_shard(shard, **options):
+    """
+    Build the stats for one shard, as returned by plan_shards(). Runs in a worker
+    process, so only the (small) stats travel back.
+    """
+    path, start, end = shard
+    stats = EphemerisStats(**options)
+    for chunk in read_ephemeris(path, start, end):
+        stats.add(*chunk)
+    return stats
@@ -0,0 +1,74 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import logging
+import time
+
+class TruePositionFramer(object):
+    """
+    Splits the raw byte stream from the GPSDO into sentences.
+
+    Bytes are accumulated in a single bytearray and only the partial line at the end
+    of a chunk is carried over to the next call. Complete lines are located with
+    find() and decoded straight out of a memoryview, so there is no per-character
+    work in Python. Line noise (non-ASCII bytes, stray carriage returns from the
+    bootloader) is replaced or stripped rather than raising.
+
+    on_sentence is called with each sentence and the time.monotonic() at which the
+    chunk that completed it arrived.
+    """
+    def __init__(self, on_sentence, max_line_len=512):
+        self._on_sentence = on_sentence
+        self._max_line_len = max_line_len
+        self._buf = bytearray()
+        self.nr_bytes = 0
+        self.nr_sentences = 0
+        self.nr_overruns = 0
+
+    def _emit(self, view, start, end, rx_time):
+        line = str(view[start:end], 'ascii', 'replace')
+        if '\r' in line:
+            # The bootloader likes to scatter carriage returns about
+            line = line.replace('\r', '')
+        line = line.strip()
+        if line:
+            self.nr_sentences += 1
+            self._on_sentence(line, rx_time)
+
+    def feed(self, data):
+        """
+        Consume a chunk of bytes from the UART, calling on_sentence for each complete
+        line found.
+        """
+        rx_time = time.monotonic()
+        self.nr_bytes += len(data)
+
+        if self._buf:
+            self._buf += data
+            data = self._buf
+
+        view = memoryview(data)
+        try:
+            start = 0
+            end = data.find(b'\n')
+            while end >= 0:
+                self._emit(view, start, end, rx_time)
+                start = end + 1
+                end = data.find(b'\n', start)
+        finally:
+            view.release()
+
+        if data is self._buf:
+            del self._buf[:start]
+        elif start < len(data):
+            self._buf += data[start:]
+
+        if len(self._buf) > self._max_line_len:
+            # Nothing that long is a real sentence, so we are looking at noise
+            logging.debug('Discarding {} bytes of unterminated input'.format(len(self._buf)))
+            self.nr_overruns += 1
+            del self._buf[:]
+
+    def reset(self):
+        del self._buf[:]
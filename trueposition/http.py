@@ -4,24 +4,326 @@
 
 import logging
 import asyncio
+import binascii
+import collections
+import gzip
 import json
+import itertools
+import math
+import os
+import time
 from aiohttp import web
 
+from .bus import SubscriptionOverflowError
+from .metrics import PROMETHEUS_CONTENT_TYPE, gauge, merge, render
+from .state import STREAM_TOPICS
+
 class TruePositionHTTPApi(object):
-    def __init__(self, tpstate, port=24601, loop=asyncio.get_event_loop()):
-        self._tpstate = tpstate
+    """
+    The HTTP API for one or more GPSDOs. tpstate is either a single state manager, or a
+    mapping of device names to state managers. Every route is served for each device
+    under /devices/<name>/, and at the top level for the first device, with /devices
+    giving an aggregate view of them all. The health of the event loop they all share is
+    served at /loop, if there is a loop_monitor.
+    """
+    def __init__(self, tpstate, port=24601, loop=asyncio.get_event_loop(), gzip_min_size=512,
+            max_stream_clients=512, stream_queue_len=64, stream_keepalive_sec=15,
+            loop_monitor=None):
+        if isinstance(tpstate, dict):
+            self._states = collections.OrderedDict(tpstate)
+        else:
+            self._states = collections.OrderedDict([('default', tpstate)])
+        self._default_device = next(iter(self._states))
+        # Versions restart from zero with the process, so tag ETags with an instance ID
+        self._instance_id = binascii.hexlify(os.urandom(4)).decode('ascii')
+        self._cache = {}
+        self._gzip_min_size = gzip_min_size
+        self._max_stream_clients = max_stream_clients
+        self._stream_queue_len = stream_queue_len
+        self._stream_keepalive_sec = stream_keepalive_sec
+        self._stream_ids = itertools.count()
+        self._nr_stream_clients = 0
+        self._loop_monitor = loop_monitor
         self._app = web.Application()
-        self._app.add_routes([web.get('/', self.get)])
+        device_routes = [('/gps', self.get_gps),
+                         ('/sats', self.get_sats),
+                         ('/status', self.get_status),
+                         ('/version', self.get_version),
+                         ('/metrics', self.get_metrics),
+                         ('/stats', self.get_stats),
+                         ('/latency', self.get_latency),
+                         ('/sats/{prn}/history', self.get_sat_history),
+                         ('/telemetry', self.get_telemetry),
+                         ('/stream', self.get_stream),
+                         ('/stream/ws', self.get_stream_ws)]
+        routes = [web.get('/', self.get),
+                  web.get('/devices', self.get_devices),
+                  web.get('/loop', self.get_loop),
+                  web.get('/devices/{device}', self.get),
+                  web.get('/devices/{device}/', self.get)]
+        for path, handler in device_routes:
+            routes.append(web.get(path, handler))
+            routes.append(web.get('/devices/{device}' + path, handler))
+        self._app.add_routes(routes)
         self._runner = web.AppRunner(self._app)
-        loop.run_until_complete(self._runner.setup())
-        self._site = web.TCPSite(self._runner, 'localhost', port)
+        self._port = port
+
+    def _device(self, request):
+        """
+        The name and state manager of the device a request is for.
+        """
+        name = request.match_info.get('device', self._default_device)
+        tpstate = self._states.get(name)
+        if tpstate is None:
+            raise web.HTTPNotFound(text='Unknown device: {}'.format(name))
+        return name, tpstate
+
+    def _cached_json_response(self, request, key, version, encode):
+        """
+        Serve the JSON encoding of encode(), which must only change when version does.
+        The encoded (and gzipped, if the client accepts it) bytes are cached per
+        version, and a client presenting the current ETag gets a 304.
+        """
+        etag = '"{}-{}-{}"'.format(self._instance_id, key, version)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                etag in [tag.strip() for tag in if_none_match.split(',')]):
+            return web.Response(status=304, headers=headers)
+
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != version:
+            entry = [version, json.dumps(encode()).encode('utf-8'), None]
+            self._cache[key] = entry
+
+        body = entry[1]
+        if self._gzip_min_size is not None and len(body) >= self._gzip_min_size and \
+                'gzip' in request.headers.get('Accept-Encoding', ''):
+            if entry[2] is None:
+                entry[2] = gzip.compress(body)
+            body = entry[2]
+            headers['Content-Encoding'] = 'gzip'
+
+        return web.Response(body=body, content_type='application/json', headers=headers)
 
     async def get(self, request):
-        return web.json_response(self._tpstate.get_state())
+        name, tpstate = self._device(request)
+        return self._cached_json_response(request, name + '/state', tpstate.version,
+                tpstate.get_state)
+
+    async def get_gps(self, request):
+        name, tpstate = self._device(request)
+        return self._cached_json_response(request, name + '/gps', tpstate.version, tpstate.get_gps)
+
+    async def get_sats(self, request):
+        name, tpstate = self._device(request)
+        return self._cached_json_response(request, name + '/sats', tpstate.version, tpstate.get_sats)
+
+    async def get_status(self, request):
+        name, tpstate = self._device(request)
+        return self._cached_json_response(request, name + '/status', tpstate.version,
+                tpstate.get_status)
+
+    async def get_version(self, request):
+        name, tpstate = self._device(request)
+        return self._cached_json_response(request, name + '/version', tpstate.version,
+                tpstate.get_version)
+
+    def _encode_devices(self):
+        return {name: {'version': tpstate.version,
+                       'gps': tpstate.get_gps(),
+                       'status': tpstate.get_status(),}
+                for name, tpstate in self._states.items()}
+
+    async def get_devices(self, request):
+        """
+        Every device's GPS and status side by side, for comparing them at a glance.
+        """
+        version = '.'.join(str(tpstate.version) for tpstate in self._states.values())
+        return self._cached_json_response(request, 'devices', version, self._encode_devices)
+
+    async def get_metrics(self, request):
+        if 'device' in request.match_info or len(self._states) == 1:
+            _, tpstate = self._device(request)
+            families = tpstate.get_metrics()
+        else:
+            # Label each device's samples, so the series stay apart
+            families = merge([({'device': name}, tpstate.get_metrics())
+                              for name, tpstate in self._states.items()])
+        families.append(gauge('gpsagent_stream_clients', 'Connected streaming clients',
+            self._nr_stream_clients))
+        if self._loop_monitor:
+            families += self._loop_monitor.get_metrics()
+        return web.Response(body=render(families), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+    async def get_sat_history(self, request):
+        try:
+            prn = int(request.match_info['prn'])
+            minutes = float(request.query.get('minutes', 10))
+        except ValueError:
+            raise web.HTTPBadRequest(text='PRN and minutes must be numbers')
+
+        _, tpstate = self._device(request)
+        samples = tpstate.get_sat_history(prn, minutes * 60)
+        return web.json_response({'satId': prn,
+                                  'fields': ['time', 'snr', 'el', 'az'],
+                                  'samples': samples})
+
+    async def get_telemetry(self, request):
+        """
+        Telemetry history, downsampled to at most the requested number of buckets. The
+        range is either the last N minutes, or from start to end (seconds since the
+        epoch).
+        """
+        _, tpstate = self._device(request)
+        telemetry = tpstate.telemetry
+        if telemetry is None:
+            raise web.HTTPNotFound(text='Telemetry is not being recorded')
+        if not telemetry.can_query:
+            raise web.HTTPNotImplemented(text='Querying telemetry needs numpy')
+
+        try:
+            end = float(request.query.get('end', time.time()))
+            start = float(request.query.get('start', end - float(request.query.get('minutes', 60)) * 60))
+            buckets = int(request.query.get('buckets', 500))
+        except ValueError:
+            raise web.HTTPBadRequest(text='start, end, minutes and buckets must be numbers')
+        if buckets < 1 or end < start:
+            raise web.HTTPBadRequest(text='Need at least one bucket, and start before end')
+
+        # A long range touches a lot of the file, so keep it off the event loop
+        bucket_sec = math.ceil((end - start + 1) / buckets)
+        result = await asyncio.get_event_loop().run_in_executor(None, telemetry.query, start, end,
+                bucket_sec)
+        return web.json_response(result)
+
+    def _open_stream(self, request):
+        """
+        Parse the requested topics and subscribe to their deltas. Returns the state
+        manager, the topics and the subscription.
+        """
+        name, tpstate = self._device(request)
+        topics = request.query.get('topics')
+        topics = topics.split(',') if topics else STREAM_TOPICS
+        unknown = set(topics) - set(STREAM_TOPICS)
+        if unknown:
+            raise web.HTTPBadRequest(text='Unknown topics: {}'.format(', '.join(sorted(unknown))))
+        if self._nr_stream_clients >= self._max_stream_clients:
+            raise web.HTTPServiceUnavailable(text='Too many streaming clients')
+
+        sub = tpstate.subscribe_deltas('stream-{}-{}'.format(name, next(self._stream_ids)), topics,
+                maxlen=self._stream_queue_len)
+        self._nr_stream_clients += 1
+        return tpstate, topics, sub
+
+    def _close_stream(self, tpstate, sub):
+        tpstate.unsubscribe(sub)
+        self._nr_stream_clients -= 1
+
+    async def _next_deltas(self, sub):
+        """
+        Wait for at least one delta, then take everything else pending so it can be sent
+        in one write. Returns an empty list if the keepalive interval passed first.
+        """
+        try:
+            deltas = [await asyncio.wait_for(sub.get(), self._stream_keepalive_sec)]
+        except asyncio.TimeoutError:
+            return []
+        while len(sub):
+            deltas.append(sub.get_nowait())
+        return deltas
+
+    async def get_stream(self, request):
+        """
+        Server-Sent Events: a snapshot event per topic, then one event per delta.
+        """
+        tpstate, topics, sub = self._open_stream(request)
+        try:
+            resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                               'Cache-Control': 'no-cache'})
+            await resp.prepare(request)
+            version = tpstate.version
+            await resp.write(''.join('event: snapshot\nid: {}\ndata: {}\n\n'.format(version,
+                json.dumps({'topic': topic, 'data': tpstate.get_topic(topic)}))
+                for topic in topics).encode('utf-8'))
+
+            while True:
+                deltas = await self._next_deltas(sub)
+                if not deltas:
+                    await resp.write(b': keepalive\n\n')
+                    continue
+                await resp.write(''.join('event: {}\nid: {}\ndata: {}\n\n'.format(d['topic'],
+                    d['version'], d['data']) for d in deltas).encode('utf-8'))
+        except SubscriptionOverflowError:
+            logging.info('Disconnecting slow stream client {}'.format(request.remote))
+            await resp.write(b'event: overflow\ndata: {}\n\n')
+        except ConnectionResetError:
+            pass
+        finally:
+            self._close_stream(tpstate, sub)
+        return resp
+
+    async def get_stream_ws(self, request):
+        """
+        WebSocket: a snapshot message per topic, then one message per delta, each as
+        {"topic": ..., "version": ..., "data": ...}.
+        """
+        tpstate, topics, sub = self._open_stream(request)
+        ws = web.WebSocketResponse(heartbeat=self._stream_keepalive_sec)
+        reader = None
+        try:
+            await ws.prepare(request)
+            # Nothing is expected from the client, but reading is what notices it closing
+            reader = asyncio.ensure_future(self._drain_ws(ws))
+            version = tpstate.version
+            for topic in topics:
+                await ws.send_str(json.dumps({'topic': topic, 'version': version, 'snapshot': True,
+                    'data': tpstate.get_topic(topic)}))
+
+            while not ws.closed:
+                for d in await self._next_deltas(sub):
+                    await ws.send_str('{{"topic": "{}", "version": {}, "data": {}}}'.format(
+                        d['topic'], d['version'], d['data']))
+        except SubscriptionOverflowError:
+            logging.info('Disconnecting slow websocket client {}'.format(request.remote))
+            await ws.close(message=b'overflow')
+        except ConnectionResetError:
+            pass
+        finally:
+            if reader:
+                reader.cancel()
+            self._close_stream(tpstate, sub)
+        return ws
+
+    async def _drain_ws(self, ws):
+        async for _ in ws:
+            pass
+
+    async def get_loop(self, request):
+        if self._loop_monitor is None:
+            raise web.HTTPNotFound(text='The event loop is not being monitored')
+        return web.json_response(self._loop_monitor.get_stats())
+
+    async def get_latency(self, request):
+        _, tpstate = self._device(request)
+        return web.json_response(tpstate.get_latency_stats())
+
+    async def get_stats(self, request):
+        _, tpstate = self._device(request)
+        return web.json_response({'sentences': tpstate.get_sentence_stats(),
+                                  'outputs': tpstate.get_output_stats(),
+                                  'commands': tpstate.get_command_stats()})
+
+    async def _start(self):
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, 'localhost', self._port)
+        await site.start()
+        logging.debug('HTTP server listening on port {}'.format(self._port))
 
     def start(self, loop):
-        # Start the site
-        asyncio.ensure_future(self._site.start())
+        # Set up and start the site in the background, rather than hold up startup
+        asyncio.ensure_future(self._start(), loop=loop)
 
     def stop(self):
         pass
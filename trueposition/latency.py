@@ -0,0 +1,131 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import logging
+
+from .metrics import MetricFamily
+
+# Bucket i holds samples below 2**i microseconds; the last bucket catches the rest
+_NR_BUCKETS = 26
+
+class LatencyHistogram(object):
+    """
+    Log2-bucketed histogram of latencies. Recording a sample is a multiply, an
+    int.bit_length() and a few additions, cheap enough to do for every sentence.
+    """
+    __slots__ = ['buckets', 'count', 'total', 'max']
+
+    def __init__(self):
+        self.buckets = [0] * _NR_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < 0:
+            seconds = 0.0
+        idx = int(seconds * 1e6).bit_length()
+        if idx >= _NR_BUCKETS:
+            idx = _NR_BUCKETS - 1
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def bucket_bound(idx):
+        """
+        Upper bound of a bucket, in seconds.
+        """
+        return (1 << idx) / 1e6
+
+    def quantile(self, q):
+        """
+        Approximate quantile: the upper bound of the bucket the q'th sample falls in,
+        capped at the largest sample seen.
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for idx, nr in enumerate(self.buckets):
+            seen += nr
+            if seen >= target:
+                return min(self.bucket_bound(idx), self.max)
+        return self.max
+
+    def encode(self):
+        return {'count': self.count,
+                'meanSecs': self.total / self.count if self.count else 0.0,
+                'p50Secs': self.quantile(0.5),
+                'p99Secs': self.quantile(0.99),
+                'maxSecs': self.max,}
+
+def add_histogram(family, hist, **labels):
+    """
+    Add the samples of a histogram to a Prometheus histogram metric family.
+    """
+    cumulative = 0
+    for idx, nr in enumerate(hist.buckets[:-1]):
+        cumulative += nr
+        family.add(cumulative, suffix='_bucket', le=repr(LatencyHistogram.bucket_bound(idx)), **labels)
+    family.add(hist.count, suffix='_bucket', le='+Inf', **labels)
+    family.add(hist.total, suffix='_sum', **labels)
+    family.add(hist.count, suffix='_count', **labels)
+
+class LatencyRecorder(object):
+    """
+    Latency histograms for each stage a sentence passes through on its way from the
+    UART to an output:
+
+     * framing: bytes arriving in data_received to the sentence being queued
+     * dispatch: queued to parsed, handled and published to the bus
+     * fanout.<output>: published to picked up by the output
+     * write.<output>: picked up to written out by the output
+     * total.<output>: bytes arriving to written out, end to end
+
+    Messages on the bus carry rxTime and pubTime (time.monotonic()) for this.
+    """
+    def __init__(self):
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        hist = self._stages.get(stage)
+        if hist is None:
+            hist = self._stages[stage] = LatencyHistogram()
+        hist.record(seconds)
+
+    def record_output(self, output, msg, delivered, written=None):
+        """
+        Record the fan-out, write and end to end latency of a message an output has
+        handled. Call with written=None if the output took the message but did not
+        write anything.
+        """
+        pub_time = msg.get('pubTime')
+        if pub_time is not None:
+            self.record('fanout.' + output, delivered - pub_time)
+        if written is None:
+            return
+        self.record('write.' + output, written - delivered)
+        rx_time = msg.get('rxTime')
+        if rx_time is not None:
+            self.record('total.' + output, written - rx_time)
+
+    def get_stats(self):
+        return {stage: hist.encode() for stage, hist in sorted(self._stages.items())}
+
+    def get_metrics(self):
+        family = MetricFamily('gpsagent_latency_seconds', 'histogram',
+                'Latency of each stage from serial byte arrival to output')
+        for stage, hist in sorted(self._stages.items()):
+            add_histogram(family, hist, stage=stage)
+        return [family]
+
+    def log_summary(self):
+        for stage, hist in sorted(self._stages.items()):
+            stats = hist.encode()
+            logging.info('Latency {}: n={} mean={:.3f}ms p50<={:.3f}ms p99<={:.3f}ms max={:.3f}ms'.format(
+                stage, stats['count'], stats['meanSecs'] * 1e3, stats['p50Secs'] * 1e3,
+                stats['p99Secs'] * 1e3, stats['maxSecs'] * 1e3))
@@ -0,0 +1,130 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import collections
+import logging
+import time
+
+from .latency import LatencyHistogram, add_histogram
+from .metrics import MetricFamily, counter, gauge
+
+# Stalls remembered, for checking the samples that arrived during them
+_NR_STALLS = 16
+
+class TruePositionLoopMonitor(object):
+    """
+    Watches the health of the event loop everything in the agent shares. A timer is
+    set to go off every tick_sec; the lag is how late it actually ran, i.e. how long
+    any other callback ready at that moment (the UART, say) was kept waiting. A lag over
+    threshold_sec is a stall.
+
+    The time outputs ask sample_is_late() before passing a sample on: a sample that
+    arrived during a stall carries a receive time that is late by up to the length of
+    the stall, and must never reach ntpd or chrony. The lag of each tick is a lower
+    bound on how long the loop was unresponsive, so keep tick_sec small next to
+    threshold_sec.
+    """
+    def __init__(self, tick_sec=0.02, threshold_sec=0.05, log_interval_sec=300):
+        self.tick_sec = tick_sec
+        self.threshold_sec = threshold_sec
+        self._log_interval_sec = log_interval_sec
+        self._lag = LatencyHistogram()
+        self._stalls = collections.deque(maxlen=_NR_STALLS)
+        self._handle = None
+        self._next_tick = None
+        self._implementation = None
+        self.last_lag_sec = 0.0
+        self.degraded = False
+        self.nr_stalls = 0
+        self.nr_late = collections.Counter()
+
+    def _schedule(self, loop):
+        self._next_tick = time.monotonic() + self.tick_sec
+        self._handle = loop.call_later(self.tick_sec, self._tick, loop)
+
+    def _tick(self, loop):
+        now = time.monotonic()
+        lag = max(0.0, now - self._next_tick)
+        self._lag.record(lag)
+        self.last_lag_sec = lag
+        if lag > self.threshold_sec:
+            self.nr_stalls += 1
+            self._stalls.append((self._next_tick, now))
+            if not self.degraded:
+                logging.warning('Event loop stalled for {:.1f}ms, holding back time samples'.format(
+                    lag * 1e3))
+                self.degraded = True
+        elif self.degraded:
+            logging.info('Event loop is keeping up again, after {} stalls'.format(self.nr_stalls))
+            self.degraded = False
+        self._schedule(loop)
+
+    def sample_is_late(self, output, rx_time, check_age=False):
+        """
+        Whether a time sample, whose bytes arrived at rx_time (time.monotonic()), may
+        have been stamped late because the loop was stalled, and should be dropped. Set
+        check_age if the output stamps samples when it writes them rather than with
+        rx_time, so the time the sample spent waiting counts too. Late samples are
+        counted against output.
+        """
+        if self._next_tick is None:
+            return False
+        now = time.monotonic()
+        # The tick that would notice a stall still going on has not had a chance to run
+        late = now - self._next_tick > self.threshold_sec
+        if check_age and now - rx_time > self.threshold_sec:
+            late = True
+        for start, end in self._stalls:
+            # Bytes that arrived during a stall are stamped once it is over
+            if start <= rx_time <= end + self.tick_sec:
+                late = True
+                break
+        if late:
+            self.nr_late[output] += 1
+        return late
+
+    def get_stats(self):
+        return {'implementation': self._implementation,
+                'tickSec': self.tick_sec,
+                'thresholdSec': self.threshold_sec,
+                'degraded': self.degraded,
+                'lastLagSec': self.last_lag_sec,
+                'lag': self._lag.encode(),
+                'nrStalls': self.nr_stalls,
+                'lateSamples': dict(self.nr_late),}
+
+    def get_metrics(self):
+        lag = MetricFamily('gpsagent_loop_lag_seconds', 'histogram',
+                'How late the event loop ran a timer set to go off every tick')
+        add_histogram(lag, self._lag)
+        late = counter('gpsagent_loop_late_samples_total',
+                'Time samples held back because the event loop stalled')
+        for output, nr in sorted(self.nr_late.items()):
+            late.add(nr, output=output)
+        return [lag,
+                counter('gpsagent_loop_stalls_total', 'Ticks that ran later than the threshold',
+                        self.nr_stalls),
+                gauge('gpsagent_loop_degraded', 'Whether the event loop is stalling', self.degraded),
+                late]
+
+    async def _log_lag(self):
+        while self._handle:
+            await asyncio.sleep(self._log_interval_sec)
+            stats = self._lag.encode()
+            logging.info('Loop lag: n={} mean={:.3f}ms p99<={:.3f}ms max={:.3f}ms, {} stalls, '
+                '{} late samples'.format(stats['count'], stats['meanSecs'] * 1e3,
+                stats['p99Secs'] * 1e3, stats['maxSecs'] * 1e3, self.nr_stalls,
+                sum(self.nr_late.values())))
+
+    def start(self, loop=asyncio.get_event_loop()):
+        self._implementation = type(loop).__module__.split('.')[0]
+        self._schedule(loop)
+        if self._log_interval_sec:
+            asyncio.ensure_future(self._log_lag(), loop=loop)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
@@ -0,0 +1,84 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import collections
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricFamily(object):
+    """
+    A named metric and its samples, each sample being a dict of labels, a value and a
+    suffix for the sample name (e.g. _bucket, _sum and _count for histograms).
+    """
+    __slots__ = ['name', 'kind', 'help', 'samples']
+
+    def __init__(self, name, kind, help_text, samples=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.samples = samples if samples is not None else []
+
+    def add(self, value, suffix='', **labels):
+        self.samples.append((labels, value, suffix))
+        return self
+
+def gauge(name, help_text, value=None, **labels):
+    family = MetricFamily(name, 'gauge', help_text)
+    if value is not None:
+        family.add(value, **labels)
+    return family
+
+def counter(name, help_text, value=None, **labels):
+    family = MetricFamily(name, 'counter', help_text)
+    if value is not None:
+        family.add(value, **labels)
+    return family
+
+def merge(sources):
+    """
+    Merge the metric families of several sources into one family per name, so each
+    is only described once. sources is a list of (labels, families), and each
+    source's labels are added to all of its samples.
+    """
+    merged = collections.OrderedDict()
+    for labels, families in sources:
+        for family in families:
+            target = merged.get(family.name)
+            if target is None:
+                target = merged[family.name] = MetricFamily(family.name, family.kind, family.help)
+            for sample_labels, value, suffix in family.samples:
+                target.samples.append((dict(sample_labels, **labels), value, suffix))
+    return list(merged.values())
+
+def render(families):
+    """
+    Render metric families in the Prometheus text exposition format.
+    """
+    lines = []
+    for family in families:
+        if not family.samples:
+            continue
+        lines.append('# HELP {} {}'.format(family.name, family.help))
+        lines.append('# TYPE {} {}'.format(family.name, family.kind))
+        for labels, value, suffix in family.samples:
+            if labels:
+                label_str = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items()))
+                lines.append('{}{}{{{}}} {}'.format(family.name, suffix, label_str,
+                    _format_value(value)))
+            else:
+                lines.append('{}{} {}'.format(family.name, suffix, _format_value(value)))
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
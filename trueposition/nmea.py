@@ -0,0 +1,153 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import functools
+import math
+import operator
+import time
+
+def nmea_checksum(body):
+    """
+    XOR of every byte of a sentence body (the part between the $ and the *).
+    """
+    return functools.reduce(operator.xor, body, 0)
+
+def _part(data):
+    # Sentence fragments are kept with their checksum, since XOR lets us combine the
+    # checksums of cached fragments instead of rescanning the whole sentence.
+    return (data, nmea_checksum(data))
+
+def _frac_to_dm(frac, deg_digits):
+    """
+    Convert signed fractional degrees to NMEA ddmm.mmmm (or dddmm.mmmm) form. Rounding
+    is done on an integer number of ten-thousandths of a minute, so we never emit
+    60.0000 minutes.
+    """
+    total = int(round(abs(frac) * 600000))
+    deg, mins = divmod(total, 600000)
+    return '{:0{}d}{:02d}.{:04d}'.format(deg, deg_digits, mins // 10000, mins % 10000)
+
+_COMMA = _part(b',')
+_STATUS_A = _part(b',A,')
+_STATUS_V = _part(b',V,')
+_RMC_MOTION = _part(b',0.0,0.0,')
+_RMC_MAGVAR = _part(b',0.0,E')
+_GGA_TRAILER = _part(b',,')
+# We only know TDOP, so PDOP, HDOP and VDOP are left empty
+_GSA_DOPS = _part(b',,,')
+
+# Satellites per GSV sentence, and PRNs per GSA sentence
+_GSV_SATS = 4
+_GSA_PRNS = 12
+
+class NMEAEncoder(object):
+    """
+    Formats gps messages from the state manager as NMEA sentences, returned as bytes
+    ready to write.
+
+    Everything derived from the timestamp is computed once per second, and everything
+    derived from the position is computed once per position change (i.e. when a
+    GETPOS or SURVEY response moves it), along with the checksum of each fragment.
+    Building a sentence is then a join and a handful of XORs.
+    """
+    def __init__(self, talker='GP'):
+        self._talker = talker.encode('ascii')
+        self._time_key = None
+        self._time_parts = None
+        self._pos_key = None
+        self._pos_parts = None
+        self._prefix = {}
+        self._gsv_key = None
+        self._gsv = None
+
+    def _sentence_prefix(self, name):
+        prefix = self._prefix.get(name)
+        if prefix is None:
+            prefix = self._prefix[name] = _part(self._talker + name + b',')
+        return prefix
+
+    def _times(self, when):
+        key = int(when)
+        if key != self._time_key:
+            now = time.gmtime(key)
+            hms = '{:02d}{:02d}{:02d}'.format(now.tm_hour, now.tm_min, now.tm_sec)
+            self._time_parts = {
+                'hms': _part(hms.encode('ascii')),
+                'date': _part('{:02d}{:02d}{:02d}'.format(now.tm_mday, now.tm_mon,
+                    now.tm_year % 100).encode('ascii')),
+                'zda': _part('{},{:02d},{:02d},{:04d},0,0'.format(hms, now.tm_mday, now.tm_mon,
+                    now.tm_year).encode('ascii')),
+            }
+            self._time_key = key
+        return self._time_parts
+
+    def _position(self, msg):
+        lat = msg.get('latitude', 0)
+        lon = msg.get('longitude', 0)
+        elev = msg.get('elevMetres', 0)
+        geoid = msg.get('geoidOffs', 0)
+        key = (lat, lon, elev, geoid)
+        if key != self._pos_key:
+            latlon = '{},{},{},{}'.format(_frac_to_dm(lat, 2), 'N' if lat >= 0 else 'S',
+                    _frac_to_dm(lon, 3), 'E' if lon >= 0 else 'W')
+            self._pos_parts = {
+                'latlon': _part(latlon.encode('ascii')),
+                'alt': _part('{:.1f},M,{:.1f},M'.format(elev, geoid).encode('ascii')),
+            }
+            self._pos_key = key
+        return self._pos_parts
+
+    def _finish(self, parts):
+        checksum = 0
+        for _, cs in parts:
+            checksum ^= cs
+        return b''.join([b'$'] + [data for data, _ in parts] + [b'*%02X\n' % checksum])
+
+    def rmc(self, msg):
+        times = self._times(msg.get('time'))
+        pos = self._position(msg)
+        status = _STATUS_A if msg.get('goodFix', False) else _STATUS_V
+        return self._finish([self._sentence_prefix(b'RMC'), times['hms'], status, pos['latlon'],
+            _RMC_MOTION, times['date'], _RMC_MAGVAR])
+
+    def zda(self, msg):
+        return self._finish([self._sentence_prefix(b'ZDA'), self._times(msg.get('time'))['zda']])
+
+    def gga(self, msg, hdop=None):
+        times = self._times(msg.get('time'))
+        pos = self._position(msg)
+        fix = '{},{:02d},{},'.format(1 if msg.get('goodFix', False) else 0, msg.get('nrSats', 0),
+                '' if hdop is None else '{:.1f}'.format(hdop))
+        return self._finish([self._sentence_prefix(b'GGA'), times['hms'], _COMMA, pos['latlon'],
+            _COMMA, _part(fix.encode('ascii')), pos['alt'], _GGA_TRAILER])
+
+    def gsa(self, msg):
+        # The satellites with a signal are the ones used in the solution
+        prns = ['{:02d}'.format(sat['satId']) for sat in msg.get('trackedSats', [])
+                if sat['snr'] > 0][:_GSA_PRNS]
+        prns += [''] * (_GSA_PRNS - len(prns))
+        mode = 'A,{},{}'.format(3 if msg.get('goodFix', False) else 1, ','.join(prns))
+        return self._finish([self._sentence_prefix(b'GSA'), _part(mode.encode('ascii')), _GSA_DOPS])
+
+    def gsv(self, msg):
+        """
+        The satellites in view, as a group of GSV sentences (four satellites apiece) in a
+        single bytes. The group is only formatted again once the satellites change.
+        """
+        key = tuple((sat['satId'], max(0, sat['el']), sat['az'], min(99, sat['snr']))
+                    for sat in msg.get('trackedSats', []))
+        if key != self._gsv_key:
+            prefix = self._sentence_prefix(b'GSV')
+            nr_sentences = max(1, math.ceil(len(key) / _GSV_SATS))
+            sentences = []
+            for idx in range(nr_sentences):
+                fields = ['{},{},{:02d}'.format(nr_sentences, idx + 1, len(key))]
+                for sat_id, el, az, snr in key[idx * _GSV_SATS:(idx + 1) * _GSV_SATS]:
+                    # An SNR of zero means the channel has no signal, which NMEA leaves empty
+                    fields.append('{:02d},{:02d},{:03d},{}'.format(sat_id, el, az,
+                        '{:02d}'.format(snr) if snr else ''))
+                sentences.append(self._finish([prefix, _part(','.join(fields).encode('ascii'))]))
+            self._gsv = b''.join(sentences)
+            self._gsv_key = key
+        return self._gsv
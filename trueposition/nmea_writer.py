@@ -2,92 +2,207 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
-import aiofiles
 import asyncio
+import errno
 import logging
+import os
 import time
 
+from .bus import COALESCE
+from .nmea import NMEAEncoder
+
+# The sentences that can be written, in the order they go out each second
+NMEA_SENTENCES = ['RMC', 'GGA', 'GSA', 'GSV', 'ZDA']
+
+class NMEAFileDestination(object):
+    """
+    A file or FIFO that NMEA sentences are written to, with a non-blocking descriptor
+    driven from the event loop. If a FIFO reader is slow, the unwritten tail is held
+    (up to max_pending bytes) and flushed when the descriptor becomes writable. If
+    there is no reader, or the reader goes away, the FIFO is reopened once a new
+    sentence arrives and reopen_interval_sec has passed.
+    """
+    def __init__(self, path, loop=asyncio.get_event_loop(), max_pending=4096, reopen_interval_sec=1.0):
+        self._path = path
+        self._loop = loop
+        self._fd = None
+        self._pending = bytearray()
+        self._max_pending = max_pending
+        self._reopen_interval_sec = reopen_interval_sec
+        self._next_open = 0
+        self._truncate = True
+        self.nr_written = 0
+        self.nr_dropped = 0
+        self.nr_reopens = 0
+
+    def _open(self):
+        now = time.monotonic()
+        if now < self._next_open:
+            return False
+        self._next_open = now + self._reopen_interval_sec
+
+        flags = os.O_WRONLY | os.O_NONBLOCK | os.O_CREAT
+        if self._truncate:
+            # Match the old 'wt' behaviour for plain files, but only the first time
+            flags |= os.O_TRUNC
+        try:
+            self._fd = os.open(self._path, flags, 0o644)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                logging.warning('Unable to open NMEA output {}: {}'.format(self._path, e))
+            # ENXIO means a FIFO with nobody reading it yet, which is perfectly normal
+            return False
+
+        logging.debug('Opened NMEA output {}'.format(self._path))
+        self._truncate = False
+        self.nr_reopens += 1
+        return True
+
+    def _close(self):
+        if self._fd is None:
+            return
+        if self._pending:
+            self._loop.remove_writer(self._fd)
+            del self._pending[:]
+        os.close(self._fd)
+        self._fd = None
+
+    def _write(self, data):
+        """
+        Write as much of data as the descriptor will take, returning the number of
+        bytes written, or None if the descriptor had to be closed.
+        """
+        try:
+            return os.write(self._fd, data)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                logging.warning('Error writing NMEA output {}: {}'.format(self._path, e))
+            else:
+                logging.debug('NMEA reader on {} went away'.format(self._path))
+            self._close()
+            return None
+
+    def _flush_pending(self):
+        written = self._write(self._pending)
+        if written is None:
+            return
+        del self._pending[:written]
+        if not self._pending:
+            self._loop.remove_writer(self._fd)
+
+    def write(self, data):
+        if self._fd is None and not self._open():
+            self.nr_dropped += 1
+            return
+
+        if self._pending:
+            # Still waiting on the reader; queue up behind what is already pending
+            if len(self._pending) + len(data) > self._max_pending:
+                self.nr_dropped += 1
+            else:
+                self._pending += data
+            return
+
+        written = self._write(data)
+        if written is None:
+            self.nr_dropped += 1
+            return
+
+        self.nr_written += 1
+        if written < len(data):
+            self._pending += data[written:]
+            self._loop.add_writer(self._fd, self._flush_pending)
+
+    def close(self):
+        self._close()
+
 class TruePositionNMEAWriter(object):
-    def __init__(self, out_file, loop=asyncio.get_event_loop(), zda_interval_sec=0):
-        self._msg_queue = asyncio.Queue(loop=loop)
-        self._file = loop.run_until_complete(aiofiles.open(out_file, 'wt'))
-        self._last_zda = time.gmtime(0)
-        self._zda_interval_sec = zda_interval_sec
-        self._last_gps_msg = None
-
-    async def enqueue_tp_message(self, msg):
-        await self._msg_queue.put(msg)
-
-    def __format_rmc(self, msg):
-        def _frac_to_dm(frac_n):
-            frac = abs(frac_n)
-            deg = int(frac)
-            mins = (frac - deg) * 60.0
-            return (deg, mins)
-
-        lon = msg.get('longitude', 0)
-        lat = msg.get('latitude', 0)
-        lat_deg, lat_mins = _frac_to_dm(lat)
-        lon_deg, lon_mins = _frac_to_dm(lon)
-        now = time.gmtime(msg.get('time'))
-        fields = {'time': time.strftime('%H%M%S', now),
-                'date': time.strftime('%d%m%y', now),
-                'elev': msg.get('elevMetres', 0),
-                'to_geoid': msg.get('geoidOffs', 0),
-                'lat_deg': lat_deg,
-                'lat_mins': lat_mins,
-                'lon_deg': lon_deg,
-                'lon_mins': lon_mins,
-                'lat_dir': 'N' if lat > 0 else 'S',
-                'lon_dir': 'E' if lon > 0 else 'W',
-                'fix_quality': 'A' if msg.get('goodFix', False) else 'V',
-                'nr_sats': msg.get('nrSats', 0),
-                }
-
-        return 'GPRMC,{time},{fix_quality},{lat_deg:02d}{lat_mins:6.4f},{lat_dir},{lon_deg:03d}{lon_mins:6.4f},{lon_dir},0.0,0.0,{date},0.0,E'.format(**fields)
-
-    def __format_zda(self, msg):
-        gmt = time.gmtime(msg.get('time'))
-        return 'GPZDA,{:02d}{:02d}{:02d},{:02d},{:02d},{:04d},0,0'.format(gmt.tm_hour,
-                gmt.tm_min, gmt.tm_sec, gmt.tm_mday, gmt.tm_mon, gmt.tm_year)
-
-    def __format_nmea_msg(self, msg_body):
-        def __nmea_chksum(msg):
-            checksum = 0
-            for c in msg:
-                checksum ^= ord(c)
-            return checksum
-
-        return '${}*{:2X}\n'.format(msg_body, __nmea_chksum(msg_body))
+    """
+    Writes NMEA sentences for each fix to files or FIFOs. intervals maps each sentence
+    to write (see NMEA_SENTENCES) to the seconds of GPS time between them; by default
+    only RMC is written, with every fix. The sentences due for a fix are formatted
+    once, satellites included (GSA and GSV come from the satellite table carried on
+    the fix, not from every SAT update), and written out together.
+
+    Writes never block, so in direct mode each fix is written from within the handler
+    that published it, rather than queued for a writer task.
+    """
+    def __init__(self, out_files, loop=asyncio.get_event_loop(), zda_interval_sec=0, queue_len=4,
+            overflow_policy=COALESCE, intervals=None, direct=False):
+        if isinstance(out_files, str):
+            out_files = [out_files]
+        intervals = dict(intervals or {'RMC': 1})
+        if zda_interval_sec:
+            intervals['ZDA'] = zda_interval_sec
+        unknown = set(intervals) - set(NMEA_SENTENCES)
+        if unknown:
+            raise ValueError('Unknown NMEA sentences: {}'.format(', '.join(sorted(unknown))))
+        self._sub = None
+        self._latency = None
+        self._queue_len = queue_len
+        self._overflow_policy = overflow_policy
+        self._direct = direct
+        self._dests = [NMEAFileDestination(path, loop=loop) for path in out_files]
+        self._encoder = NMEAEncoder()
+        self._schedule = [(name, intervals[name], getattr(self._encoder, name.lower()))
+                          for name in NMEA_SENTENCES if intervals.get(name)]
+        self._last_sent = {}
+
+    def subscribe(self, bus):
+        if self._direct:
+            self._sub = bus.subscribe('nmea', types=['gps'], callback=self._write_fix)
+        else:
+            # A stale fix is worthless to the consumer, so by default only the latest is kept
+            self._sub = bus.subscribe('nmea', types=['gps'], maxlen=self._queue_len,
+                    policy=self._overflow_policy)
+        self._latency = bus.latency
+        if any(name in ('GSA', 'GSV') for name, _, _ in self._schedule):
+            bus.wants_tracked_sats = True
+
+    def _emit(self, data):
+        # The sentence is formatted once; every destination gets the same bytes
+        for dest in self._dests:
+            dest.write(data)
+
+    def _due(self, msg):
+        """
+        Format the sentences due at the time of a fix, as one block.
+        """
+        when = msg.get('time') or 0
+        sentences = []
+        for name, interval, encode in self._schedule:
+            last = self._last_sent.get(name)
+            # Time going backwards (e.g. a replay starting over) restarts the schedule
+            if last is None or when - last >= interval or when < last:
+                self._last_sent[name] = when
+                sentences.append(encode(msg))
+        return b''.join(sentences)
+
+    def _write_fix(self, msg):
+        delivered = time.monotonic()
+
+        msg_type = msg.get('type', 'unknown')
+        if msg_type == 'gps':
+            data = self._due(msg)
+            if data:
+                self._emit(data)
+            self._latency.record_output('nmea', msg, delivered, time.monotonic())
+        else:
+            logging.debug('Unknown message type: {} (Message: {})'.format(msg_type, msg))
 
     async def _writer(self):
-        self._last_zda = 0
-
         while self._running:
-            msg = await self._msg_queue.get()
-
-            # Logic to handle sending a periodic ZDA message to help the receiver figure out the
-            # UTC date.
-            now = time.time()
-            if self._zda_interval_sec and self._last_gps_msg and (now - self._last_zda) >= self._zda_interval_sec:
-                self._last_zda = now
-                await self._file.write(self.__format_nmea_msg(self.__format_zda(self._last_gps_msg)))
-                await self._file.flush()
-
-            msg_type = msg.get('type', 'unknown')
-            if msg_type == 'sat':
-                pass
-            elif msg_type == 'gps':
-                self._last_gps_msg = msg
-                await self._file.write(self.__format_nmea_msg(self.__format_rmc(msg)))
-                await self._file.flush()
-            else:
-                logging.debug('Unknown message type: {} (Message: {})'.format(msg_type, msg))
+            self._write_fix(await self._sub.get())
 
     def start(self, loop=asyncio.get_event_loop()):
         self._running = True
-        asyncio.ensure_future(self._writer(), loop=loop)
+        if not self._direct:
+            asyncio.ensure_future(self._writer(), loop=loop)
 
     def stop(self):
         self._running = False
+        for dest in self._dests:
+            dest.close()
 
@@ -0,0 +1,87 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import logging
+import os
+import socket
+import time
+
+def sd_notify(state):
+    """
+    Send a state string (e.g. READY=1) to systemd, if it is listening. Returns whether
+    it was sent.
+    """
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path[0] == '@':
+        # Abstract namespace socket
+        path = '\0' + path[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(state.encode('utf-8'), path)
+        except OSError as e:
+            logging.warning('Could not notify systemd: {}'.format(e))
+            return False
+    return True
+
+class TruePositionReadiness(object):
+    """
+    Tells whoever started the agent that it is up, as soon as a time output of every
+    device it was given to has written out a sample with a good fix: by sd_notify(),
+    if running under systemd with Type=notify, and by creating ready_file, if one is
+    given. A device with no time outputs is ready at its first CLOCK with a good fix.
+
+    Add the same instance to the outputs of each device, after their time outputs, so
+    that it can tell whether there are any.
+    """
+    def __init__(self, ready_file=None):
+        self._ready_file = ready_file
+        self._pending = []
+        self._created = time.monotonic()
+        self.is_ready = False
+
+        if ready_file and os.path.exists(ready_file):
+            os.unlink(ready_file)
+
+    def subscribe(self, bus):
+        self._pending.append(bus)
+        if bus.time_outputs:
+            hook = lambda output, msg: self._written(bus, msg, lambda: bus.remove_written_hook(hook))
+            bus.add_written_hook(hook)
+        else:
+            sub = bus.subscribe('readiness', types=['gps'],
+                    callback=lambda msg: self._written(bus, msg, lambda: bus.unsubscribe(sub)))
+
+    def _written(self, bus, msg, done):
+        # Only the first good sample from each device matters
+        if not msg.get('goodFix'):
+            return
+        done()
+        self._pending.remove(bus)
+        if not self._pending:
+            self._notify()
+
+    def _notify(self):
+        self.is_ready = True
+        logging.info('Ready, {:.3f}s after startup'.format(time.monotonic() - self._created))
+        sd_notify('READY=1\nSTATUS=Serving time')
+        if self._ready_file:
+            # Appear all at once, for anything polling for the file
+            tmp_file = '{}.{}'.format(self._ready_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                f.write('{}\n'.format(os.getpid()))
+            os.rename(tmp_file, self._ready_file)
+
+    def start(self, loop=asyncio.get_event_loop()):
+        pass
+
+    def stop(self):
+        if not self.is_ready:
+            return
+        self.is_ready = False
+        sd_notify('STOPPING=1')
+        if self._ready_file and os.path.exists(self._ready_file):
+            os.unlink(self._ready_file)
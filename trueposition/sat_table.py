@@ -0,0 +1,186 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+from array import array
+import logging
+
+# No receiver has anywhere near this many channels; a channel past it is garbage
+MAX_CHANNELS = 64
+
+class SatelliteHistory(object):
+    """
+    Fixed-size ring of (time, snr, el, az) samples for a single PRN.
+    """
+    __slots__ = ['_time', '_snr', '_el', '_az', '_head', '_count', 'last_sample']
+
+    def __init__(self, length):
+        self._time = array('d', bytes(8 * length))
+        self._snr = array('B', bytes(length))
+        self._el = array('b', bytes(length))
+        self._az = array('H', bytes(2 * length))
+        self._head = 0
+        self._count = 0
+        self.last_sample = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, when, snr, el, az):
+        idx = self._head
+        self._time[idx] = when
+        self._snr[idx] = snr
+        self._el[idx] = el
+        self._az[idx] = az
+        self._head = (idx + 1) % len(self._time)
+        if self._count < len(self._time):
+            self._count += 1
+        self.last_sample = when
+
+    def since(self, start):
+        """
+        Return the samples taken at or after start, oldest first. Walks back from the
+        newest sample, so only the samples returned are ever touched.
+        """
+        length = len(self._time)
+        samples = []
+        idx = self._head
+        for _ in range(self._count):
+            idx = (idx - 1) % length
+            when = self._time[idx]
+            if when < start:
+                break
+            samples.append((when, self._snr[idx], self._el[idx], self._az[idx]))
+        samples.reverse()
+        return samples
+
+class SatelliteTable(object):
+    """
+    The satellites the receiver is tracking, one fixed slot per receiver channel,
+    stored as parallel array columns. Each PRN also gets a bounded history ring,
+    sampled at most once every history_interval_sec. Channels not updated in
+    stale_sec are cleared, and histories with no sample in the whole history window
+    are dropped, so memory stays bounded however long the agent runs. Updates for a
+    channel outside 0 <= channel < MAX_CHANNELS are rejected and counted.
+    """
+    def __init__(self, nr_channels=16, history_len=720, history_interval_sec=10,
+            stale_sec=120):
+        self._sat_id = array('h')
+        self._el = array('b')
+        self._az = array('H')
+        self._snr = array('B')
+        self._last_seen = array('d')
+        self._grow(nr_channels)
+        self._history = {}
+        self._history_len = history_len
+        self._history_interval_sec = history_interval_sec
+        self._stale_sec = stale_sec
+        self._next_expire = 0
+        self.nr_bad_channels = 0
+
+    def _grow(self, nr_channels):
+        extra = nr_channels - len(self._sat_id)
+        self._sat_id.extend([-1] * extra)
+        self._el.extend([0] * extra)
+        self._az.extend([0] * extra)
+        self._snr.extend([0] * extra)
+        self._last_seen.extend([0.0] * extra)
+
+    def update(self, channel, sat_id, el, az, snr, when):
+        """
+        Record a report for a channel. Returns False, having changed nothing, if the
+        channel is out of range.
+        """
+        if not 0 <= channel < MAX_CHANNELS:
+            self.nr_bad_channels += 1
+            logging.warning('Ignoring satellite report for out of range channel {} (PRN {})'.format(
+                channel, sat_id))
+            return False
+        if channel >= len(self._sat_id):
+            self._grow(channel + 1)
+
+        # Keep odd values from the receiver within the column types
+        el = max(-90, min(90, el))
+        az = max(0, min(359, az))
+        snr = max(0, min(255, snr))
+
+        self._sat_id[channel] = sat_id
+        self._el[channel] = el
+        self._az[channel] = az
+        self._snr[channel] = snr
+        self._last_seen[channel] = when
+
+        hist = self._history.get(sat_id)
+        if hist is None:
+            hist = self._history[sat_id] = SatelliteHistory(self._history_len)
+        if when - hist.last_sample >= self._history_interval_sec:
+            hist.append(when, snr, el, az)
+
+        if when >= self._next_expire:
+            self.expire(when)
+        return True
+
+    def expire(self, now):
+        """
+        Clear channels that have gone stale, and forget PRNs not seen for the length
+        of the history window.
+        """
+        for channel, last_seen in enumerate(self._last_seen):
+            if self._sat_id[channel] >= 0 and now - last_seen > self._stale_sec:
+                logging.debug('Channel {} (PRN {}) has gone stale'.format(channel,
+                    self._sat_id[channel]))
+                self._sat_id[channel] = -1
+
+        horizon = now - self._history_len * self._history_interval_sec
+        for sat_id in [k for k, v in self._history.items() if v.last_sample < horizon]:
+            del self._history[sat_id]
+
+        self._next_expire = now + self._stale_sec / 4.0
+
+    def restore(self, sats):
+        """
+        Put back channels as returned by tracked(), e.g. from a checkpoint. They expire
+        in the usual way, stale_sec after they were last seen, unless the receiver
+        reports them again.
+        """
+        for sat in sats:
+            self.update(sat['slotId'], sat['satId'], sat['el'], sat['az'], sat['snr'],
+                    sat['lastSeen'])
+
+    def channel(self, channel):
+        if not 0 <= channel < len(self._sat_id) or self._sat_id[channel] < 0:
+            return None
+        return {'satId': self._sat_id[channel],
+                'el': self._el[channel],
+                'az': self._az[channel],
+                'snr': self._snr[channel],
+                'lastSeen': self._last_seen[channel],
+                'slotId': channel,}
+
+    def tracked(self):
+        return [self.channel(channel) for channel, sat_id in enumerate(self._sat_id) if sat_id >= 0]
+
+    def iter_tracked(self):
+        """
+        (satId, slotId, el, snr, az) of each channel in use, straight from the columns,
+        for packing without a dict per channel.
+        """
+        for channel, sat_id in enumerate(self._sat_id):
+            if sat_id >= 0:
+                yield sat_id, channel, self._el[channel], self._snr[channel], self._az[channel]
+
+    def __len__(self):
+        return sum(1 for sat_id in self._sat_id if sat_id >= 0)
+
+    def history(self, sat_id, start):
+        """
+        Samples of the given PRN taken at or after start, as a list of
+        (time, snr, el, az), oldest first.
+        """
+        hist = self._history.get(sat_id)
+        if hist is None:
+            return []
+        return hist.since(start)
+
+    def known_prns(self):
+        return sorted(self._history)
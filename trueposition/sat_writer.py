@@ -2,31 +2,193 @@
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
-import aiofiles
 import asyncio
+import concurrent.futures
+import gzip
 import logging
-import json
+import os
+import struct
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .bus import DROP_OLDEST
+
+# Fixed-width binary record: lastSeen, slotId, satId, el, az, snr
+SAT_RECORD = struct.Struct('<dBBbHB')
+# Every binary ephemeris file starts with this, so readers can tell it from JSONL
+SAT_FILE_MAGIC = b'TPSAT\x00\x01\x00'
+
+SAT_FORMATS = ['jsonl', 'binary']
+SAT_COMPRESSION = {'none': '', 'gzip': '.gz'}
+if zstandard:
+    SAT_COMPRESSION['zstd'] = '.zst'
+
+# Equivalent to json.dumps() of a sat message, without the generic encoder overhead
+_JSONL_TEMPLATE = ('{{"satId": {satId}, "el": {el}, "az": {az}, "snr": {snr}, '
+                   '"lastSeen": {lastSeen}, "slotId": {slotId}, "type": "sat"}}\n')
+
+def _encode_jsonl(msg):
+    return _JSONL_TEMPLATE.format_map(msg).encode('ascii')
+
+def _encode_binary(msg):
+    return SAT_RECORD.pack(msg['lastSeen'], msg['slotId'], msg['satId'], msg['el'], msg['az'],
+            msg['snr'])
 
 class TruePositionSatWriter(object):
-    def __init__(self, out_file, loop=asyncio.get_event_loop()):
-        self._msg_queue = asyncio.Queue(loop=loop)
-        self._file = loop.run_until_complete(aiofiles.open(out_file, 'wt+'))
+    """
+    Logs satellite ephemeris to disk. Records are batched in memory and written out
+    once batch_size records are pending or every flush_interval_sec, whichever comes
+    first, with each batch costing a single write on the writer's own thread. The log
+    can be compressed as it is written, and rotated by size and/or age. Records that
+    can't be encoded (e.g. values out of range for the binary format) are skipped and
+    counted.
+    """
+    def __init__(self, out_file, loop=asyncio.get_event_loop(), queue_len=1024,
+            overflow_policy=DROP_OLDEST, fmt='jsonl', compression='none', batch_size=256,
+            flush_interval_sec=30.0, rotate_bytes=0, rotate_interval_sec=0):
+        if fmt not in SAT_FORMATS:
+            raise ValueError('Unknown ephemeris format: {}'.format(fmt))
+        if compression not in SAT_COMPRESSION:
+            raise ValueError('Unsupported ephemeris compression: {}'.format(compression))
+
+        self._sub = None
+        self._latency = None
+        self._queue_len = queue_len
+        self._overflow_policy = overflow_policy
+        self._loop = loop
+        self._fmt = fmt
+        self._encode = _encode_binary if fmt == 'binary' else _encode_jsonl
+        self._compression = compression
+        self._suffix = SAT_COMPRESSION[compression]
+        self._path = out_file
+        if self._suffix and not self._path.endswith(self._suffix):
+            self._path += self._suffix
+        self._batch = []
+        self._batch_size = batch_size
+        self._flush_interval_sec = flush_interval_sec
+        self._flush_lock = asyncio.Lock()
+        # A single thread, so batches land in order, and stop() can wait for the last one
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._rotate_bytes = rotate_bytes
+        self._rotate_interval_sec = rotate_interval_sec
+        self._raw = None
+        self._file = None
+        self._opened_at = 0
+        self.nr_records = 0
+        self.nr_bad = 0
+        self.nr_batches = 0
+        self.nr_rotations = 0
+
+        if (rotate_bytes or rotate_interval_sec) and os.path.exists(self._path) and \
+                os.path.getsize(self._path):
+            # Don't clobber the last run's log if we are keeping history anyway
+            self._rotate_aside(os.path.getmtime(self._path))
+        self._open()
+
+    def subscribe(self, bus):
+        self._sub = bus.subscribe('satfile', types=['sat'], maxlen=self._queue_len,
+                policy=self._overflow_policy)
+        self._latency = bus.latency
 
-    async def enqueue_tp_message(self, msg):
-        await self._msg_queue.put(msg)
+    def _open(self):
+        self._raw = open(self._path, 'wb')
+        if self._compression == 'gzip':
+            self._file = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw)
+        elif self._compression == 'zstd':
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._file = self._raw
+        self._opened_at = time.time()
+        if self._fmt == 'binary':
+            self._file.write(SAT_FILE_MAGIC)
+
+    def _close(self):
+        if self._file is not self._raw:
+            self._file.close()
+        if not self._raw.closed:
+            self._raw.close()
+        self._file = self._raw = None
+
+    def _rotate_aside(self, when):
+        base = self._path[:-len(self._suffix)] if self._suffix else self._path
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(when))
+        rotated = '{}.{}{}'.format(base, stamp, self._suffix)
+        seq = 0
+        while os.path.exists(rotated):
+            seq += 1
+            rotated = '{}.{}-{}{}'.format(base, stamp, seq, self._suffix)
+        logging.info('Rotating ephemeris log {} to {}'.format(self._path, rotated))
+        os.rename(self._path, rotated)
+        self.nr_rotations += 1
+
+    def _should_rotate(self):
+        # Size is measured on disk, i.e. after compression
+        if self._rotate_bytes and self._raw.tell() >= self._rotate_bytes:
+            return True
+        if self._rotate_interval_sec and time.time() - self._opened_at >= self._rotate_interval_sec:
+            return True
+        return False
+
+    def _write_batch(self, data):
+        """
+        Runs on the writer thread: write a batch, then rotate if it is time to.
+        """
+        self._file.write(data)
+        self._file.flush()
+        if self._should_rotate():
+            self._close()
+            self._rotate_aside(self._opened_at)
+            self._open()
+
+    def _take_batch(self):
+        data = b''.join(self._batch)
+        self._batch = []
+        return data
+
+    async def _flush(self):
+        async with self._flush_lock:
+            if not self._batch:
+                return
+            self.nr_batches += 1
+            await self._loop.run_in_executor(self._executor, self._write_batch, self._take_batch())
+
+    async def _flusher(self):
+        while self._running:
+            await asyncio.sleep(self._flush_interval_sec)
+            await self._flush()
 
     async def _writer(self):
         while self._running:
-            msg = await self._msg_queue.get()
+            msg = await self._sub.get()
+            # Records only reach the disk with their batch, so only fan-out is measured
+            self._latency.record_output('satfile', msg, time.monotonic())
             if msg.get('type', 'unknown') == 'sat':
                 logging.debug('EPHEMERIS: {}'.format(msg))
-                await self._file.write(json.dumps(msg) + '\n')
-                await self._file.flush()
+                try:
+                    record = self._encode(msg)
+                except (struct.error, KeyError, TypeError, ValueError):
+                    self.nr_bad += 1
+                    logging.debug('Skipping ephemeris record that cannot be encoded: {}'.format(msg))
+                    continue
+                self._batch.append(record)
+                self.nr_records += 1
+                if len(self._batch) >= self._batch_size:
+                    await self._flush()
 
     def start(self, loop=asyncio.get_event_loop()):
         self._running = True
         asyncio.ensure_future(self._writer(), loop=loop)
+        asyncio.ensure_future(self._flusher(), loop=loop)
 
     def stop(self):
         self._running = False
-
+        if self._file:
+            # Shutting down, so it is fine to block: let a batch being written finish,
+            # then write the last one
+            self._executor.shutdown(wait=True)
+            self._write_batch(self._take_batch())
+            self._close()
@@ -0,0 +1,142 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import logging
+import time
+
+class SentenceFieldCountError(ValueError):
+    pass
+
+class SentenceSchema(object):
+    """
+    Declarative description of a TruePosition sentence: the tag it starts with, and
+    the name and type of each space-separated field that follows. Trailing fields
+    beyond those described are ignored, so newer firmware that appends fields does
+    not break parsing.
+
+    A schema with fields=None is raw: the handler is given the whole sentence.
+    """
+    def __init__(self, tag, fields=None):
+        self.tag = tag
+        self.fields = None if fields is None else tuple(fields)
+
+    @property
+    def is_raw(self):
+        return self.fields is None
+
+    def compile(self):
+        """
+        Generate a parser for this schema. The parser splits the sentence once and
+        converts every field in a single expression, returning a tuple in schema order.
+        """
+        if self.is_raw:
+            return None
+
+        nr_fields = len(self.fields) + 1
+        namespace = {'SentenceFieldCountError': SentenceFieldCountError}
+        convs = []
+        for idx, (name, conv) in enumerate(self.fields):
+            conv_name = '_conv_{}'.format(idx)
+            namespace[conv_name] = conv
+            convs.append('{}(f[{}])'.format(conv_name, idx + 1))
+
+        src = ('def parse(msg):\n'
+               '    f = msg.split(\' \')\n'
+               '    if len(f) < {nr}:\n'
+               '        raise SentenceFieldCountError(len(f))\n'
+               '    return ({convs},)\n').format(nr=nr_fields, convs=', '.join(convs))
+        exec(src, namespace)
+        parser = namespace['parse']
+        parser.__qualname__ = 'parse_{}'.format(self.tag.lstrip('$').lower())
+        return parser
+
+class SentenceStats(object):
+    __slots__ = ['count', 'field_count_errors', 'type_errors', 'handler_errors', 'parse_secs',
+                 'max_parse_secs']
+
+    def __init__(self):
+        self.count = 0
+        self.field_count_errors = 0
+        self.type_errors = 0
+        self.handler_errors = 0
+        self.parse_secs = 0.0
+        self.max_parse_secs = 0.0
+
+    def encode(self):
+        return {'count': self.count,
+                'fieldCountErrors': self.field_count_errors,
+                'typeErrors': self.type_errors,
+                'handlerErrors': self.handler_errors,
+                'parseSecs': self.parse_secs,
+                'maxParseSecs': self.max_parse_secs,
+                'meanParseSecs': self.parse_secs / self.count if self.count else 0.0,}
+
+class SentenceDispatcher(object):
+    """
+    Maps sentence tags to a compiled parser and a handler, so that each sentence costs
+    one dictionary lookup to route. Parse failures, and exceptions raised by handlers on
+    sentences they could not make sense of, are counted against the tag rather than
+    propagated.
+    """
+    def __init__(self, default=None):
+        self._table = {}
+        self._default = default
+        self._stats = {}
+
+    def register(self, schema, handler):
+        self._table[schema.tag] = (schema.compile(), handler)
+        self._stats.setdefault(schema.tag, SentenceStats())
+
+    def unregister(self, tag):
+        self._table.pop(tag, None)
+
+    def dispatch(self, msg):
+        """
+        Route a sentence to its handler. Returns whatever the handler returns, or None
+        if the sentence was unknown or could not be parsed.
+        """
+        tag = msg.split(' ', 1)[0]
+        entry = self._table.get(tag)
+        if entry is None:
+            if self._default:
+                self._default(msg)
+            return None
+
+        parser, handler = entry
+        stats = self._stats[tag]
+        stats.count += 1
+        if parser is None:
+            return self._call(stats, msg, handler, msg)
+
+        start = time.perf_counter()
+        try:
+            fields = parser(msg)
+        except SentenceFieldCountError:
+            stats.field_count_errors += 1
+            logging.debug('Short sentence for {}: [{}]'.format(tag, msg))
+            return None
+        except ValueError:
+            stats.type_errors += 1
+            logging.debug('Malformed field in {}: [{}]'.format(tag, msg))
+            return None
+        elapsed = time.perf_counter() - start
+        stats.parse_secs += elapsed
+        if elapsed > stats.max_parse_secs:
+            stats.max_parse_secs = elapsed
+
+        return self._call(stats, msg, handler, *fields)
+
+    def _call(self, stats, msg, handler, *args):
+        try:
+            return handler(*args)
+        except Exception:
+            stats.handler_errors += 1
+            logging.exception('Handler for {} failed on [{}]'.format(msg.split(' ', 1)[0], msg))
+            return None
+
+    def iter_stats(self):
+        return self._stats.items()
+
+    def get_stats(self):
+        return {tag: stats.encode() for tag, stats in self._stats.items()}
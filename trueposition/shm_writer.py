@@ -7,34 +7,107 @@ import logging
 import ntpdshm
 import time
 
+from .bus import COALESCE
+
+# The coarsest precision advertised, however long the GPSDO has been in holdover
+_MAX_PRECISION = -1
+
 class TruePositionSHMWriter(object):
-    def __init__(self, loop=asyncio.get_event_loop(), unit=0):
-        self._msg_queue = asyncio.Queue(loop=loop)
+    """
+    Feeds the GPSDO time to ntpd (or chrony) through an ntpd shared memory segment.
+
+    By default the time is handed over from an output task, and the receive timestamp
+    is whenever that task gets to run. In direct mode, the segment is updated from
+    within the $CLOCK handler instead, and the receive timestamp is the time the
+    sentence's bytes arrived at the UART, less fudge_sec to account for how far into
+    the second the GPSDO sends it.
+
+    The advertised precision is precision while the GPSDO is locked, and gets coarser
+    the longer it has been in holdover. The leap indicator says not in sync
+    while the 1PPS is bad, or the GPSDO is neither locked nor in holdover.
+
+    If the event loop stalled while a sample was on its way, the sample is skipped,
+    rather than handing ntpd a time that was stamped late.
+    """
+    def __init__(self, loop=asyncio.get_event_loop(), unit=0, direct=False, fudge_sec=0.0,
+            precision=-10):
+        self._sub = None
+        self._latency = None
+        self._loop_monitor = None
+        self._sample_written = None
+        self._direct = direct
+        self._fudge_sec = fudge_sec
+        self._precision = precision
         logging.debug('Connecting to shared memory segment, unit {}'.format(unit))
         self._shm = ntpdshm.NtpdShm(unit=unit)
         self._shm.mode = 1
-        self._shm.precision = -7
-        self._shm.leap = 0
+        self._shm.precision = precision
+        self._shm.leap = ntpdshm.LEAP_NOTINSYNC
 
-    async def enqueue_tp_message(self, msg):
-        await self._msg_queue.put(msg)
+    def subscribe(self, bus):
+        if self._direct:
+            self._sub = bus.subscribe('shm', types=['gps'], callback=self._update_direct)
+        else:
+            # Only the most recent time sample is worth handing to ntpd
+            self._sub = bus.subscribe('shm', types=['gps'], maxlen=1, policy=COALESCE)
+        self._latency = bus.latency
+        self._loop_monitor = bus.loop_monitor
+        self._sample_written = bus.sample_written
+        bus.time_outputs.add('shm')
+
+    def _is_late(self, msg):
+        rx_time = msg.get('rxTime')
+        if self._loop_monitor is None or rx_time is None:
+            return False
+        # Outside of direct mode, the sample is stamped when it is written
+        return self._loop_monitor.sample_is_late('shm', rx_time, check_age=not self._direct)
+
+    def _leap(self, msg):
+        if msg.get('ppsBad') or not (msg.get('goodFix') or msg.get('holdoverSec')):
+            return ntpdshm.LEAP_NOTINSYNC
+        return ntpdshm.LEAP_NOWARNING
+
+    def _precision_for(self, msg):
+        holdover_sec = msg.get('holdoverSec') or 0
+        # One step coarser for each doubling of the minutes spent in holdover
+        return min(_MAX_PRECISION, self._precision + int(holdover_sec // 60).bit_length())
+
+    def _update_direct(self, msg):
+        delivered = time.monotonic()
+        receive_time = None
+        if self._is_late(msg):
+            self._latency.record_output('shm', msg, delivered)
+            return
+        rx_time = msg.get('rxTime')
+        if rx_time is not None:
+            # Carry the monotonic arrival time over to the wall clock
+            receive_time = time.time() - (delivered - rx_time) - self._fudge_sec
+        self._shm.update(msg.get('time', None), receive_time, leap=self._leap(msg),
+                precision=self._precision_for(msg))
+        self._latency.record_output('shm', msg, delivered, time.monotonic())
+        self._sample_written('shm', msg)
 
     async def _writer(self):
         while self._running:
-            msg = await self._msg_queue.get()
+            msg = await self._sub.get()
+            delivered = time.monotonic()
 
             msg_type = msg.get('type', 'unknown')
-            if msg_type == 'sat':
-                pass
-            elif msg_type == 'gps':
-                self._shm.update(msg.get('time', None))
+            if msg_type == 'gps':
+                if self._is_late(msg):
+                    self._latency.record_output('shm', msg, delivered)
+                    continue
+                self._shm.update(msg.get('time', None), leap=self._leap(msg),
+                        precision=self._precision_for(msg))
+                self._latency.record_output('shm', msg, delivered, time.monotonic())
+                self._sample_written('shm', msg)
             else:
                 logging.debug('Unknown message type: {} (Message: {})'.format(msg_type, msg))
 
     def start(self, loop=asyncio.get_event_loop()):
         self._running = True
-        asyncio.ensure_future(self._writer(), loop=loop)
+        if not self._direct:
+            asyncio.ensure_future(self._writer(), loop=loop)
 
     def stop(self):
         self._running = False
-
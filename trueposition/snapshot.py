@@ -0,0 +1,222 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+A fixed-layout binary snapshot of the GPSDO state, published to a file that local
+processes map (put it under /dev/shm for POSIX shared memory), so that reading the
+state costs a memory copy rather than an HTTP request and a JSON parse.
+
+Everything is little-endian, at these offsets:
+
+    0   header  magic 'TPSNAP\\x00\\x01', u32 sequence, u16 layout version, u16 sat slots
+    16  body    SNAPSHOT_BODY (80 bytes, see below)
+    96  sats    SNAPSHOT_SAT (8 bytes) per sat slot, the first nrSats of them in use
+
+The sequence is a seqlock: the agent makes it odd before it rewrites the snapshot, and
+even again once it is done. A reader takes the sequence, copies the snapshot, and
+takes the sequence again; the copy is consistent if the sequence was even and did not
+change. SnapshotReader does this for Python; a C reader needs read barriers around the
+copy (the agent is the only writer).
+
+This module only uses the standard library, so readers can import it on its own.
+"""
+
+import math
+import mmap
+import os
+import struct
+import time
+
+SNAPSHOT_MAGIC = b'TPSNAP\x00\x01'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sIHH')
+_SEQUENCE = struct.Struct('<I')
+_SEQUENCE_OFFSET = 8
+
+# published (wall clock), unixEpoch (NaN until the first CLOCK), gpsEpoch (-1 until the
+# first CLOCK), state version, lat, lon, elevMetres, elevCorrWGS84, temperatureC, tdop,
+# holdoverSec, flags, leapSeconds, timeQuality, state, nrTrackedSats, nrSignals, nrSats
+SNAPSHOT_BODY = struct.Struct('<ddqQddffffiHhBbBBBxxx')
+# satId, slotId, el, snr, az
+SNAPSHOT_SAT = struct.Struct('<BBbBHxx')
+_SAT_FIELDS = ('satId', 'slotId', 'el', 'snr', 'az')
+SNAPSHOT_MAX_SATS = 32
+SNAPSHOT_SIZE = SNAPSHOT_HEADER.size + SNAPSHOT_BODY.size + SNAPSHOT_MAX_SATS * SNAPSHOT_SAT.size
+
+# Bits of the flags field
+FLAG_GOOD_FIX = 0x01
+FLAG_10MHZ_BAD = 0x02
+FLAG_PPS_BAD = 0x04
+FLAG_ANTENNA_BAD = 0x08
+FLAG_SURVEY = 0x10
+FLAG_BOOTED = 0x20
+# Some of the state was restored from a checkpoint, and is not yet confirmed
+FLAG_STALE = 0x40
+FLAG_LEAP_KNOWN = 0x80
+
+_FLAG_NAMES = [(FLAG_GOOD_FIX, 'goodFix'), (FLAG_10MHZ_BAD, 'tenMhzBad'), (FLAG_PPS_BAD, 'onePPSBad'),
+               (FLAG_ANTENNA_BAD, 'antennaBad'), (FLAG_SURVEY, 'isSurvey'), (FLAG_BOOTED, 'isBooted'),
+               (FLAG_STALE, 'isStale')]
+
+class SnapshotFormatError(Exception):
+    pass
+
+class SnapshotBusyError(Exception):
+    pass
+
+class TruePositionSnapshotWriter(object):
+    """
+    Publishes the state manager's state to the snapshot file at path, every time it
+    changes. Each publication is one pack and one copy into the mapping, bracketed by
+    the sequence updates. Satellites whose PRN does not fit the layout are left out.
+    """
+    def __init__(self, path):
+        self._path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SNAPSHOT_SIZE)
+            self._map = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+
+        # Carry on from the last run's sequence, so readers polling it see the change
+        magic, seq, _, _ = SNAPSHOT_HEADER.unpack_from(self._map, 0)
+        self._seq = (seq + 1) & ~1 if magic == SNAPSHOT_MAGIC else 0
+        SNAPSHOT_HEADER.pack_into(self._map, 0, SNAPSHOT_MAGIC, self._seq, SNAPSHOT_VERSION,
+                SNAPSHOT_MAX_SATS)
+        self.nr_published = 0
+
+    def publish(self, state, version=0):
+        """
+        Publish a state, as returned by TruePositionState.get_state(), and its version.
+        """
+        flags = 0
+        flags |= FLAG_GOOD_FIX if state['state'] == 0 else 0
+        flags |= FLAG_10MHZ_BAD if state['tenMhzBad'] else 0
+        flags |= FLAG_PPS_BAD if state['onePPSBad'] else 0
+        flags |= FLAG_ANTENNA_BAD if state['antennaBad'] else 0
+        flags |= FLAG_SURVEY if state['isSurvey'] else 0
+        flags |= FLAG_BOOTED if state['isBooted'] else 0
+        flags |= FLAG_STALE if state.get('staleFields') else 0
+        location = state['location']
+        ext = state['extParams']
+        self.publish_fields(version, state['unixEpoch'], state['gpsEpoch'], state['leapSeconds'],
+                state['timeQuality'], state['state'], state['holdoverSec'], location['lat'],
+                location['lon'], location['elevMetres'], location['elevCorrWGS84'],
+                ext['temperatureC'], ext['tdop'], state['nrTrackedSats'], ext['nrSignals'], flags,
+                [tuple(sat[field] for field in _SAT_FIELDS) for sat in state['trackedSats']])
+
+    def publish_fields(self, version, unix_epoch, gps_epoch, leap_seconds, quality, state,
+            holdover_sec, lat, lon, elev, elev_corr, temperature, tdop, nr_tracked_sats,
+            nr_signals, flags, sats):
+        """
+        Publish the state from its fields, as the state manager holds them, without
+        building the dict publish() takes. flags are the FLAG_ bits other than
+        FLAG_LEAP_KNOWN, and sats are (satId, slotId, el, snr, az) tuples.
+        """
+        if not self._map:
+            return
+        if isinstance(leap_seconds, int):
+            flags |= FLAG_LEAP_KNOWN
+        else:
+            leap_seconds = 0
+
+        snapshot = bytearray(SNAPSHOT_SIZE - SNAPSHOT_HEADER.size)
+        offset = SNAPSHOT_BODY.size
+        nr_sats = 0
+        for sat in sats:
+            if nr_sats == SNAPSHOT_MAX_SATS:
+                break
+            if not 0 <= sat[0] <= 255:
+                continue
+            SNAPSHOT_SAT.pack_into(snapshot, offset, *sat)
+            offset += SNAPSHOT_SAT.size
+            nr_sats += 1
+        SNAPSHOT_BODY.pack_into(snapshot, 0, time.time(),
+                math.nan if unix_epoch is None else unix_epoch,
+                gps_epoch if isinstance(gps_epoch, int) else -1,
+                version, lat, lon, elev, elev_corr, temperature, tdop, holdover_sec,
+                flags, leap_seconds, max(0, min(255, quality)), max(-128, min(127, state)),
+                min(255, nr_tracked_sats), min(255, nr_signals), nr_sats)
+
+        self._seq = (self._seq + 1) & 0xffffffff
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._seq)
+        self._map[SNAPSHOT_HEADER.size:] = snapshot
+        self._seq = (self._seq + 1) & 0xffffffff
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._seq)
+        self.nr_published += 1
+
+    def stop(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+class SnapshotReader(object):
+    """
+    Reads the snapshot published by the agent. read() returns a consistent copy, decoded
+    into a dict with the same names as the HTTP API uses; sequence is cheap to poll,
+    and changes whenever a new snapshot is published.
+    """
+    def __init__(self, path, max_retries=10000):
+        self._max_retries = max_retries
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+        magic, _, version, max_sats = SNAPSHOT_HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or max_sats != SNAPSHOT_MAX_SATS:
+            self._map.close()
+            raise SnapshotFormatError('{} is not a version {} state snapshot'.format(path,
+                SNAPSHOT_VERSION))
+        self.nr_retries = 0
+
+    @property
+    def sequence(self):
+        return _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+
+    def read_raw(self):
+        """
+        A consistent copy of the snapshot (everything after the header), and its sequence.
+        """
+        for attempt in range(self._max_retries):
+            seq = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+            if not seq & 1:
+                snapshot = self._map[SNAPSHOT_HEADER.size:]
+                if _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0] == seq:
+                    return seq, snapshot
+            self.nr_retries += 1
+            if attempt % 64 == 63:
+                # The agent must have been descheduled mid-update; let it finish
+                time.sleep(0)
+        raise SnapshotBusyError('Snapshot did not settle after {} tries'.format(self._max_retries))
+
+    def read(self):
+        seq, snapshot = self.read_raw()
+        (published, unix_epoch, gps_epoch, version, lat, lon, elev, elev_corr, temperature, tdop,
+         holdover_sec, flags, leap_seconds, quality, state, nr_tracked_sats, nr_signals,
+         nr_sats) = SNAPSHOT_BODY.unpack_from(snapshot, 0)
+        result = {'sequence': seq,
+                  'published': published,
+                  'unixEpoch': None if math.isnan(unix_epoch) else unix_epoch,
+                  'gpsEpoch': None if gps_epoch < 0 else gps_epoch,
+                  'version': version,
+                  'leapSeconds': leap_seconds if flags & FLAG_LEAP_KNOWN else None,
+                  'timeQuality': quality,
+                  'state': state,
+                  'holdoverSec': holdover_sec,
+                  'temperatureC': temperature,
+                  'tdop': tdop,
+                  'nrTrackedSats': nr_tracked_sats,
+                  'nrSignals': nr_signals,
+                  'location': {'lat': lat,
+                               'lon': lon,
+                               'elevMetres': elev,
+                               'elevCorrWGS84': elev_corr},
+                  'trackedSats': [dict(zip(_SAT_FIELDS, sat)) for sat in SNAPSHOT_SAT.iter_unpack(
+                      snapshot[SNAPSHOT_BODY.size:SNAPSHOT_BODY.size +
+                               min(nr_sats, SNAPSHOT_MAX_SATS) * SNAPSHOT_SAT.size])]}
+        for flag, name in _FLAG_NAMES:
+            result[name] = bool(flags & flag)
+        return result
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,123 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import errno
+import logging
+import socket
+import struct
+import time
+
+# struct sock_sample from chrony's refclock_sock.c: the local time of the sample
+# (a struct timeval), the offset of true time from it, the pulse flag, the leap
+# indicator, padding and the magic number
+SOCK_SAMPLE = struct.Struct('@lldiiii')
+SOCK_MAGIC = 0x534f434b
+
+# Leap indications understood by chrony
+SOCK_LEAP_NORMAL = 0
+SOCK_LEAP_INSERT = 1
+SOCK_LEAP_DELETE = 2
+
+def encode_sock_sample(receive_time, offset, leap=SOCK_LEAP_NORMAL, pulse=0):
+    tv_sec = int(receive_time // 1)
+    tv_usec = int(round((receive_time - tv_sec) * 1e6))
+    if tv_usec >= 1000000:
+        tv_sec += 1
+        tv_usec -= 1000000
+    return SOCK_SAMPLE.pack(tv_sec, tv_usec, offset, pulse, leap, 0, SOCK_MAGIC)
+
+def decode_sock_sample(data):
+    """
+    Unpack a sample into (receive_time, offset, pulse, leap). Raises ValueError if it
+    is not a chrony SOCK sample.
+    """
+    if len(data) != SOCK_SAMPLE.size:
+        raise ValueError('Sample is {} bytes, expected {}'.format(len(data), SOCK_SAMPLE.size))
+    tv_sec, tv_usec, offset, pulse, leap, _, magic = SOCK_SAMPLE.unpack(data)
+    if magic != SOCK_MAGIC:
+        raise ValueError('Bad sample magic: {:#x}'.format(magic))
+    return tv_sec + tv_usec / 1e6, offset, pulse, leap
+
+class TruePositionSockWriter(object):
+    """
+    Pushes time samples to chrony's SOCK refclock driver (refclock SOCK <path>) over a
+    Unix datagram socket. Samples are sent from within the $CLOCK handler, with no
+    queue in between, and are stamped with the time the sentence arrived at the UART,
+    less fudge_sec.
+
+    Unlike the SHM segment, which chrony polls and which keeps offering the last
+    sample, nothing is sent while the GPSDO does not have a good fix or has been in
+    holdover for more than max_holdover_sec, so chrony sees the source go quiet.
+
+    If chrony is not running (or not listening on path yet), samples are dropped, as
+    are samples that arrived while the event loop was stalled.
+    """
+    def __init__(self, path, loop=asyncio.get_event_loop(), fudge_sec=0.0, max_holdover_sec=0):
+        self._path = path
+        self._fudge_sec = fudge_sec
+        self._max_holdover_sec = max_holdover_sec
+        self._sub = None
+        self._latency = None
+        self._loop_monitor = None
+        self._sample_written = None
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._was_suppressed = None
+        self.nr_sent = 0
+        self.nr_suppressed = 0
+        self.nr_dropped = 0
+        self.nr_late = 0
+
+    def subscribe(self, bus):
+        self._sub = bus.subscribe('sock', types=['gps'], callback=self._send_sample)
+        self._latency = bus.latency
+        self._loop_monitor = bus.loop_monitor
+        self._sample_written = bus.sample_written
+        bus.time_outputs.add('sock')
+
+    def _suppress(self, msg):
+        suppress = not msg.get('goodFix') or (msg.get('holdoverSec') or 0) > self._max_holdover_sec
+        if suppress != self._was_suppressed:
+            if suppress:
+                logging.info('GPSDO is not locked, not sending samples to {}'.format(self._path))
+            elif self._was_suppressed is not None:
+                logging.info('GPSDO is locked, sending samples to {}'.format(self._path))
+            self._was_suppressed = suppress
+        return suppress
+
+    def _send_sample(self, msg):
+        delivered = time.monotonic()
+        clock_time = msg.get('time')
+        if clock_time is None:
+            return
+        if self._suppress(msg):
+            self.nr_suppressed += 1
+            return
+
+        rx_time = msg.get('rxTime', delivered)
+        if self._loop_monitor and self._loop_monitor.sample_is_late('sock', rx_time):
+            self.nr_late += 1
+            return
+        receive_time = time.time() - (delivered - rx_time) - self._fudge_sec
+        # CLOCK only ever reports the current GPS-UTC offset, so no leap is announced
+        sample = encode_sock_sample(receive_time, clock_time - receive_time)
+
+        try:
+            self._sock.sendto(sample, self._path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+                raise
+            self.nr_dropped += 1
+            return
+
+        self.nr_sent += 1
+        self._latency.record_output('sock', msg, delivered, time.monotonic())
+        self._sample_written('sock', msg)
+
+    def start(self, loop=asyncio.get_event_loop()):
+        pass
+
+    def stop(self):
+        self._sock.close()
@@ -3,18 +3,64 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 
 import asyncio
+import json
 import logging
+import time
+
+from .bus import DISCONNECT, TruePositionBus
+from .metrics import counter, gauge
+from .sat_table import SatelliteTable
+from .sentences import SentenceDispatcher, SentenceSchema
+from .snapshot import (FLAG_10MHZ_BAD, FLAG_ANTENNA_BAD, FLAG_BOOTED, FLAG_GOOD_FIX, FLAG_PPS_BAD,
+        FLAG_STALE, FLAG_SURVEY)
+
+def _microdegrees(field):
+    return float(field) / 1e6
+
+# Field layout of each sentence we understand. A schema of None means the handler
+# wants the raw sentence.
+SENTENCE_SCHEMAS = {
+    '$GETVER': None,
+    '$CLOCK': [('wallclock', int), ('leap_seconds', int), ('quality', int)],
+    '$SAT': [('channel', int), ('sat_id', int), ('el', int), ('az', int), ('snr', int)],
+    '$WSAT': None,
+    '$SURVEY': [('lat', _microdegrees), ('lon', _microdegrees), ('elev', float),
+                ('elev_corr', float), ('survey_secs', int)],
+    '$EXTSTATUS': [('survey', int), ('nr_sat_signals', int), ('tdop', float),
+                   ('temperature', float)],
+    '$GETPOS': [('lat', _microdegrees), ('lon', _microdegrees), ('elev', float),
+                ('elev_corr', float), ('state', int)],
+    '$STATUS': [('ten_mhz_bad', int), ('pps_bad', int), ('antenna_bad', int),
+                ('holdover_sec', int), ('nr_tracked_sats', int), ('state', int)],
+}
+
+# Bookkeeping carried on bus messages that clients have no use for
+_INTERNAL_FIELDS = frozenset(['type', 'rxTime', 'pubTime'])
+
+# Topics that can be followed as a stream of deltas (see TruePositionState.get_topic)
+STREAM_TOPICS = ['gps', 'sat', 'status', 'alarms']
 
 class TruePositionState(object):
-    def __init__(self, serial_proto, outputs=[]):
-        self._sats = {}
+    def __init__(self, serial_proto, outputs=[], latency_log_interval_sec=300, getpos_survey_sec=10,
+            getpos_min_sec=30, getpos_max_sec=960, checkpoint=None, telemetry=None,
+            snapshot=None, loop_monitor=None, direct=False):
+        self._sats = SatelliteTable()
         self._wallclock = {}
         self._leap_seconds = {}
         self._quality = 9
         self._active = False
         self._running = False
-        self._msg_queue = asyncio.Queue(loop=asyncio.get_event_loop())
+        self._msg_queue = asyncio.Queue()
         self._serial_proto = serial_proto
+        self._direct = direct
+        # Commands raised by sentences handled in direct mode, waiting to be sent
+        self._commands_due = []
+        # Sentences that raised somewhere past the dispatcher (e.g. in an output handed
+        # the fix directly), counted rather than let out into the UART read or the task
+        self.nr_message_errors = 0
+        self._getpos_survey_sec = getpos_survey_sec
+        self._getpos_min_sec = getpos_min_sec
+        self._getpos_max_sec = getpos_max_sec
         self._is_survey = False
         self._nr_sat_signals = 0
         self._tdop = 0.0
@@ -33,8 +79,106 @@ class TruePositionState(object):
         self._firmware_serial = None
         self._is_active = False
         self._in_bootloader = False
-        self._outputs = outputs
+        self._bus = TruePositionBus(loop_monitor=loop_monitor)
+        self._latency = self._bus.latency
+        self._latency_log_interval_sec = latency_log_interval_sec
+        self._outputs = []
+        for output in outputs:
+            self.add_output(output)
         self._survey_secs = 0
+        # Bumped by the handlers whenever any field changes, so that anything derived
+        # from the state (e.g. its JSON encoding) can be cached until the next change.
+        self._version = 0
+        self._last_deltas = {}
+        self._topic_encoders = {'gps': self._encode_gps_topic,
+                                'status': self._encode_status_topic,
+                                'alarms': self._encode_alarms_topic,}
+        self._dispatcher = SentenceDispatcher(default=self._default)
+        for tag, fields in SENTENCE_SCHEMAS.items():
+            handler = getattr(self, '_' + tag.lstrip('$').lower())
+            self.register_sentence(SentenceSchema(tag, fields), handler)
+        # Parts of the state put back from the checkpoint that the GPSDO has yet to confirm
+        self._stale = set()
+        self._checkpoint = checkpoint
+        self._telemetry = telemetry
+        self._snapshot = snapshot
+        if checkpoint:
+            saved = checkpoint.load()
+            if saved:
+                self.restore_checkpoint(saved)
+
+    def add_output(self, output):
+        """
+        Attach an output, which subscribes to the message types it cares about on the
+        state manager's bus.
+        """
+        output.subscribe(self._bus)
+        self._outputs.append(output)
+
+    def get_output_stats(self):
+        return self._bus.get_stats()
+
+    def register_sentence(self, schema, handler):
+        """
+        Register a handler for a sentence type. The handler is called with the fields
+        described by the schema, in order (or the raw sentence, for a raw schema). If it
+        returns a dict, that is published to the outputs.
+        """
+        self._dispatcher.register(schema, handler)
+
+    def get_sentence_stats(self):
+        return self._dispatcher.get_stats()
+
+    def get_checkpoint(self):
+        """
+        What is worth keeping across a restart, as restore_checkpoint() takes it. Parts
+        not yet known are left out.
+        """
+        checkpoint = {'trackedSats': self._sats.tracked()}
+        if self._geo != (0.0, 0.0):
+            checkpoint['location'] = {'lat': self._geo[0],
+                                      'lon': self._geo[1],
+                                      'elevMetres': self._elev,
+                                      'elevCorrWGS84': self._elev_corr,}
+        if self._leap_seconds != {}:
+            checkpoint['leapSeconds'] = self._leap_seconds
+        if self._firmware_version and self._firmware_serial:
+            checkpoint['firmwareVersion'] = self._firmware_version
+            checkpoint['firmwareSerial'] = self._firmware_serial
+        return checkpoint
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        Warm start from a checkpoint. Each part restored is flagged as stale (see
+        staleFields in the state) until the GPSDO reports it again.
+        """
+        location = checkpoint.get('location')
+        if location:
+            self._geo = (location['lat'], location['lon'])
+            self._elev = location['elevMetres']
+            self._elev_corr = location['elevCorrWGS84']
+            self._stale.add('location')
+        if 'leapSeconds' in checkpoint:
+            self._leap_seconds = checkpoint['leapSeconds']
+            self._stale.add('leapSeconds')
+        if 'firmwareVersion' in checkpoint:
+            self._firmware_version = checkpoint['firmwareVersion']
+            self._firmware_serial = checkpoint['firmwareSerial']
+            self._stale.add('firmware')
+        if checkpoint.get('trackedSats'):
+            self._sats.restore(checkpoint['trackedSats'])
+            self._stale.add('sats')
+        self._version += 1
+
+    def _confirm(self, part):
+        if part in self._stale:
+            logging.debug('GPSDO confirmed {}'.format(part))
+            self._stale.discard(part)
+            self._version += 1
+
+    def get_command_stats(self):
+        get_stats = getattr(self._serial_proto, 'get_command_stats', None)
+        return get_stats() if get_stats else None
 
     def _encode_state(self):
         state = {'gpsEpoch': self._wallclock,
@@ -54,11 +198,12 @@ class TruePositionState(object):
                  'onePPSBad' : self._1pps_bad,
                  'antennaBad' : self._antenna_bad,
                  'holdoverSec' : self._holdover_sec,
-                 'trackedSats' : [y for y in self._sats.values()],
+                 'trackedSats' : self._sats.tracked(),
                  'nrTrackedSats' : self._nr_tracked_sats,
                  'state' : self._state,
                  'firmwareVersion' : self._firmware_version,
-                 'firmwareSerial' : self._firmware_serial,}
+                 'firmwareSerial' : self._firmware_serial,
+                 'staleFields' : sorted(self._stale),}
 
         if self._is_survey:
             state['surveySeconds'] = self._survey_secs
@@ -67,89 +212,342 @@ class TruePositionState(object):
     def get_state(self):
         return self._encode_state()
 
+    @property
+    def version(self):
+        return self._version
+
+    def get_gps(self):
+        gps = self._encode_gps_topic()
+        gps['unixEpoch'] = self.epoch_time
+        return gps
+
+    def get_sats(self):
+        return {'trackedSats': self._sats.tracked(),
+                'nrTrackedSats': self._nr_tracked_sats,}
+
+    def get_status(self):
+        status = self._encode_status_topic()
+        status.update(self._encode_alarms_topic())
+        return status
+
+    def get_version(self):
+        return {'firmwareVersion': self._firmware_version,
+                'firmwareSerial': self._firmware_serial,
+                'isBooted': self._is_active,}
+
+    def get_metrics(self):
+        """
+        Metric families for the Prometheus endpoint, read straight from the state
+        attributes and the running counters kept by the dispatcher and the bus.
+        """
+        alarms = gauge('gpsagent_alarm', 'GPSDO alarm flags (1 = alarm raised)')
+        alarms.add(self._10mhz_bad, alarm='10mhz')
+        alarms.add(self._1pps_bad, alarm='1pps')
+        alarms.add(self._antenna_bad, alarm='antenna')
+
+        families = [gauge('gpsagent_holdover_seconds', 'Seconds the GPSDO has been in holdover',
+                          self._holdover_sec),
+                    gauge('gpsagent_temperature_celsius', 'GPSDO temperature', self._temperature),
+                    gauge('gpsagent_tdop', 'Time dilution of precision', self._tdop),
+                    gauge('gpsagent_tracked_satellites', 'Satellites the PLL is locked to',
+                          self._nr_tracked_sats),
+                    gauge('gpsagent_satellite_signals', 'Satellite signals visible',
+                          self._nr_sat_signals),
+                    gauge('gpsagent_time_quality', 'Time quality reported in CLOCK', self._quality),
+                    gauge('gpsagent_state', 'GPSDO state reported in STATUS (0 = locked)',
+                          self._state),
+                    gauge('gpsagent_survey', 'Whether a site survey is in progress', self._is_survey),
+                    gauge('gpsagent_booted', 'Whether the GPSDO is up and reporting', self._is_active),
+                    alarms]
+
+        sentences = counter('gpsagent_sentences_total', 'Sentences received, by type')
+        errors = counter('gpsagent_sentence_errors_total', 'Sentences that failed to parse')
+        parse_secs = counter('gpsagent_sentence_parse_seconds_total', 'Time spent parsing')
+        for tag, stats in self._dispatcher.iter_stats():
+            tag = tag.lstrip('$')
+            sentences.add(stats.count, tag=tag)
+            errors.add(stats.field_count_errors, tag=tag, kind='field_count')
+            errors.add(stats.type_errors, tag=tag, kind='type')
+            errors.add(stats.handler_errors, tag=tag, kind='handler')
+            parse_secs.add(stats.parse_secs, tag=tag)
+        errors.add(self._sats.nr_bad_channels, tag='SAT', kind='channel')
+        families += [sentences, errors, parse_secs]
+
+        depth = gauge('gpsagent_output_queue_depth', 'Messages waiting for an output')
+        dropped = counter('gpsagent_output_dropped_total', 'Messages an output dropped on overflow')
+        delivered = counter('gpsagent_output_delivered_total', 'Messages an output consumed')
+        for sub in self._bus.subscriptions():
+            if sub.transient:
+                continue
+            depth.add(len(sub), output=sub.name)
+            dropped.add(sub.nr_dropped, output=sub.name)
+            delivered.add(sub.nr_delivered, output=sub.name)
+        families += [depth, dropped, delivered,
+                     gauge('gpsagent_message_queue_depth', 'Sentences waiting for the state manager',
+                           self._msg_queue.qsize()),
+                     counter('gpsagent_message_errors_total', 'Sentences whose handling raised',
+                             self.nr_message_errors)]
+        families += self._latency.get_metrics()
+        return families
+
+    def get_latency_stats(self):
+        return self._latency.get_stats()
+
+    @property
+    def telemetry(self):
+        return self._telemetry
+
+    def get_sat_history(self, sat_id, window_sec):
+        return self._sats.history(sat_id, self._now() - window_sec)
+
+    def _now(self):
+        # Until the first CLOCK message we have no idea what GPS time it is
+        if self._wallclock == {}:
+            return time.time()
+        return self.epoch_time
+
     @property
     def epoch_time(self):
+        if self._wallclock == {}:
+            return None
         kGPS_EPOCH_DELTA = 315964800 - self._leap_seconds
         return kGPS_EPOCH_DELTA + self._wallclock
 
     def _encode_gps_state(self):
-        return {'time': self.epoch_time,
-                'nrTrackedSats': self._nr_tracked_sats,
-                'elevMetres': self._elev,
-                'latitude': self._geo[0],
-                'longitude': self._geo[1],
-                'geoidOffs': self._elev_corr,
-                'goodFix': self._state == 0,
-                'nrSats': self._nr_tracked_sats,
-                }
+        state = {'time': self.epoch_time,
+                 'nrTrackedSats': self._nr_tracked_sats,
+                 'elevMetres': self._elev,
+                 'latitude': self._geo[0],
+                 'longitude': self._geo[1],
+                 'geoidOffs': self._elev_corr,
+                 'goodFix': self._state == 0,
+                 'nrSats': self._nr_tracked_sats,
+                 'leapSeconds': self._leap_seconds,
+                 'holdoverSec': self._holdover_sec,
+                 'ppsBad': self._1pps_bad,
+                 }
+        # Only GSA and GSV need the satellites, and building the list costs a dict each
+        if self._bus.wants_tracked_sats:
+            state['trackedSats'] = self._sats.tracked()
+        return state
 
     def get_gps_state(self):
         return self._encode_gps_state()
 
+    def _encode_gps_topic(self):
+        return {'gpsEpoch': self._wallclock,
+                'leapSeconds': self._leap_seconds,
+                'timeQuality': self._quality,
+                'lat': self._geo[0],
+                'lon': self._geo[1],
+                'elevMetres': self._elev,
+                'elevCorrWGS84': self._elev_corr,}
+
+    def _encode_status_topic(self):
+        return {'isBooted': self._is_active,
+                'isSurvey': self._is_survey,
+                'surveySeconds': self._survey_secs,
+                'nrSignals': self._nr_sat_signals,
+                'tdop': self._tdop,
+                'temperatureC': self._temperature,
+                'holdoverSec': self._holdover_sec,
+                'nrTrackedSats': self._nr_tracked_sats,
+                'state': self._state,
+                'firmwareVersion': self._firmware_version,
+                'firmwareSerial': self._firmware_serial,}
+
+    def _encode_alarms_topic(self):
+        return {'tenMhzBad': self._10mhz_bad,
+                'onePPSBad': self._1pps_bad,
+                'antennaBad': self._antenna_bad,}
+
+    def get_topic(self, topic):
+        """
+        Full current value of a stream topic, to seed a new subscriber before it starts
+        receiving deltas.
+        """
+        if topic == 'sat':
+            return {'trackedSats': self._sats.tracked()}
+        return self._topic_encoders[topic]()
+
+    def subscribe_deltas(self, name, topics, maxlen=64, policy=DISCONNECT):
+        """
+        Subscribe to deltas for the given topics. Each message has the topic, the state
+        version and the JSON encoding of the fields that changed, under 'data'. By
+        default a subscriber that falls maxlen messages behind is cut off.
+        """
+        for topic in topics:
+            if topic in self._topic_encoders and not self._bus.has_subscribers('delta.' + topic):
+                # Nobody was following this topic, so the last delta sent is stale. Start
+                # again from what the new subscriber will be sent as its snapshot.
+                self._last_deltas[topic] = self._topic_encoders[topic]()
+        return self._bus.subscribe(name, types=['delta.' + topic for topic in topics],
+                maxlen=maxlen, policy=policy, transient=True)
+
+    def unsubscribe(self, sub):
+        self._bus.unsubscribe(sub)
+
+    def _publish_delta(self, topic, changes):
+        self._bus.publish({'type': 'delta.' + topic,
+                           'topic': topic,
+                           'version': self._version,
+                           'data': json.dumps(changes),})
+
+    def _publish_deltas(self, tp_msg):
+        """
+        Publish the fields that changed in each topic somebody is following. Only called
+        when the version moved, and the work is skipped for topics without subscribers.
+        """
+        if tp_msg and tp_msg.get('type') == 'sat' and self._bus.has_subscribers('delta.sat'):
+            changes = {k: v for k, v in tp_msg.items() if k not in _INTERNAL_FIELDS}
+            self._publish_delta('sat', changes)
+
+        for topic, encoder in self._topic_encoders.items():
+            msg_type = 'delta.' + topic
+            if not self._bus.has_subscribers(msg_type):
+                continue
+            current = encoder()
+            last = self._last_deltas.get(topic, {})
+            changes = {k: v for k, v in current.items() if k not in last or last[k] != v}
+            if changes:
+                self._last_deltas[topic] = current
+                self._publish_delta(topic, changes)
+
     async def enqueue_message(self, msg):
         """
         Helper function to enqueue a message to be consumed by the TruePosition state
         manager.
         """
-        await self._msg_queue.put(msg)
+        now = time.monotonic()
+        await self._msg_queue.put((msg, now, now))
+
+    def enqueue_message_nowait(self, msg, rx_time=None):
+        """
+        Enqueue a message without waiting, for use from synchronous callers such as the
+        UART framer. The message queue is unbounded, so this never fails. rx_time is the
+        time.monotonic() at which the bytes of the message arrived.
+        """
+        now = time.monotonic()
+        if rx_time is None:
+            rx_time = now
+        else:
+            self._latency.record('framing', now - rx_time)
+        self._msg_queue.put_nowait((msg, rx_time, now))
+
+    def receive_message(self, msg, rx_time=None):
+        """
+        Take a sentence from the UART framer. In direct mode, it is handled and published
+        to the outputs right away, in the framer's call stack; otherwise it is queued for
+        the message handler task.
+        """
+        # Anything that arrived before start() is still queued, and goes first
+        if not self._direct or not self._running or self._msg_queue.qsize():
+            self.enqueue_message_nowait(msg, rx_time)
+            return
+
+        now = time.monotonic()
+        if rx_time is None:
+            rx_time = now
+        else:
+            self._latency.record('framing', now - rx_time)
+        try:
+            commands = [cmd for cmd in self._handle_message(msg, rx_time, now)
+                        if cmd not in self._commands_due]
+        except Exception:
+            self.nr_message_errors += 1
+            logging.exception('Failed to handle [{}]'.format(msg))
+            return
+        if commands and not self._commands_due:
+            asyncio.ensure_future(self._send_due_commands())
+        self._commands_due.extend(commands)
+
+    async def _send_due_commands(self):
+        while self._commands_due:
+            await self._serial_proto.enqueue_command(self._commands_due.pop(0))
 
     def _getver(self, msg):
         if 'BOOT' in msg:
             self._in_bootloader = True
             self._is_active = False
+            self._version += 1
             return
 
         logging.debug('GETVER: [{}]'.format(msg))
         fields = msg.split(' ')
+        if len(fields) < 7:
+            logging.debug('Short GETVER response, ignoring')
+            return
         self._firmware_version = fields[1]
         self._firmware_serial = fields[6]
         self._is_active = True
+        self._version += 1
+        self._confirm('firmware')
 
-    def _clock(self, msg):
+    def _clock(self, wallclock, leap_seconds, quality):
+        if (True, wallclock, leap_seconds, quality) != (self._is_active, self._wallclock,
+                self._leap_seconds, self._quality):
+            self._version += 1
         self._is_active = True
-        fields = msg.split(' ')
-        self._wallclock = int(fields[1])
-        self._leap_seconds = int(fields[2])
-        self._quality = int(fields[3])
-
-    def _sat(self, msg):
+        self._wallclock = wallclock
+        self._leap_seconds = leap_seconds
+        self._quality = quality
+        self._confirm('leapSeconds')
+
+        if self._telemetry:
+            # Once a second is plenty, and CLOCK is what arrives once a second
+            self._telemetry.record(self.epoch_time, self._holdover_sec, self._temperature,
+                    self._tdop, self._nr_tracked_sats, self._nr_sat_signals, self._10mhz_bad,
+                    self._1pps_bad, self._antenna_bad, self._state)
+
+        # A clock message needs to be converted to an NMEA sentence
+        clock_state = self.get_gps_state()
+        clock_state['type'] = 'gps'
+        return clock_state
+
+    def _sat(self, channel, sat_id, el, az, snr):
         self._is_active = True
-        fields = msg.split(' ')
-        channel = int(fields[1])
-
-        sat_info = {'satId': int(fields[2]),
-                    'el': int(fields[3]),
-                    'az': int(fields[4]),
-                    'snr' : int(fields[5]),
-                    'lastSeen' : self.epoch_time,
-                    'slotId': channel,}
-        self._sats[channel] = sat_info
-        return sat_info
+        when = self._now()
+        if not self._sats.update(channel, sat_id, el, az, snr, when):
+            return None
+        self._version += 1
+        self._confirm('sats')
+
+        # Send out the updated satellite data
+        return {'satId': sat_id,
+                'el': el,
+                'az': az,
+                'snr' : snr,
+                'lastSeen' : when,
+                'slotId': channel,
+                'type': 'sat',}
 
     def _wsat(self, msg):
+        if not self._is_active:
+            self._version += 1
         self._is_active = True
 
     def _default(self, msg):
         logging.info('UNKNOWN MSG: [{}]'.format(msg))
 
-    def _survey(self, msg):
+    def _survey(self, lat, lon, elev, elev_corr, survey_secs):
+        if (True, lat, lon, elev, elev_corr, survey_secs) != (self._is_active, self._geo[0],
+                self._geo[1], self._elev, self._elev_corr, self._survey_secs):
+            self._version += 1
         self._is_active = True
-        fields = msg.split(' ')
-        lat = float(fields[1])/1e6
-        lon = float(fields[2])/1e6
-        self._elev = float(fields[3])
-        self._elev_corr = float(fields[4])
-        self._survey_secs = int(fields[5])
+        self._elev = elev
+        self._elev_corr = elev_corr
+        self._survey_secs = survey_secs
         self._geo = (lat, lon)
+        self._confirm('location')
 
-
-    def _extstatus(self, msg):
+    def _extstatus(self, survey, nr_sat_signals, tdop, temperature):
+        is_survey = survey == 1
+        if (True, is_survey, nr_sat_signals, tdop, temperature) != (self._is_active,
+                self._is_survey, self._nr_sat_signals, self._tdop, self._temperature):
+            self._version += 1
         self._is_active = True
-        fields = msg.split(' ')
-        is_survey = int(fields[1]) == 1
-        nr_sat_signals = int(fields[2])
-        self._tdop = float(fields[3])
-        self._temperature = float(fields[4])
+        self._tdop = tdop
+        self._temperature = temperature
 
         if is_survey != self._is_survey:
             if is_survey:
@@ -161,25 +559,26 @@ class TruePositionState(object):
         self._is_survey = is_survey
         self._nr_sat_signals = nr_sat_signals
 
-    def _getpos(self, msg):
+    def _getpos(self, lat, lon, elev, elev_corr, state):
+        if (True, lat, lon, elev, elev_corr) != (self._is_active, self._geo[0], self._geo[1],
+                self._elev, self._elev_corr):
+            self._version += 1
         self._is_active = True
-        fields = msg.split(' ')
-        lat = float(fields[1])/1e6
-        lon = float(fields[2])/1e6
-        self._elev = float(fields[3])
-        self._elev_corr = float(fields[4])
-        state = int(fields[5])
+        self._elev = elev
+        self._elev_corr = elev_corr
         self._geo = (lat, lon)
-
-    def _status(self, msg):
+        self._confirm('location')
+
+    def _status(self, ten_mhz_bad, pps_bad, antenna_bad, holdover_sec, nr_tracked_sats, state):
+        ten_mhz_bad = ten_mhz_bad != 0
+        pps_bad = pps_bad != 0
+        antenna_bad = antenna_bad != 0
+        if (True, ten_mhz_bad, pps_bad, antenna_bad, holdover_sec, nr_tracked_sats, state) != \
+                (self._is_active, self._10mhz_bad, self._1pps_bad, self._antenna_bad,
+                 self._holdover_sec, self._nr_tracked_sats, self._state):
+            self._version += 1
         self._is_active = True
-        fields = msg.split(' ')
-        ten_mhz_bad = int(fields[1]) != 0
-        pps_bad = int(fields[2]) != 0
-        antenna_bad = int(fields[3]) != 0
-        self._holdover_sec = int(fields[4])
-        nr_tracked_sats = int(fields[5])
-        state = int(fields[6])
+        self._holdover_sec = holdover_sec
 
         # Catch various state changes
         if ten_mhz_bad != self._10mhz_bad:
@@ -213,12 +612,75 @@ class TruePositionState(object):
         self._state = state
 
     async def _request_location_update(self):
+        """
+        Poll the position with GETPOS: often while a survey is refining it, and then less
+        and less often (down to once every getpos_max_sec) for as long as it holds still.
+        A position restored from a checkpoint is confirmed as soon as the GPSDO is up.
+        """
         logging.debug('Starting location request update tracker')
+        interval = 1 if 'location' in self._stale else self._getpos_min_sec
+        last_position = None
         while self._running:
-            await asyncio.sleep(30)
-            if self._is_active:
-                # Send a GETPOS command to update our internal view of the position
-                await self._serial_proto.enqueue_command('$GETPOS')
+            await asyncio.sleep(interval)
+            if not self._is_active:
+                continue
+
+            # Send a GETPOS command to update our internal view of the position
+            await self._serial_proto.enqueue_command('$GETPOS')
+
+            position = (self._geo, self._elev, self._elev_corr)
+            if self._is_survey:
+                interval = self._getpos_survey_sec
+            elif position == last_position:
+                interval = min(interval * 2, self._getpos_max_sec)
+            else:
+                interval = self._getpos_min_sec
+            last_position = position
+
+    def _publish_snapshot(self):
+        # Packed straight from the fields, as this runs for every change, SATs included
+        flags = ((FLAG_GOOD_FIX if self._state == 0 else 0) |
+                 (FLAG_10MHZ_BAD if self._10mhz_bad else 0) |
+                 (FLAG_PPS_BAD if self._1pps_bad else 0) |
+                 (FLAG_ANTENNA_BAD if self._antenna_bad else 0) |
+                 (FLAG_SURVEY if self._is_survey else 0) |
+                 (FLAG_BOOTED if self._is_active else 0) |
+                 (FLAG_STALE if self._stale else 0))
+        self._snapshot.publish_fields(self._version, self.epoch_time, self._wallclock,
+                self._leap_seconds, self._quality, self._state, self._holdover_sec, self._geo[0],
+                self._geo[1], self._elev, self._elev_corr, self._temperature, self._tdop,
+                self._nr_tracked_sats, self._nr_sat_signals, flags, self._sats.iter_tracked())
+
+    def _handle_message(self, msg, rx_time, queued):
+        """
+        Update the state from a message and publish the result. Returns the commands to
+        send the GPSDO in response.
+        """
+        if (msg[0] != '$'):
+            logging.debug('Invalid sentence: missing $: [{}]'.format(msg))
+
+        version = self._version
+        tp_msg = self._dispatcher.dispatch(msg)
+        if tp_msg:
+            tp_msg['rxTime'] = rx_time
+            tp_msg['pubTime'] = time.monotonic()
+            self._latency.record('dispatch', tp_msg['pubTime'] - queued)
+            self._bus.publish(tp_msg)
+        if version != self._version:
+            self._publish_deltas(tp_msg)
+            if self._snapshot:
+                self._publish_snapshot()
+
+        commands = []
+        if self._in_bootloader:
+            logging.info('Device is in bootloader, booting.')
+            commands.append('$PROCEED')
+            self._in_bootloader = False
+        if self._is_active and (not self._firmware_serial or not self._firmware_version or
+                'firmware' in self._stale):
+            logging.debug('Querying for the firmware version')
+            commands.append('$GETVER')
+        return commands
 
     async def _handle_messages(self):
         """
@@ -227,56 +689,44 @@ class TruePositionState(object):
         """
         logging.debug('Starting TruePosition message handler')
         while self._running:
-            msg = await self._msg_queue.get()
-            if (msg[0] != '$'):
-                logging.debug('Invalid sentence: missing $: [{}]'.format(msg))
-            if msg.startswith('$GETVER'):
-                resp = self._getver(msg)
-                if resp:
-                    await self._serial_proto.enqueue_command(resp)
-            elif msg.startswith('$CLOCK'):
-                self._clock(msg)
-                # A clock message needs to be converted to an NMEA sentence
-                clock_state = self.get_gps_state()
-                clock_state['type'] = 'gps'
-                for o in self._outputs:
-                    await o.enqueue_tp_message(clock_state)
-            elif msg.startswith('$SAT'):
-                sat_info = self._sat(msg)
-                # Send out the updated satellite data
-                sat_info['type'] = 'sat'
-                for o in self._outputs:
-                    await o.enqueue_tp_message(sat_info)
-
-            elif msg.startswith('$WSAT'):
-                self._wsat(msg)
-            elif msg.startswith('$SURVEY'):
-                self._survey(msg)
-            elif msg.startswith('$EXTSTATUS'):
-                self._extstatus(msg)
-            elif msg.startswith('$GETPOS'):
-                self._getpos(msg)
-            elif msg.startswith('$STATUS'):
-                self._status(msg)
-            else:
-                self._default(msg)
-
-            if self._in_bootloader:
-                logging.info('Device is in bootloader, booting.')
-                await self._serial_proto.enqueue_command('$PROCEED')
-                self._in_bootloader = False
-            if self._is_active and (not self._firmware_serial or not self._firmware_version):
-                logging.debug('Querying for the firmware version')
-                await self._serial_proto.enqueue_command('$GETVER')
+            msg, rx_time, queued = await self._msg_queue.get()
+            try:
+                commands = self._handle_message(msg, rx_time, queued)
+            except Exception:
+                self.nr_message_errors += 1
+                logging.exception('Failed to handle [{}]'.format(msg))
+                continue
+            for cmd in commands:
+                await self._serial_proto.enqueue_command(cmd)
 
         logging.debug('Shutting down handling loop')
 
+    async def _log_latency(self):
+        while self._running:
+            await asyncio.sleep(self._latency_log_interval_sec)
+            self._latency.log_summary()
+
     def start(self, loop=asyncio.get_event_loop()):
         self._running = True
         asyncio.ensure_future(self._handle_messages(), loop=loop)
         asyncio.ensure_future(self._request_location_update(), loop=loop)
+        if self._latency_log_interval_sec:
+            asyncio.ensure_future(self._log_latency(), loop=loop)
+        if self._checkpoint:
+            self._checkpoint.start(self, loop=loop)
+        if self._telemetry:
+            self._telemetry.start(loop=loop)
+        if self._snapshot:
+            # Readers get whatever was restored from the checkpoint straight away
+            self._publish_snapshot()
         logging.debug('Done startup of TruePosition state tracker')
 
     def stop(self):
         self._running = False
+        if self._checkpoint:
+            self._checkpoint.stop()
+        if self._telemetry:
+            self._telemetry.stop()
+        if self._snapshot:
+            self._snapshot.stop()
 
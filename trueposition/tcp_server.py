@@ -0,0 +1,250 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import json
+import logging
+import socket
+import time
+
+from .bus import COALESCE, DISCONNECT, DROP_NEWEST
+from .nmea import NMEAEncoder
+
+TCP_PROTOCOLS = ['nmea', 'gpsd']
+TCP_SLOW_POLICIES = [DROP_NEWEST, DISCONNECT]
+
+# What we tell gpsd clients we are; proto 3.11 is what gpsd 3.17 and later speak
+GPSD_VERSION = {'class': 'VERSION', 'release': '3.17', 'rev': 'gpsagent', 'proto_major': 3,
+                'proto_minor': 11}
+
+# Clients only ever send short commands, so anything longer is not a gpsd client
+_MAX_COMMAND_LEN = 4096
+
+def _iso_time(when):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when)) + '.{:03d}Z'.format(
+            int((when % 1) * 1000))
+
+def encode_tpv(msg, device):
+    """
+    A gpsd TPV (time-position-velocity) report for a GPS message.
+    """
+    elev = msg.get('elevMetres', 0)
+    geoid = msg.get('geoidOffs', 0)
+    tpv = {'class': 'TPV',
+           'device': device,
+           'mode': 3 if msg.get('goodFix', False) else 1,
+           'lat': msg.get('latitude', 0),
+           'lon': msg.get('longitude', 0),
+           'alt': elev,
+           'altMSL': elev,
+           'altHAE': elev + geoid,
+           'geoidSep': geoid,}
+    if msg.get('time') is not None:
+        tpv['time'] = _iso_time(msg['time'])
+    if isinstance(msg.get('leapSeconds'), int):
+        tpv['leapseconds'] = msg['leapSeconds']
+    return tpv
+
+class _TCPClient(asyncio.Protocol):
+    """
+    A connected client. The transport's write buffer is the client's buffer: once it
+    is over the server's limit, asyncio pauses us and the client counts as slow.
+    """
+    def __init__(self, server):
+        self._server = server
+        self.transport = None
+        self.paused = False
+        self.peer = None
+        # What the client has asked for; raw NMEA clients get NMEA from the start
+        self.watch_json = False
+        self.watch_nmea = server.protocol == 'nmea'
+        self._command = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        if not self._server._add_client(self):
+            transport.close()
+            return
+        # Bound what the kernel holds for the client too, or a stalled client could
+        # soak up megabytes of autotuned socket buffer before it ever counts as slow
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._server.max_client_buffer)
+        transport.set_write_buffer_limits(high=self._server.max_client_buffer)
+        if self._server.protocol == 'gpsd':
+            self.send_json(GPSD_VERSION)
+
+    def connection_lost(self, exc):
+        self._server._remove_client(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def send_json(self, obj):
+        self.transport.write(json.dumps(obj).encode('utf-8') + b'\r\n')
+
+    def data_received(self, data):
+        if self._server.protocol != 'gpsd':
+            return
+        self._command += data
+        while True:
+            end = self._command.find(b';')
+            if end < 0:
+                break
+            command = bytes(self._command[:end]).decode('ascii', 'replace').strip()
+            del self._command[:end + 1]
+            self._server._handle_command(self, command)
+        if len(self._command) > _MAX_COMMAND_LEN:
+            logging.info('Dropping gpsd client {} sending junk'.format(self.peer))
+            self.transport.close()
+
+class TruePositionTCPServer(object):
+    """
+    Serves the GPS fix to remote clients over TCP, either as a raw NMEA stream (RMC and
+    GGA for every fix), or speaking enough of the gpsd protocol for gpsd clients to
+    ?WATCH for TPV reports (or NMEA) and ?POLL the latest fix.
+
+    Each fix is formatted once, and the same bytes are handed to every client's
+    transport, whose write buffer is capped at max_client_buffer. A client that
+    falls behind by more than that is either skipped until it catches up
+    (drop-newest) or disconnected (disconnect). At most max_clients are served at
+    once. Since handing bytes to a transport never blocks, in direct mode each fix is
+    sent from within the handler that published it.
+    """
+    def __init__(self, port, loop=asyncio.get_event_loop(), host='localhost', protocol='nmea',
+            device='gpsagent', max_clients=256, max_client_buffer=16384, slow_policy=DROP_NEWEST,
+            queue_len=4, direct=False):
+        if protocol not in TCP_PROTOCOLS:
+            raise ValueError('Unknown TCP protocol: {}'.format(protocol))
+        if slow_policy not in TCP_SLOW_POLICIES:
+            raise ValueError('Unknown slow client policy: {}'.format(slow_policy))
+        self.protocol = protocol
+        self.max_client_buffer = max_client_buffer
+        self._port = port
+        self._host = host
+        self._device = device
+        self._max_clients = max_clients
+        self._slow_policy = slow_policy
+        self._queue_len = queue_len
+        self._direct = direct
+        self._sub = None
+        self._latency = None
+        self._server = None
+        self._clients = set()
+        self._encoder = NMEAEncoder()
+        self._last_tpv = None
+        self._started = time.time()
+        self.nr_rejected = 0
+        self.nr_dropped = 0
+        self.nr_disconnected = 0
+
+    def subscribe(self, bus):
+        name = 'tcp-{}'.format(self._port)
+        if self._direct:
+            self._sub = bus.subscribe(name, types=['gps'], callback=self._deliver)
+        else:
+            # Like the NMEA files, remote clients only care about the latest fix
+            self._sub = bus.subscribe(name, types=['gps'], maxlen=self._queue_len, policy=COALESCE)
+        self._latency = bus.latency
+
+    def _add_client(self, client):
+        if len(self._clients) >= self._max_clients:
+            logging.info('Refusing {} client {}: too many clients'.format(self.protocol, client.peer))
+            self.nr_rejected += 1
+            return False
+        logging.debug('New {} client {}'.format(self.protocol, client.peer))
+        self._clients.add(client)
+        return True
+
+    def _remove_client(self, client):
+        self._clients.discard(client)
+
+    def _handle_command(self, client, command):
+        name, _, arg = command.partition('=')
+        if name == '?WATCH':
+            try:
+                watch = json.loads(arg) if arg else {}
+            except ValueError:
+                client.send_json({'class': 'ERROR', 'message': 'Invalid WATCH: {}'.format(arg)})
+                return
+            enable = watch.get('enable', True)
+            client.watch_json = enable and watch.get('json', not watch.get('nmea', False))
+            client.watch_nmea = enable and watch.get('nmea', False)
+            client.send_json(self._encode_devices())
+            client.send_json({'class': 'WATCH', 'enable': enable, 'json': client.watch_json,
+                              'nmea': client.watch_nmea})
+        elif name == '?POLL':
+            client.send_json({'class': 'POLL', 'time': _iso_time(time.time()),
+                              'active': 1 if self._last_tpv else 0,
+                              'tpv': [self._last_tpv] if self._last_tpv else [],
+                              'sky': []})
+        elif name == '?VERSION':
+            client.send_json(GPSD_VERSION)
+        elif name == '?DEVICES':
+            client.send_json(self._encode_devices())
+        else:
+            client.send_json({'class': 'ERROR', 'message': "Unrecognized request '{}'".format(name)})
+
+    def _encode_devices(self):
+        return {'class': 'DEVICES',
+                'devices': [{'class': 'DEVICE', 'path': self._device, 'driver': 'TruePosition',
+                             'activated': _iso_time(self._started)}]}
+
+    def _broadcast(self, parts, wants):
+        for client in list(self._clients):
+            if not wants(client):
+                continue
+            if client.paused:
+                if self._slow_policy == DISCONNECT:
+                    logging.info('Disconnecting slow {} client {}'.format(self.protocol, client.peer))
+                    self.nr_disconnected += 1
+                    client.transport.abort()
+                else:
+                    self.nr_dropped += 1
+                continue
+            client.transport.writelines(parts)
+
+    def _send_fix(self, msg):
+        nmea = None
+        if any(client.watch_nmea for client in self._clients):
+            nmea = [self._encoder.rmc(msg), self._encoder.gga(msg)]
+            self._broadcast(nmea, lambda client: client.watch_nmea)
+
+        if self.protocol == 'gpsd':
+            self._last_tpv = encode_tpv(msg, self._device)
+            if any(client.watch_json for client in self._clients):
+                tpv = [json.dumps(self._last_tpv).encode('utf-8'), b'\r\n']
+                self._broadcast(tpv, lambda client: client.watch_json)
+
+    def _deliver(self, msg):
+        delivered = time.monotonic()
+        if msg.get('type', 'unknown') != 'gps':
+            return
+        self._send_fix(msg)
+        self._latency.record_output(self._sub.name, msg, delivered, time.monotonic())
+
+    async def _writer(self):
+        while self._running:
+            self._deliver(await self._sub.get())
+
+    async def _serve(self, loop):
+        self._server = await loop.create_server(lambda: _TCPClient(self), self._host, self._port)
+        logging.debug('Serving {} on {}:{}'.format(self.protocol, self._host, self._port))
+
+    def start(self, loop=asyncio.get_event_loop()):
+        self._running = True
+        asyncio.ensure_future(self._serve(loop), loop=loop)
+        if not self._direct:
+            asyncio.ensure_future(self._writer(), loop=loop)
+
+    def stop(self):
+        self._running = False
+        if self._server:
+            self._server.close()
+        for client in list(self._clients):
+            client.transport.close()
@@ -0,0 +1,171 @@
+# Copyright (c) 2018 Phil Vachon <phil@security-embedded.com>
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+import asyncio
+import concurrent.futures
+import logging
+import mmap
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A telemetry file is this header (magic, number of records, record size), followed by
+# a fixed number of records, one per second of GPS time. The record for second t lives
+# in slot t % capacity, so the file never grows, a range of time is a range of slots,
+# and a slot holding any other second is simply out of date.
+TELEMETRY_MAGIC = b'TPTLM\x00\x01\x00'
+TELEMETRY_HEADER = struct.Struct('<8sII')
+# time, holdoverSec, temperatureC, tdop, nrTrackedSats, nrSignals, tenMhzBad, onePPSBad,
+# antennaBad, state, then padding to keep records 8-byte aligned
+TELEMETRY_RECORD = struct.Struct('<IiffBBBBBbxx')
+
+# The fields of a record that can be queried, in record order
+TELEMETRY_FIELDS = ['holdoverSec', 'temperatureC', 'tdop', 'nrTrackedSats', 'nrSignals',
+                    'tenMhzBad', 'onePPSBad', 'antennaBad', 'state']
+
+if numpy:
+    TELEMETRY_DTYPE = numpy.dtype([('time', '<u4'), ('holdoverSec', '<i4'),
+        ('temperatureC', '<f4'), ('tdop', '<f4'), ('nrTrackedSats', 'u1'), ('nrSignals', 'u1'),
+        ('tenMhzBad', 'u1'), ('onePPSBad', 'u1'), ('antennaBad', 'u1'), ('state', 'i1'),
+        ('pad', 'V2')])
+
+class TelemetryFormatError(Exception):
+    pass
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+class TruePositionTelemetry(object):
+    """
+    One sample per second of the GPSDO's health (holdover, temperature, TDOP, satellites,
+    alarms and state), kept in a memory-mapped ring of fixed-size records. The file is
+    sized for capacity seconds up front, so months of history take a known amount of
+    disk, and survives restarts of the agent.
+
+    Recording a sample is a struct packed into the mapping, which is flushed to disk
+    every flush_interval_sec on a thread of its own, so the msync never holds up the
+    event loop. Range queries are downsampled to min/max/mean per bucket, vectorized
+    with NumPy over the mapping (queries need NumPy; recording does not).
+    """
+    def __init__(self, path, capacity=90 * 86400, flush_interval_sec=60):
+        self._path = path
+        self._flush_interval_sec = flush_interval_sec
+        self._running = False
+        self._loop = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.nr_samples = 0
+
+        size = TELEMETRY_HEADER.size + capacity * TELEMETRY_RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.fstat(fd).st_size
+            if existing:
+                magic, file_capacity, record_size = TELEMETRY_HEADER.unpack(
+                        os.pread(fd, TELEMETRY_HEADER.size, 0))
+                if magic != TELEMETRY_MAGIC or record_size != TELEMETRY_RECORD.size:
+                    raise TelemetryFormatError('{} is not a telemetry file'.format(path))
+                if file_capacity != capacity or existing != size:
+                    raise TelemetryFormatError('{} holds {} seconds of telemetry, not {}; '
+                        'move it aside to start a new one'.format(path, file_capacity, capacity))
+            else:
+                # Sparse, so the disk is only used as the history fills in
+                os.ftruncate(fd, size)
+                os.pwrite(fd, TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, capacity,
+                    TELEMETRY_RECORD.size), 0)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+
+    @property
+    def can_query(self):
+        return numpy is not None
+
+    def record(self, when, holdover_sec, temperature, tdop, nr_tracked_sats, nr_signals,
+            ten_mhz_bad, pps_bad, antenna_bad, state):
+        when = int(when)
+        offset = TELEMETRY_HEADER.size + (when % self.capacity) * TELEMETRY_RECORD.size
+        TELEMETRY_RECORD.pack_into(self._map, offset, when, holdover_sec, temperature, tdop,
+                _clamp(nr_tracked_sats, 0, 255), _clamp(nr_signals, 0, 255), ten_mhz_bad,
+                pps_bad, antenna_bad, _clamp(state, -128, 127))
+        self.nr_samples += 1
+
+    def _column(self, records, field, segments, valid):
+        return numpy.concatenate([records[field][lo:hi] for lo, hi in segments])[valid]
+
+    def query(self, start, end, bucket_sec=60):
+        """
+        Samples from start to end (in seconds since the epoch, inclusive), grouped into
+        buckets of bucket_sec. Returns the start time and number of samples of each
+        non-empty bucket, and the min, max and mean of each field over the bucket, as
+        columns.
+        """
+        start = int(start)
+        end = int(end)
+        bucket_sec = max(1, int(bucket_sec))
+        # Anything older than the ring has been overwritten, and time 0 marks an empty slot
+        start = max(start, end - self.capacity + 1, 1)
+
+        result = {'start': start, 'end': end, 'bucketSec': bucket_sec, 'time': [],
+                  'count': [], 'fields': {}}
+        if end < start:
+            return result
+
+        # The slots for the range, as at most two runs either side of the end of the ring
+        first = start % self.capacity
+        nr_slots = end - start + 1
+        segments = [(first, min(first + nr_slots, self.capacity))]
+        if first + nr_slots > self.capacity:
+            segments.append((0, first + nr_slots - self.capacity))
+
+        records = numpy.frombuffer(self._map, dtype=TELEMETRY_DTYPE, count=self.capacity,
+                offset=TELEMETRY_HEADER.size)
+        times = numpy.concatenate([records['time'][lo:hi] for lo, hi in segments])
+        valid = (times >= start) & (times <= end)
+        times = times[valid]
+        if not len(times):
+            return result
+
+        # Slots are in time order, so each bucket is a run of consecutive samples. Buckets
+        # line up with multiples of bucket_sec, so they stay put from one query to the next.
+        buckets = times // bucket_sec
+        edges = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        counts = numpy.diff(numpy.append(edges, len(times)))
+        result['time'] = (buckets[edges] * bucket_sec).tolist()
+        result['count'] = counts.tolist()
+
+        for field in TELEMETRY_FIELDS:
+            column = self._column(records, field, segments, valid)
+            if column.dtype.kind == 'f':
+                column = column.astype(numpy.float64)
+            result['fields'][field] = {
+                'min': numpy.round(numpy.minimum.reduceat(column, edges), 3).tolist(),
+                'max': numpy.round(numpy.maximum.reduceat(column, edges), 3).tolist(),
+                'mean': numpy.round(numpy.add.reduceat(column, edges, dtype=numpy.float64) / counts,
+                    3).tolist(),}
+        return result
+
+    async def _flusher(self):
+        while self._running:
+            await asyncio.sleep(self._flush_interval_sec)
+            if self._running:
+                await self._loop.run_in_executor(self._executor, self._map.flush)
+
+    def start(self, loop=asyncio.get_event_loop()):
+        self._loop = loop
+        self._running = True
+        asyncio.ensure_future(self._flusher(), loop=loop)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        # Shutting down, so it is fine to block: let a flush in progress finish first
+        self._executor.shutdown(wait=True)
+        self._map.flush()
+        logging.debug('Recorded {} telemetry samples to {}'.format(self.nr_samples, self._path))
@@ -4,22 +4,31 @@
 
 import asyncio
 import logging
-import serial_asyncio
+
+from .capture import ReplayTransport
+from .commands import TruePositionCommandScheduler
+from .framer import TruePositionFramer
 
 class TruePositionUART(asyncio.Protocol):
     def connection_made(self, transport):
         logging.debug('Connected to {}'.format(transport))
         self._transport = transport
-        self._cur = ''
-        self._messages = []
-        self._cmd_queue = asyncio.Queue(loop=asyncio.get_event_loop())
+        self._framer = TruePositionFramer(self._sentence_received)
+        self._commands = TruePositionCommandScheduler()
         self._running = False
         self._tpstate = None
+        self._capture = None
 
     def set_trueposition_state(self, state):
         logging.debug('Setting TruePosition state to [{}]'.format(state))
         self._tpstate = state
 
+    def set_capture(self, capture):
+        """
+        Record everything read from the UART to the given capture writer.
+        """
+        self._capture = capture
+
     async def _send_queued_messages(self):
         """
         Green thread for sending queued messages to the device, from the TruePosition
@@ -27,30 +36,28 @@ class TruePositionUART(asyncio.Protocol):
         """
         logging.debug('Starting TruePosition UART Protocol Sender')
         while self._running:
-            msg = await self._cmd_queue.get()
-            logging.debug('SEND: [{}]'.format(msg))
-            self._transport.write(bytearray(msg + '\r\n', 'utf-8'))
-            await asyncio.sleep(1.0)
+            msg = await self._commands.next()
+            await self._commands.send(msg, self._write_command)
 
-    async def enqueue_command(self, msg):
-        await self._cmd_queue.put(msg)
+    def _write_command(self, msg):
+        logging.debug('SEND: [{}]'.format(msg))
+        self._transport.write(bytearray(msg + '\r\n', 'utf-8'))
+
+    async def enqueue_command(self, msg, priority=None):
+        self._commands.enqueue(msg, priority)
+
+    def get_command_stats(self):
+        return self._commands.get_stats()
+
+    def _sentence_received(self, sentence, rx_time):
+        self._commands.sentence_received(sentence)
+        if self._tpstate:
+            self._tpstate.receive_message(sentence, rx_time)
 
     def data_received(self, data):
-        for c in data.decode('utf-8'):
-            if c == '\n':
-                self._messages.append(self._cur)
-                self._cur = ''
-            elif c == '\r':
-                # Eat \n, due to weird bootloader bugs
-                continue
-            else:
-                self._cur += c
-
-        if self._messages:
-            for message in self._messages:
-                if message.strip():
-                    asyncio.ensure_future(self._tpstate.enqueue_message(message.strip()))
-            self._messages = []
+        if self._capture:
+            self._capture.write(data)
+        self._framer.feed(data)
 
     def connection_lost(self, exc):
         logging.debug('Connection lost to {}. Reason: {}'.format(self._transport, exc))
@@ -63,11 +70,32 @@ class TruePositionUART(asyncio.Protocol):
 
     def stop(self):
         self._running = False
+        if self._capture:
+            self._capture.close()
+
+    @staticmethod
+    async def Open(loop=asyncio.get_event_loop(), uart='/dev/ttyUSB0', baudrate=9600):
+        """
+        Open the UART, without blocking the loop, so several can be opened at once.
+        """
+        # pyserial is only needed when there is a real UART
+        import serial_asyncio
+        _, proto = await serial_asyncio.create_serial_connection(loop, TruePositionUART, uart,
+                baudrate=baudrate)
+        return proto
 
     @staticmethod
     def Create(loop=asyncio.get_event_loop(), uart='/dev/ttyUSB0', baudrate=9600):
-        coro = serial_asyncio.create_serial_connection(loop, TruePositionUART, uart, baudrate=baudrate)
-        _, proto = loop.run_until_complete(coro)
+        return loop.run_until_complete(TruePositionUART.Open(loop=loop, uart=uart, baudrate=baudrate))
+
+    @staticmethod
+    def CreateReplay(loop=asyncio.get_event_loop(), capture='capture.tpcap', speed=1.0, faults=None):
+        """
+        Create a protocol fed from a serial capture rather than a real UART. See
+        ReplayTransport.
+        """
+        proto = TruePositionUART()
+        ReplayTransport(proto, capture, speed=speed, faults=faults, loop=loop)
         return proto
 
 